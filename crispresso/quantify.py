@@ -0,0 +1,443 @@
+"""
+Local quantification of editing outcomes, as an alternative to a Crispresso
+mirror for the numbers that CrispyCrunch shows: how many reads have insertions,
+deletions or substitutions in a window around the cut site, for the reference
+amplicon and, for HDR, the amplicon after HDR. Stats are the same as those of
+CrispressoRequest._get_stats, so they are displayed the same way.
+
+Pairs of reads are merged by their overlap, and identical reads are aligned
+once. Reads are aligned to each amplicon by a global alignment with the scores
+of Crispresso2, in a band around the diagonal, for many reads at a time with
+numpy. Alignments may end before the end of the amplicon, for reads that are
+too short to merge. Each read is assigned to the amplicon it is most identical
+to, if at least MIN_HOMOLOGY percent. Reads that end before the window are not
+counted.
+
+Pure CPU work, so wells are run in a pool of processes. See
+webscraperequest.localrequest.LocalCrispressoRequest.
+
+>>> amplicon = 'CGAGGAGATACAGGCGGAGGGCGCTAGGACCCGCCGGCCACCCCGCCGGCTCCCGGGAGGTTGATAAAGCGGC'
+>>> sgRNA = 'CCGCCGGCTCCCGGGAGGTT'
+>>> cut = amplicon.find(sgRNA) + len(sgRNA) - 3
+>>> reads = Counter({
+...     amplicon: 5,
+...     amplicon[:cut - 2] + amplicon[cut + 2:]: 3,
+...     amplicon[:cut] + 'T' + amplicon[cut:]: 2,
+...     amplicon[:10] + 'T' + amplicon[11:]: 1,
+... })
+>>> stats = quantify_reads(amplicon, sgRNA, reads)
+>>> [(col, stats[col]['Reference']) for col in ('Total', 'Unmodified', 'Modified', 'Insertions', 'Deletions')]
+[('Total', 11), ('Unmodified', 6), ('Modified', 5), ('Insertions', 2), ('Deletions', 3)]
+"""
+import gzip
+import logging
+import os
+
+from collections import Counter, OrderedDict, namedtuple
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import numpy
+
+try:
+    from utils.guidescan import reverse_complement
+except ImportError:
+    # For doctest, which is not run from the project root
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils.guidescan import reverse_complement
+
+logger = logging.getLogger(__name__)
+
+# Scores of Crispresso2, which are those of EDNAFULL
+MATCH = 5
+MISMATCH = -4
+N_SCORE = -2
+GAP_OPEN = -20
+GAP_EXTEND = -2
+# bp of indels allowed beyond the difference in length of read and amplicon
+BAND = 30
+# Reads aligned at a time, and max bytes of their traceback, which is one
+# per read, amplicon position and diagonal of the band
+CHUNK = 256
+MAX_TRACEBACK_BYTES = 64 * 1024 * 1024
+# Min bp that the pair of a read must start with to be found in the read
+MERGE_SEED = 16
+# Max fraction of mismatches in the overlap of a pair of reads
+MERGE_MAX_MISMATCH = 0.1
+# Defaults of the Crispresso form. See CrispressoRequest.data.
+WINDOW_CENTER = -3
+WINDOW_SIZE = 1
+MIN_HOMOLOGY = 60
+
+# Columns of CRISPResso_quantification_of_editing_frequency.txt
+STATS_COLUMNS = (
+    'Total',
+    'Unmodified',
+    'Modified',
+    'Discarded',
+    'Insertions',
+    'Deletions',
+    'Substitutions',
+    'Only Insertions',
+    'Only Deletions',
+    'Only Substitutions',
+    'Insertions and Deletions',
+    'Insertions and Substitutions',
+    'Deletions and Substitutions',
+    'Insertions Deletions and Substitutions',
+)
+
+Alignment = namedtuple('Alignment', [
+    # Percent of aligned columns that match
+    'identity',
+    # (site, length) of inserts before amplicon position site
+    'insertions',
+    # amplicon positions
+    'deletions',
+    'substitutions',
+    # amplicon position after the last aligned base of the read
+    'end',
+])
+
+_CODES = numpy.full(256, 4, dtype=numpy.uint8)
+for _i, _base in enumerate('ACGT'):
+    _CODES[ord(_base)] = _i
+    _CODES[ord(_base.lower())] = _i
+_PAD = 5
+
+# Scores by code of amplicon base and code of read base, with N and padding
+_SCORES = numpy.full((6, 6), MISMATCH, dtype=numpy.int32)
+numpy.fill_diagonal(_SCORES, MATCH)
+_SCORES[4, :] = _SCORES[:, 4] = N_SCORE
+_SCORES[_PAD, :] = _SCORES[:, _PAD] = MISMATCH
+
+_NEG = -2 ** 28
+# Bits of traceback directions
+_FROM_E = 1
+_FROM_F = 2
+_E_EXTENDS = 4
+_F_EXTENDS = 8
+
+
+def read_fastq(path: str) -> Iterator[str]:
+    """Sequences of a fastq file, which may be gzipped"""
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt') as f:  # type: ignore
+        for i, line in enumerate(f):
+            if i % 4 == 1:
+                yield line.strip().upper()
+
+
+def merge_pair(r1: str, r2: str) -> str:
+    """
+    One read of a pair of reads that overlap, or r1 if they do not.
+
+    >>> merge_pair('AAACCCGGGTTTACGTACGTACGCA', reverse_complement('GTTTACGTACGTACGCATCAT'))
+    'AAACCCGGGTTTACGTACGTACGCATCAT'
+    >>> merge_pair('AAACCCGGG', 'AAAAAAAAA')
+    'AAACCCGGG'
+    """
+    r2 = reverse_complement(r2)
+    seed = r2[:MERGE_SEED]
+    start = r1.find(seed)
+    while start >= 0:
+        overlap = r1[start:start + len(r2)]
+        mismatches = sum(a != b for a, b in zip(overlap, r2))
+        if mismatches <= len(overlap) * MERGE_MAX_MISMATCH:
+            # Anything of r1 after r2 is adapter
+            return r1[:start] + r2
+        start = r1.find(seed, start + 1)
+    return r1
+
+
+def read_merged(fastq_r1: str, fastq_r2: str) -> Counter:
+    """Counts of merged reads of a pair of fastqs"""
+    return Counter(merge_pair(r1, r2) for r1, r2 in zip(read_fastq(fastq_r1), read_fastq(fastq_r2)))
+
+
+def window(amplicon: str, sgRNA: str, center: int = WINDOW_CENTER, size: int = WINDOW_SIZE) -> Set[int]:
+    """
+    Positions of the amplicon where edits are counted, around the cut of the
+    guide on either strand.
+
+    >>> sorted(window('AAAAGCTTCCAGGTACAAAA', 'GCTTCCAGGT'))
+    [10, 11]
+    >>> sorted(window('AAAAGCTTCCAGGTACAAAA', 'ACCTGGAAGC'))
+    [6, 7]
+    """
+    amplicon, sgRNA = amplicon.upper(), sgRNA.upper()
+    start = amplicon.find(sgRNA)
+    if start >= 0:
+        cut = start + len(sgRNA) + center
+    else:
+        start = amplicon.find(reverse_complement(sgRNA))
+        if start < 0:
+            raise ValueError('Guide {} not in amplicon'.format(sgRNA))
+        cut = start - center
+    return set(range(cut - size, cut + size))
+
+
+def align(amplicon: str, reads: Sequence[str]) -> List[Alignment]:
+    """
+    Banded global alignments of reads to amplicon, except that reads may end
+    before the amplicon.
+
+    >>> align('ACGTACGTAC', ['ACGTTACGTAC', 'ACGTA', 'ACCTACGTAC'])
+    [Alignment(identity=90.9, insertions=((3, 1),), deletions=(), substitutions=(), end=10), \
+Alignment(identity=100.0, insertions=(), deletions=(), substitutions=(), end=5), \
+Alignment(identity=90.0, insertions=(), deletions=(), substitutions=(2,), end=10)]
+
+    Reads of the same length are aligned together, for the narrowest band.
+    """
+    amplicon = amplicon.upper()
+    order = sorted(range(len(reads)), key=lambda r: len(reads[r]))
+    alignments = [None] * len(reads)  # type: List[Optional[Alignment]]
+    while order:
+        # Reads are in order of length, so the band is as wide as of the last
+        size = 1
+        while size < min(CHUNK, len(order)) and (size + 1) * (len(amplicon) + 1) * \
+                _band_width(len(amplicon), len(reads[order[0]]), len(reads[order[size]])) \
+                <= MAX_TRACEBACK_BYTES:
+            size += 1
+        chunk, order = order[:size], order[size:]
+        for r, ops in zip(chunk, _align_ops(amplicon, [reads[r] for r in chunk])):
+            alignments[r] = _to_alignment(ops)
+    return alignments  # type: ignore
+
+
+def _band(n: int, shortest: int, longest: int) -> Tuple[int, int]:
+    """First and last diagonal of the band, as column minus row"""
+    return min(0, shortest - n) - BAND, max(0, longest - n) + BAND
+
+
+def _band_width(n: int, shortest: int, longest: int) -> int:
+    lo, hi = _band(n, shortest, longest)
+    return hi - lo + 1
+
+
+def _align_ops(amplicon: str, reads: Sequence[str]) -> List[str]:
+    """
+    Columns of the alignment of each read: M for match, X for mismatch, N for
+    an N in either, D for deletion from the read and I for insertion.
+
+    Rows are positions of the amplicon and columns are positions of reads,
+    within a band of diagonals from lo to hi. The gaps of rows are scanned as a
+    running max, which is exact for affine gaps because GAP_OPEN < GAP_EXTEND.
+    """
+    n = len(amplicon)
+    lengths = numpy.array([len(read) for read in reads])
+    width = int(lengths.max())
+    codes = numpy.full((len(reads), width), _PAD, dtype=numpy.uint8)
+    for r, read in enumerate(reads):
+        codes[r, :len(read)] = _CODES[numpy.frombuffer(read.encode('ascii'), dtype=numpy.uint8)]
+    amp_codes = _CODES[numpy.frombuffer(amplicon.encode('ascii'), dtype=numpy.uint8)]
+
+    lo, hi = _band(n, int(lengths.min()), int(lengths.max()))
+    bands = numpy.arange(hi - lo + 1)
+    rows = numpy.arange(len(reads))
+
+    # Row 0 is only insertions
+    cols = lo + bands
+    H = numpy.where(cols == 0, 0, numpy.where(cols > 0, GAP_OPEN + (cols - 1) * GAP_EXTEND, _NEG))
+    H = numpy.tile(H.astype(numpy.int32), (len(reads), 1))
+    E = numpy.full_like(H, _NEG)
+    F = numpy.where(cols > 0, H, _NEG).astype(numpy.int32)
+    first = numpy.where(cols > 0, _FROM_F, 0) | numpy.where(cols > 1, _F_EXTENDS, 0)
+    directions = [numpy.tile(first.astype(numpy.uint8), (len(reads), 1))]
+
+    best, best_row = _ends(H, lengths, 0, lo, numpy.full(len(reads), _NEG), numpy.zeros(len(reads), int))
+    for i in range(1, n + 1):
+        cols = i + lo + bands
+        in_read = (cols >= 1) & (cols <= width)
+        diag = H + _SCORES[amp_codes[i - 1]][codes[:, numpy.clip(cols - 1, 0, width - 1)]]
+        diag[:, ~in_read] = _NEG
+
+        # From the row above, which is one band to the right
+        up_H = numpy.full_like(H, _NEG)
+        up_H[:, :-1] = H[:, 1:]
+        up_E = numpy.full_like(E, _NEG)
+        up_E[:, :-1] = E[:, 1:]
+        E = numpy.maximum(up_H + GAP_OPEN, up_E + GAP_EXTEND)
+        e_extends = up_E + GAP_EXTEND > up_H + GAP_OPEN
+
+        H = numpy.maximum(diag, E)
+        from_e = E > diag
+        running = numpy.maximum.accumulate(H + GAP_OPEN - bands * GAP_EXTEND, axis=1)
+        F = numpy.full_like(H, _NEG)
+        F[:, 1:] = running[:, :-1] + bands[:-1] * GAP_EXTEND
+        from_f = F > H
+        H = numpy.maximum(H, F)
+        f_extends = numpy.zeros_like(from_f)
+        f_extends[:, 1:] = F[:, :-1] + GAP_EXTEND > H[:, :-1] + GAP_OPEN
+
+        outside = (cols < 0) | (cols > width)
+        H[:, outside] = E[:, outside] = F[:, outside] = _NEG
+        directions.append((
+            numpy.where(from_f, _FROM_F, numpy.where(from_e, _FROM_E, 0)) |
+            numpy.where(e_extends, _E_EXTENDS, 0) |
+            numpy.where(f_extends, _F_EXTENDS, 0)).astype(numpy.uint8))
+        best, best_row = _ends(H, lengths, i, lo, best, best_row)
+
+    directions = numpy.stack(directions, axis=1)
+    return [_traceback(directions[r].tolist(), amplicon, reads[r], int(best_row[r]), lo)
+            for r in rows]
+
+
+def _ends(H: numpy.ndarray, lengths: numpy.ndarray, i: int, lo: int,
+          best: numpy.ndarray, best_row: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Best score and row so far of the end of each read"""
+    band = lengths - i - lo
+    inside = (band >= 0) & (band < H.shape[1])
+    scores = numpy.where(inside, H[numpy.arange(len(H)), numpy.clip(band, 0, H.shape[1] - 1)], _NEG)
+    better = scores > best
+    return numpy.where(better, scores, best), numpy.where(better, i, best_row)
+
+
+def _traceback(directions: List[List[int]], amplicon: str, read: str, i: int, lo: int) -> str:
+    ops = []  # type: List[str]
+    j = len(read)
+    state = 0
+    while i > 0 or j > 0:
+        d = directions[i][j - i - lo]
+        if state == 0:
+            state = d & (_FROM_E | _FROM_F)
+            if state:
+                continue
+            a, b = amplicon[i - 1], read[j - 1]
+            ops.append('N' if a == 'N' or b == 'N' else 'M' if a == b else 'X')
+            i -= 1
+            j -= 1
+        elif state == _FROM_E:
+            ops.append('D')
+            state = _FROM_E if d & _E_EXTENDS else 0
+            i -= 1
+        else:
+            ops.append('I')
+            state = _FROM_F if d & _F_EXTENDS else 0
+            j -= 1
+    return ''.join(reversed(ops))
+
+
+def _to_alignment(ops: str) -> Alignment:
+    insertions = []  # type: List[Tuple[int, int]]
+    deletions = []  # type: List[int]
+    substitutions = []  # type: List[int]
+    pos = 0
+    for op in ops:
+        if op == 'I':
+            if insertions and insertions[-1][0] == pos:
+                insertions[-1] = (pos, insertions[-1][1] + 1)
+            else:
+                insertions.append((pos, 1))
+            continue
+        if op == 'D':
+            deletions.append(pos)
+        elif op == 'X':
+            substitutions.append(pos)
+        pos += 1
+    return Alignment(
+        round(100 * ops.count('M') / max(1, len(ops)), 1),
+        tuple(insertions), tuple(deletions), tuple(substitutions), pos)
+
+
+def _map_window(amplicon: str, other: str, positions: Set[int]) -> Set[int]:
+    """Positions of amplicon in other, by their alignment"""
+    mapped = set()
+    pos = other_pos = 0
+    for op in _align_ops(other, [amplicon])[0]:
+        if op != 'I' and pos in positions and op != 'D':
+            mapped.add(other_pos)
+        if op != 'D':
+            pos += 1
+        if op != 'I':
+            other_pos += 1
+    return mapped
+
+
+def classify(alignment: Alignment, positions: Set[int]) -> Tuple[bool, bool, bool]:
+    """
+    Whether there are insertions, deletions and substitutions in the window.
+    Insertions count if next to it.
+    """
+    return (
+        any(site in positions or site - 1 in positions for site, _ in alignment.insertions),
+        any(pos in positions for pos in alignment.deletions),
+        any(pos in positions for pos in alignment.substitutions),
+    )
+
+
+def quantify(
+        amplicon: str,
+        sgRNA: str,
+        fastq_r1: str,
+        fastq_r2: str,
+        amplicon_after_hdr: str = '',
+        window_center: int = WINDOW_CENTER,
+        window_size: int = WINDOW_SIZE,
+        min_homology: int = MIN_HOMOLOGY) -> Dict[str, Dict[str, int]]:
+    """Stats of a pair of fastqs. See quantify_reads."""
+    return quantify_reads(
+        amplicon, sgRNA, read_merged(fastq_r1, fastq_r2), amplicon_after_hdr,
+        window_center, window_size, min_homology)
+
+
+def quantify_reads(
+        amplicon: str,
+        sgRNA: str,
+        reads: Counter,
+        amplicon_after_hdr: str = '',
+        window_center: int = WINDOW_CENTER,
+        window_size: int = WINDOW_SIZE,
+        min_homology: int = MIN_HOMOLOGY) -> Dict[str, Dict[str, int]]:
+    """
+    Stats of counts of reads by column and amplicon, like those of
+    CrispressoRequest._parse_tsv.
+    """
+    amplicons = OrderedDict([('Reference', amplicon.upper())])
+    windows = {'Reference': window(amplicon, sgRNA, window_center, window_size)}
+    if amplicon_after_hdr:
+        amplicons['HDR'] = amplicon_after_hdr.upper()
+        try:
+            windows['HDR'] = window(amplicon_after_hdr, sgRNA, window_center, window_size)
+        except ValueError:
+            # The guide may be mutated by HDR, to stop recutting
+            windows['HDR'] = _map_window(amplicons['Reference'], amplicons['HDR'], windows['Reference'])
+
+    uniques = list(reads)
+    alignments = dict((name, align(seq, uniques)) for name, seq in amplicons.items())
+    counts = OrderedDict((name, Counter()) for name in amplicons)  # type: Dict[str, Counter]
+    for r, read in enumerate(uniques):
+        name = max(amplicons, key=lambda name: alignments[name][r].identity)
+        alignment = alignments[name][r]
+        if alignment.identity < min_homology or alignment.end <= max(windows[name]):
+            continue
+        _count(counts[name], classify(alignment, windows[name]), reads[read])
+
+    stats = OrderedDict()  # type: Dict[str, Dict[str, int]]
+    for column in STATS_COLUMNS:
+        stats[column] = OrderedDict((name, counts[name][column]) for name in amplicons)
+        stats[column]['overall'] = sum(stats[column].values())
+    return stats
+
+
+def _count(counts: Counter, edits: Tuple[bool, bool, bool], count: int) -> None:
+    insertions, deletions, substitutions = edits
+    counts['Total'] += count
+    if not any(edits):
+        counts['Unmodified'] += count
+        return
+    counts['Modified'] += count
+    names = [name for name, edited in zip(('Insertions', 'Deletions', 'Substitutions'), edits) if edited]
+    for name in names:
+        counts[name] += count
+    if len(names) == 1:
+        counts['Only ' + names[0]] += count
+    elif len(names) == 2:
+        counts[' and '.join(names)] += count
+    else:
+        counts['Insertions Deletions and Substitutions'] += count
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -196,9 +196,47 @@ else:  # local dev with remote
             'USER': 'postgres',
             'HOST': 'localhost',
             'PORT': '5432',
-        }
+        },
+        # Local stand-in for the postgres job queue. See main.routers.
+        # Create with: python manage.py migrate --database=jobs
+        'jobs': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'jobs.sqlite3'),
+        },
     }
 
+# Where BatchJob rows are stored. See main.routers.
+JOBS_DATABASE = 'jobs' if 'jobs' in DATABASES else 'default'
+DATABASE_ROUTERS = ['main.routers.JobRouter']
+
+# When true, batch web requests are persisted as BatchJob rows and run by
+# separate `manage.py runworker` processes, instead of threads of the web
+# process. Jobs then survive restarts and redeploys.
+DURABLE_BATCH_JOBS = os.environ.get('DURABLE_BATCH_JOBS', '') == '1'
+
+# Where primers are designed: 'crispor', by the Crispor mirror, or 'primer3',
+# in process with primer3-py. See webscraperequest.localrequest.
+PRIMER_DESIGN_BACKEND = os.environ.get('PRIMER_DESIGN_BACKEND', 'crispor')
+
+# Whether parsed Crispor guide results are kept in a table shared by all
+# experiments. See webscraperequest.guidestore.
+CRISPOR_RESULT_STORE = os.environ.get('CRISPOR_RESULT_STORE', '1') == '1'
+
+# Samples of a plate per Crispresso batch job, or 1 for a job per sample. Batch
+# jobs need a Crispresso mirror with CRISPRessoBatch. See
+# webscraperequest.scraperequest.CrispressoBatchRequest.
+CRISPRESSO_BATCH_SIZE = int(os.environ.get('CRISPRESSO_BATCH_SIZE', 1))
+
+# Where editing outcomes are quantified: 'crispresso', by the Crispresso mirror,
+# or 'local', in process, without Crispresso reports. See crispresso.quantify.
+CRISPRESSO_BACKEND = os.environ.get('CRISPRESSO_BACKEND', 'crispresso')
+
+# Where Crispresso report artifacts are kept by digest, so that results are
+# served from local disk, or '' to link to the mirror only. See
+# webscraperequest.artifacts.
+CRISPRESSO_ARTIFACT_DIR = os.environ.get(
+    'CRISPRESSO_ARTIFACT_DIR', os.path.join(BASE_DIR, 'artifacts'))
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -11,3 +11,5 @@ admin.site.register(PrimerDesign)
 admin.site.register(PrimerSelection)
 admin.site.register(Analysis)
 admin.site.register(GuideDesign)
+admin.site.register(BatchJob)
+admin.site.register(CrisporGuideResult)
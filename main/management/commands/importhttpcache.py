@@ -0,0 +1,39 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils import httpcache
+
+# Files of the requests_cache sessions that each client had before the shared
+# cache, in the working dir of the web server
+LEGACY_FILES = [
+    'webscraperequest.scraperequest_cache.sqlite',
+    'utils.conversions_cache.sqlite',
+    'protospacex.protospacex_cache.sqlite',
+]
+
+
+class Command(BaseCommand):
+    help = """Copies responses from the legacy cache files of web clients into
+    the shared HTTP cache, so that they are not requested again after upgrading.
+    Also removes expired entries from the shared cache. Run once after
+    upgrading, then delete the legacy files."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files', nargs='*',
+            help='Legacy cache files. Default is those of LEGACY_FILES that exist.')
+
+    def handle(self, *args, **options):
+        files = options['files'] or [f for f in LEGACY_FILES if os.path.exists(f)]
+        for filename in files:
+            if not os.path.exists(filename):
+                raise CommandError('No such file: {}'.format(filename))
+            count = httpcache.shared_cache.import_requests_cache(filename)
+            self.stdout.write('{}: {} responses copied'.format(filename, count))
+        if not files:
+            self.stdout.write('No legacy cache files found')
+
+        count = httpcache.shared_cache.remove_old_entries()
+        self.stdout.write('{} expired entries removed'.format(count))
+        self.stdout.write('Cache stats: {}'.format(httpcache.shared_cache.stats()))
@@ -0,0 +1,29 @@
+import signal
+import sys
+
+from django.core.management.base import BaseCommand
+
+from webscraperequest import jobqueue
+from webscraperequest.resultwriter import shared_writer
+
+
+class Command(BaseCommand):
+    help = 'Runs queued batch web requests. See settings.DURABLE_BATCH_JOBS.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=16,
+            help='Max number of jobs in flight in this worker')
+
+    def handle(self, *args, **options):
+        # Exit normally on SIGTERM, such as on redeploy, so that pending
+        # results are written. Jobs in flight are claimed again when their
+        # leases expire.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        worker = jobqueue.Worker(options['concurrency'])
+        self.stdout.write('Starting worker {}'.format(worker.worker_id))
+        try:
+            worker.run_forever()
+        finally:
+            shared_writer.flush()
+            self.stdout.write('Stopped worker {}'.format(worker.worker_id))
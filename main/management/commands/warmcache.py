@@ -0,0 +1,110 @@
+import logging
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+
+from django.core.management.base import BaseCommand, CommandError
+
+import webscraperequest
+
+from main.models import Experiment, GuideDesign
+from main.targets import TargetResolver
+from utils import httpcache
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """Fetches everything that guide design needs for the given targets,
+    so that a later submit is served from cache. Targets are in the same format
+    as GuideDesign.targets_raw, such as "ENST00000330949,N"."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('targets', nargs='*', help='Targets, one per argument')
+        parser.add_argument('--file', help='File of targets, one per line')
+        parser.add_argument('--genome', default='hg38', choices=dict(GuideDesign.GENOMES))
+        parser.add_argument('--pam', default='NGG')
+        parser.add_argument(
+            '--hdr-tag', choices=dict(GuideDesign.HDR_TAG_TERMINUSES),
+            help='Default is per_target when targets end in ",N" or ",C", otherwise no HDR')
+        parser.add_argument('--no-crispor', action='store_true', help='Skip Crispor guides')
+
+    def handle(self, *args, **options):
+        targets_raw = self._read_targets(options)
+        if not targets_raw:
+            raise CommandError('No targets given')
+
+        hdr_tag = options['hdr_tag']
+        if hdr_tag is None and any(t.endswith((',N', ',C')) for t in targets_raw):
+            hdr_tag = 'per_target'
+        guide_design = GuideDesign(
+            experiment=Experiment(name='warmcache', is_hdr=bool(hdr_tag)),
+            targets_raw=targets_raw,
+            genome=options['genome'],
+            pam=options['pam'],
+            hdr_tag=hdr_tag,
+        )
+        try:
+            targets, guide_design.target_tags = guide_design.parse_targets_raw()
+        except ValueError as e:
+            raise CommandError(e)
+
+        self.stdout.write('Warming cache for {} targets...'.format(len(targets)))
+        resolver = TargetResolver(user='warmcache')
+        # Stages are independent, so run them at once
+        with ThreadPoolExecutor(3) as pool:
+            target_locs, target_seqs, _ = pool.map(
+                lambda func: self._resolve(func, targets, guide_design),
+                [resolver.get_targets_chr_loc, resolver.get_target_seqs, resolver.get_target_genes])
+
+        if not options['no_crispor'] and target_locs and target_seqs:
+            self._warm_crispor(target_locs, target_seqs, guide_design)
+
+        self.stdout.write('Cache stats: {}'.format(httpcache.shared_cache.stats()))
+
+    def _read_targets(self, options) -> List[str]:
+        targets_raw = list(options['targets'])
+        if options['file']:
+            with open(options['file']) as f:
+                targets_raw += [line.strip() for line in f if line.strip()]
+        return targets_raw
+
+    def _resolve(self, func, targets, guide_design) -> list:
+        """Each stage fans out over the shared scheduler. See TargetResolver."""
+        try:
+            results = func(targets, guide_design)
+        except Exception as e:
+            self.stderr.write('{} failed: {}'.format(func.__name__, e))
+            return []
+        self.stdout.write('{}: {} done'.format(func.__name__, len(results)))
+        return results
+
+    def _warm_crispor(self, target_locs, target_seqs, guide_design) -> None:
+        futures = []  # type: List[Future]
+        for target, target_seq in zip(target_locs, target_seqs):
+            # Same args as GuideDesignView.plus, so that the cache keys match
+            request = webscraperequest.CrisporGuideRequest(
+                target_seq,
+                guide_design.experiment.name,
+                guide_design.genome,
+                guide_design.pam,
+                target,
+                guide_design.pre_filter,
+                guide_design.guides_per_target)
+            if request.in_cache():
+                continue
+            request.user = 'warmcache'
+            futures.append(webscraperequest.shared_scheduler.submit(
+                webscraperequest.CrisporGuideBatchWebRequest.lane,
+                request.arun_coalesced,
+                user='warmcache',
+            ))
+        self.stdout.write('Crispor: {} targets not in cache'.format(len(futures)))
+        errors = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(str(e))
+                errors += 1
+        self.stdout.write('Crispor: {} done, {} errors'.format(len(futures) - errors, errors))
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:47
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_auto_20190124_1220'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+                ('update_time', models.DateTimeField(auto_now=True)),
+                ('batch_class', models.CharField(max_length=80)),
+                ('model_label', models.CharField(max_length=80)),
+                ('object_id', models.IntegerField()),
+                ('index', models.IntegerField()),
+                ('args', models.TextField()),
+                ('user_id', models.IntegerField(blank=True, null=True)),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=40)),
+                ('attempts', models.IntegerField(default=0)),
+                ('max_attempts', models.IntegerField(default=3)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('lease_owner', models.CharField(blank=True, max_length=160)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['-id'],
+                'index_together': {('state', 'run_after')},
+            },
+        ),
+    ]
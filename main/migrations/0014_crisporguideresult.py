@@ -0,0 +1,53 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:18
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_batchjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrisporGuideResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+                ('update_time', models.DateTimeField(auto_now=True)),
+                ('seq_hash', models.CharField(max_length=64)),
+                ('seq', models.TextField()),
+                ('genome', models.CharField(max_length=80)),
+                ('pam', models.CharField(max_length=80)),
+                ('ingest', models.CharField(max_length=10)),
+                ('batch_id', models.CharField(max_length=40)),
+                ('url', models.TextField()),
+                ('score_columns', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+            ],
+            options={
+                'unique_together': {('seq_hash', 'genome', 'pam', 'ingest')},
+            },
+        ),
+        migrations.CreateModel(
+            name='CrisporGuide',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.IntegerField()),
+                ('pam_id', models.CharField(max_length=20)),
+                ('guide_seq', models.CharField(max_length=80)),
+                ('specificity', models.CharField(max_length=20)),
+                ('efficiency', models.CharField(max_length=20)),
+                ('out_of_frame', models.CharField(max_length=20)),
+                ('primer_url', models.TextField()),
+                ('has_primers', models.NullBooleanField()),
+                ('result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='guides', to='main.CrisporGuideResult')),
+            ],
+            options={
+                'ordering': ['rank'],
+                'unique_together': {('result', 'pam_id')},
+            },
+        ),
+    ]
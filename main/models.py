@@ -5,6 +5,7 @@ See SampleSheetTestCase for example data.
 """
 
 import functools
+import urllib.parse
 from django.utils import timezone
 
 from pandas import DataFrame
@@ -895,6 +896,11 @@ class Analysis(BaseModel):
     def is_complete(self):
         return len(self.results_data) > 0
 
+    def artifact_url(self, index: int, name: str) -> str:
+        """Of a local copy of a file of the report of a sample. See ReportArtifactView."""
+        return '/main/analysis/{}/artifacts/{}/{}'.format(
+            self.id, index, urllib.parse.quote(name))
+
     @cached_property
     def s3_url(self):
         return 'https://console.aws.amazon.com/s3/buckets/{}/{}/'.format(
@@ -903,3 +909,114 @@ class Analysis(BaseModel):
     @cached_property
     def s3_address(self):
         return f's3://{self.s3_bucket}/{self.s3_prefix}'
+
+
+class BatchJob(models.Model):
+    """
+    One request of a BaseBatchWebRequest, persisted so that it survives restarts
+    of the web process. Jobs are claimed by `manage.py runworker` processes with
+    a lease. A job whose lease expires, because its worker died, is claimed
+    again by another worker.
+
+    Jobs are stored in settings.JOBS_DATABASE. See main.routers.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    class Meta:
+        ordering = ['-id']
+        index_together = [('state', 'run_after')]
+
+    create_time = models.DateTimeField(auto_now_add=True)
+    update_time = models.DateTimeField(auto_now=True)
+
+    # Name of a subclass of BaseBatchWebRequest
+    batch_class = models.CharField(max_length=80)
+    # The model instance that receives the result, such as "main.GuideDesign"
+    model_label = models.CharField(max_length=80)
+    object_id = models.IntegerField()
+    # Index into the result field of the model instance
+    index = models.IntegerField()
+    # JSON encoded list of args to the requester of batch_class. Plain text
+    # because JSONField is only supported by postgres.
+    args = models.TextField()
+    # For fair sharing of workers between users
+    user_id = models.IntegerField(null=True, blank=True)
+
+    state = models.CharField(max_length=40, choices=STATES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    lease_owner = models.CharField(max_length=160, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return 'BatchJob({}, {} {}[{}], {})'.format(
+            self.batch_class, self.model_label, self.object_id, self.index, self.state)
+
+
+class CrisporGuideResult(models.Model):
+    """
+    Parsed guide results of Crispor for one target sequence, shared by all
+    experiments. CrisporGuideRequest looks here before any HTTP work, so a
+    target that was designed before costs one indexed lookup. Results expire
+    by create_time, because the Crispor batch of a result is purged in time.
+
+    See webscraperequest.guidestore.
+    """
+
+    class Meta:
+        unique_together = [('seq_hash', 'genome', 'pam', 'ingest')]
+
+    create_time = models.DateTimeField(auto_now_add=True)
+    update_time = models.DateTimeField(auto_now=True)
+
+    # Hash of seq, because target sequences are too long to index
+    seq_hash = models.CharField(max_length=64)
+    # Sequence or chromosome location, as sent to Crispor
+    seq = models.TextField()
+    genome = models.CharField(max_length=80)
+    pam = models.CharField(max_length=80)
+    # How guides were read from Crispor. See CRISPOR_INGEST.
+    ingest = models.CharField(max_length=10)
+
+    batch_id = models.CharField(max_length=40)
+    url = models.TextField()
+    # All score columns of Crispor, when ingested from TSV
+    score_columns = JSONField(null=True, blank=True)
+
+    def __str__(self):
+        return 'CrisporGuideResult({}, {}, {}, {})'.format(
+            self.seq[:40], self.genome, self.pam, self.batch_id)
+
+
+class CrisporGuide(models.Model):
+    """One guide of a CrisporGuideResult, in the order of Crispor."""
+
+    class Meta:
+        ordering = ['rank']
+        unique_together = [('result', 'pam_id')]
+
+    result = models.ForeignKey(CrisporGuideResult, on_delete=models.CASCADE, related_name='guides')
+    rank = models.IntegerField()
+    pam_id = models.CharField(max_length=20)
+    guide_seq = models.CharField(max_length=80)
+    # As shown by Crispor, which may be "None"
+    specificity = models.CharField(max_length=20)
+    efficiency = models.CharField(max_length=20)
+    out_of_frame = models.CharField(max_length=20)
+    primer_url = models.TextField()
+    # Whether Crispor found primers for the guide, once checked by pre_filter
+    has_primers = models.NullBooleanField()
+
+    def __str__(self):
+        return 'CrisporGuide({}, {})'.format(self.pam_id, self.guide_seq)
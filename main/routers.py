@@ -0,0 +1,39 @@
+"""
+Database routing for CrispyCrunch.
+
+BatchJob rows live in settings.JOBS_DATABASE. In prod, that is the same
+postgres database as everything else. In local dev, it is a SQLite file so that
+`manage.py runworker` can be tried without extra setup.
+
+See https://docs.djangoproject.com/en/2.1/topics/db/multi-db/
+"""
+from django.conf import settings
+
+
+def _is_job(model) -> bool:
+    return model._meta.app_label == 'main' and model._meta.model_name == 'batchjob'
+
+
+class JobRouter:
+
+    @property
+    def jobs_db(self) -> str:
+        return getattr(settings, 'JOBS_DATABASE', 'default')
+
+    def db_for_read(self, model, **hints):
+        return self.jobs_db if _is_job(model) else None
+
+    def db_for_write(self, model, **hints):
+        return self.jobs_db if _is_job(model) else None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        is_job = app_label == 'main' and model_name == 'batchjob'
+        if is_job:
+            return db == self.jobs_db
+        if self.jobs_db != 'default' and db == self.jobs_db:
+            # Nothing else belongs in a separate jobs database
+            return False
+        return None
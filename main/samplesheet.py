@@ -528,6 +528,26 @@ def from_excel(file: UploadedFile) -> DataFrame:
     return sheet
 
 
+def _local_report_zip(analysis: Analysis, index: int, report: dict) -> Optional[str]:
+    """The local copy of the report zip, if stored, else the zip on Crispresso"""
+    name = (report.get('report_zip') or '').split('/')[-1]
+    if name in report.get('artifacts', {}):
+        return analysis.artifact_url(index, name)
+    return report.get('report_zip')
+
+
+def _local_report_url(analysis: Analysis, index: int, report: dict) -> Optional[str]:
+    """
+    The local copy of the HTML report of the sample, if the report zip had
+    one, else the report on Crispresso.
+    """
+    pages = sorted((name for name in report.get('artifacts', {}) if name.endswith('.html')),
+                   key=lambda name: name.count('/'))
+    if pages:
+        return analysis.artifact_url(index, pages[0])
+    return report.get('report_url')
+
+
 def _from_analysis(analysis: Analysis, sheet: DataFrame) -> DataFrame:
     # TODO (gdingle): does this do anything?
     # sheet.analysis_id = analysis.id
@@ -553,8 +573,8 @@ def _from_analysis(analysis: Analysis, sheet: DataFrame) -> DataFrame:
     if not any(reports):
         return sheet
 
-    sheet['report_url'] = [r.get('report_url') for r in reports]
-    sheet['report_zip'] = [r.get('report_zip') for r in reports]
+    sheet['report_url'] = [_local_report_url(analysis, i, r) for i, r in enumerate(reports)]
+    sheet['report_zip'] = [_local_report_zip(analysis, i, r) for i, r in enumerate(reports)]
 
     sheet['report_stats'] = _drop_empty_report_stats(reports)
 
@@ -0,0 +1,146 @@
+"""
+Resolves the targets of a GuideDesign into chromosome locations, sequences and
+genes by calling out to web services.
+
+Used by GuideDesignView and by the warmcache management command.
+"""
+import functools
+
+from typing import Hashable
+
+from django.core.exceptions import ValidationError
+
+import webscraperequest
+
+from protospacex import get_cds_chr_loc, get_cds_seq
+from utils import conversions
+from utils.validators import is_chr, is_ensemble_transcript, is_gene, is_seq
+
+
+class TargetResolver:
+    """
+    Each method takes cleaned targets, see GuideDesign.parse_targets_raw, and a
+    GuideDesign, which need not be saved.
+    """
+
+    def __init__(self, user: Hashable = None) -> None:
+        # For fair sharing of the scheduler between users
+        self.user = user
+
+    def get_targets_chr_loc(self, targets, guide_design):
+        genome = guide_design.genome
+
+        if all(is_chr(t) for t in targets):
+            return targets
+
+        elif guide_design.is_hdr:
+            if not all(is_ensemble_transcript(t) or is_gene(t) for t in targets):
+                raise ValidationError(
+                    'Targets must all be ENST transcripts or gene symbols for HDR')
+            if genome != 'hg38':
+                raise ValidationError(
+                    'ENST transcripts are only currently implemented for the hg38 genome')
+            if guide_design.hdr_tag == 'per_target':
+                func = get_cds_chr_loc
+                cds_indexes = guide_design.cds_index
+                if not cds_indexes:
+                    raise ValidationError('You must specify "N" or "C" for each target')
+                cds_lengths = guide_design.cds_length
+                return self._map('ensembl', func, targets, cds_indexes, cds_lengths)
+            else:
+                func = functools.partial(
+                    get_cds_chr_loc,
+                    cds_index=guide_design.cds_index,
+                    length=guide_design.cds_length)
+                return self._map('ensembl', func, targets)
+
+        elif all(is_seq(t) for t in targets):
+            func = functools.partial(
+                conversions.seq_to_chr_loc,
+                genome=genome)
+            return self._map('gggenome', func, targets)
+
+        elif all(is_gene(t) or is_ensemble_transcript(t) for t in targets):
+            # TODO (gdingle): this still needs some work to get best region of gene and not the whole thing
+            func = functools.partial(
+                conversions.gene_to_chr_loc,
+                genome=genome)
+            return self._map('ucsc', func, targets)
+
+        raise ValidationError('Targets must be all of one accepted type')
+
+    def get_target_seqs(self, targets, guide_design):
+        if all(is_seq(t) for t in targets):
+            return targets
+
+        genome = guide_design.genome
+
+        if guide_design.is_hdr:
+            if genome != 'hg38':
+                raise ValidationError(
+                    'ENST transcripts are only currently implemented for the hg38 genome')
+            if guide_design.hdr_tag == 'per_target':
+                func = get_cds_seq
+                cds_indexes = guide_design.cds_index
+                cds_lengths = guide_design.cds_length
+                return self._map('ensembl', func, targets, cds_indexes, cds_lengths)
+            else:
+                func = functools.partial(
+                    get_cds_seq,
+                    cds_index=guide_design.cds_index,
+                    length=guide_design.cds_length)
+                return self._map('ensembl', func, targets)
+
+        elif all(is_ensemble_transcript(t) for t in targets):
+            raise ValidationError(
+                'ENST transcripts are only currently implemented for HDR')
+
+        elif all(is_gene(t) for t in targets):
+            raise ValidationError(
+                'Targeting genes by name is only currently implemented for HDR')
+
+        elif all(is_chr(t) for t in targets):
+            func = functools.partial(
+                conversions.chr_loc_to_seq,
+                genome=genome)
+            return self._map('togows', func, targets)
+
+        raise ValidationError('Targets must be all of one accepted type')
+
+    def get_target_genes(self, targets, guide_design):
+        if all(is_gene(t) for t in targets):
+            return targets
+
+        elif all(is_ensemble_transcript(t) for t in targets):
+            lane = 'ucsc'
+            func = functools.partial(
+                conversions.enst_to_gene_or_unknown,
+                genome=guide_design.genome)
+
+        elif all(is_seq(t) for t in targets):
+            lane = 'togows'
+            func1 = functools.partial(
+                conversions.seq_to_chr_loc,
+                genome=guide_design.genome)
+            func2 = functools.partial(
+                conversions.chr_loc_to_gene,
+                genome=guide_design.genome)
+
+            def func(target):  # type: ignore
+                return func2(func1(target))
+
+        elif all(is_chr(t) for t in targets):
+            lane = 'togows'
+            func = functools.partial(
+                conversions.chr_loc_to_gene,
+                genome=guide_design.genome)
+
+        else:
+            raise ValidationError('Targets must be all of one accepted type')
+
+        return self._map(lane, func, targets)
+
+    def _map(self, lane: str, func, *iterables) -> list:
+        """Map on the shared scheduler, which caps concurrency per upstream."""
+        return webscraperequest.shared_scheduler.map(
+            lane, func, *iterables, user=self.user)
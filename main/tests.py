@@ -1,8 +1,21 @@
 import doctest
 
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, connections
 from django.test import TestCase
+from django.utils import timezone
 
 from utils import *
+from crispresso import quantify
+from utils import guidescan, httpcache, multipart, primerdesign, ratelimit, singleflight
+from webscraperequest import artifacts, crisporpage, guidestore, jobqueue, localrequest, mirrors, statuspoller
+from webscraperequest import resultwriter
+from webscraperequest.resultwriter import ResultWriter, update_elements
+from webscraperequest.batchrequest import CrisporGuideBatchWebRequest
 
 from main.models import *
 from main.samplesheet import *
@@ -19,6 +32,18 @@ def load_tests(loader, tests, ignore):
         validators,
         chrloc,
         hdr,
+        ratelimit,
+        singleflight,
+        httpcache,
+        crisporpage,
+        primerdesign,
+        guidescan,
+        multipart,
+        localrequest,
+        mirrors,
+        statuspoller,
+        quantify,
+        artifacts,
     ]
     for module in modules:
         tests.addTests(doctest.DocTestSuite(module))
@@ -157,3 +182,228 @@ class SampleSheetTestCase(TestCase):
         self.assertEqual(sheet.loc['A3', 'fastq_fwd'],
                          'A3-BCAP31-C-sorted-180212_S3_L001_R1_001.fastq.gz')
         self.assertEqual(len(sheet), 2)
+
+
+class JobQueueTestCase(TestCase):
+    """Claims, leases and retries of webscraperequest.jobqueue"""
+
+    databases = '__all__'
+
+    def _job(self, **kwargs):
+        return BatchJob.objects.create(**dict(
+            dict(batch_class='CrisporGuideBatchWebRequest',
+                 model_label='main.GuideDesign',
+                 object_id=1,
+                 index=0,
+                 args='["chr1:11130540-11130751"]'),
+            **kwargs))
+
+    def _expire(self, job):
+        BatchJob.objects.filter(id=job.id).update(
+            lease_expires=timezone.now() - timedelta(seconds=1))
+
+    def test_claim(self):
+        job = self._job()
+        claimed = jobqueue.claim('a', limit=2)
+        self.assertEqual([j.id for j in claimed], [job.id])
+        self.assertEqual((claimed[0].state, claimed[0].lease_owner, claimed[0].attempts),
+                         (BatchJob.RUNNING, 'a', 1))
+        self.assertEqual(jobqueue.claim('b'), [])
+
+    def test_claim_later(self):
+        self._job(run_after=timezone.now() + timedelta(seconds=60))
+        self.assertEqual(jobqueue.claim('a'), [])
+
+    def test_claim_expired_lease(self):
+        job = self._job()
+        jobqueue.claim('a')
+        self._expire(job)
+        claimed = jobqueue.claim('b')
+        self.assertEqual((claimed[0].lease_owner, claimed[0].attempts), ('b', 2))
+
+    def test_fail_exhausted(self):
+        job = self._job(state=BatchJob.RUNNING, attempts=3, lease_owner='a',
+                        lease_expires=timezone.now() - timedelta(seconds=1))
+        with mock.patch.object(jobqueue, '_write_result') as write:
+            self.assertEqual(jobqueue.claim('b'), [])
+        job.refresh_from_db()
+        self.assertEqual(job.state, BatchJob.FAILED)
+        self.assertFalse(write.call_args[0][2]['success'])
+
+    def test_finish(self):
+        self._job()
+        job, = jobqueue.claim('a')
+        with mock.patch.object(jobqueue, '_write_result') as write:
+            jobqueue.Worker(worker_id='a')._finish(job, CrisporGuideBatchWebRequest, result={'x': 1})
+        job.refresh_from_db()
+        self.assertEqual(job.state, BatchJob.DONE)
+        self.assertEqual(write.call_args[0][1], 'guide_data')
+        self.assertTrue(write.call_args[0][2]['success'])
+
+    def test_finish_after_lease_lost(self):
+        self._job()
+        job, = jobqueue.claim('a')
+        self._expire(job)
+        jobqueue.claim('b')
+        with mock.patch.object(jobqueue, '_write_result') as write:
+            jobqueue.Worker(worker_id='a')._finish(job, CrisporGuideBatchWebRequest, result={'x': 1})
+        write.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.lease_owner), (BatchJob.RUNNING, 'b'))
+
+    def test_retry(self):
+        self._job()
+        job, = jobqueue.claim('a')
+        jobqueue.Worker(worker_id='a')._finish(job, CrisporGuideBatchWebRequest, error=RuntimeError('flaky'))
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.error), (BatchJob.QUEUED, 'flaky'))
+        self.assertGreater(job.run_after, timezone.now())
+
+    def test_no_retry_of_bad_input(self):
+        self._job()
+        job, = jobqueue.claim('a')
+        with mock.patch.object(jobqueue, '_write_result'):
+            jobqueue.Worker(worker_id='a')._finish(job, CrisporGuideBatchWebRequest, error=ValueError('bad'))
+        job.refresh_from_db()
+        self.assertEqual(job.state, BatchJob.FAILED)
+
+    def test_bad_args(self):
+        self._job()
+        job, = jobqueue.claim('a')
+        requester = mock.Mock(side_effect=AssertionError('Bad trim'))
+        with mock.patch.object(CrisporGuideBatchWebRequest, 'requester', requester), \
+                mock.patch.object(jobqueue, '_write_result') as write:
+            jobqueue.Worker(worker_id='a')._start(job)
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.error), (BatchJob.FAILED, 'Bad trim'))
+        self.assertEqual(write.call_args[0][1], 'guide_data')
+        self.assertEqual((write.call_args[0][2]['success'], write.call_args[0][2]['error']),
+                         (False, 'Bad trim'))
+
+    def test_unknown_batch_class(self):
+        self._job(batch_class='NoSuchBatchWebRequest')
+        job, = jobqueue.claim('a')
+        with mock.patch.object(jobqueue, '_write_result') as write:
+            jobqueue.Worker(worker_id='a')._start(job)
+        write.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual(job.state, BatchJob.FAILED)
+
+    def test_renew_leases(self):
+        self._job()
+        job, = jobqueue.claim('a')
+        self._expire(job)
+        worker = jobqueue.Worker(worker_id='a')
+        worker._in_flight[job.id] = job
+        self.assertEqual(worker.renew_leases(), 1)
+        job.refresh_from_db()
+        self.assertGreater(job.lease_expires, timezone.now())
+        self.assertEqual(jobqueue.Worker(worker_id='b').renew_leases(), 0)
+
+
+class ResultWriterTestCase(TestCase):
+    """Writes of single elements of results by webscraperequest.resultwriter"""
+
+    def _analysis(self, results_data):
+        owner = get_user_model().objects.create(username='writer')
+        experiment = Experiment.objects.create(owner=owner, name='test')
+        return Analysis.objects.create(
+            owner=owner, experiment=experiment, results_data=results_data)
+
+    def test_update_elements(self):
+        analysis = self._analysis([{'a': 1}, {'a': 2}, {'a': 3}])
+        # Written meanwhile by someone else
+        Analysis.objects.filter(id=analysis.id).update(s3_prefix='other')
+        update_elements(Analysis, analysis.id, 'results_data', {0: {'b': 1}, 2: {'a': 4}})
+        analysis.refresh_from_db()
+        self.assertEqual(analysis.results_data, [{'a': 1, 'b': 1}, {'a': 2}, {'a': 4}])
+        self.assertEqual(analysis.s3_prefix, 'other')
+
+    def test_update_missing_element(self):
+        # jsonb_set of NULL is NULL, hence COALESCE
+        analysis = self._analysis([{'a': 1}])
+        update_elements(Analysis, analysis.id, 'results_data', {1: {'b': 2}})
+        analysis.refresh_from_db()
+        self.assertEqual(analysis.results_data, [{'a': 1}, {'b': 2}])
+
+    def test_update_elements_locked(self):
+        analysis = self._analysis([{'a': 1}, {'a': 2}])
+        Analysis.objects.filter(id=analysis.id).update(s3_prefix='other')
+        with mock.patch.object(connections['default'], 'vendor', 'sqlite'):
+            update_elements(Analysis, analysis.id, 'results_data', {1: {'b': 3}})
+        analysis.refresh_from_db()
+        self.assertEqual(analysis.results_data, [{'a': 1}, {'a': 2, 'b': 3}])
+        self.assertEqual(analysis.s3_prefix, 'other')
+
+    def test_flush(self):
+        analysis = self._analysis([{'a': 1}])
+        writer = ResultWriter(window=60)
+        writer.write(analysis, 'results_data', 0, {'success': True})
+        self.assertEqual(Analysis.objects.get(id=analysis.id).results_data, [{'a': 1}])
+        writer.flush()
+        self.assertEqual(Analysis.objects.get(id=analysis.id).results_data,
+                         [{'a': 1, 'success': True}])
+
+    def test_retry_failed_write(self):
+        writer = ResultWriter(window=60)
+        key = (Analysis, 1, 'results_data')
+        with mock.patch('webscraperequest.resultwriter.update_elements',
+                        side_effect=[DatabaseError('Lost connection'), None]) as update:
+            writer._write_all({key: {0: {'a': 1}, 1: {'a': 1}}})
+            writer._merge(writer._pending[key], 1, {'b': 2})
+            writer.flush()
+        self.assertEqual(update.call_args[0][3], {0: {'a': 1}, 1: {'a': 1, 'b': 2}})
+        self.assertEqual((writer._pending, writer._attempts), ({}, {}))
+
+    def test_drop_failed_write(self):
+        writer = ResultWriter(window=60)
+        key = (Analysis, 1, 'results_data')
+        with mock.patch('webscraperequest.resultwriter.update_elements',
+                        side_effect=DatabaseError('Lost connection')) as update:
+            writer._write_all({key: {0: {'a': 1}}})
+            for _ in range(10):
+                writer.flush()
+        self.assertEqual(update.call_count, resultwriter.MAX_WRITE_ATTEMPTS)
+        self.assertEqual((writer._pending, writer._attempts), ({}, {}))
+
+    def test_insert_error(self):
+        batch = CrisporGuideBatchWebRequest(mock.Mock())
+        batch.model_instance.guide_data = [{'success': None}]
+        future = Future()  # type: Future
+        future.set_exception(RuntimeError('No response'))
+        batch._insert(future, index=0)
+        result = batch.model_instance.guide_data[0]
+        self.assertEqual((result['success'], result['error']), (False, 'No response'))
+        self.assertIn('end_time', result)
+
+
+class GuideStoreTestCase(TestCase):
+    """Expiry of results of webscraperequest.guidestore"""
+
+    KEY = ('ACGTACGT', 'hg38', 'NGG', 'html')
+    DATA = dict(
+        url='http://crispor.tefor.net/crispor.py?batchId=abc',
+        batch_id='abc',
+        guide_seqs={'s1+': 'ACGTACGTACGTACGTACGT AGG'},
+        scores={'s1+': [90, 50, 60]},
+        primer_urls={'s1+': 'http://crispor.tefor.net/crispor.py?batchId=abc&pamId=s1%2B'},
+    )
+
+    def _age(self, seconds):
+        CrisporGuideResult.objects.update(create_time=timezone.now() - timedelta(seconds=seconds))
+
+    def test_load(self):
+        guidestore.save(*self.KEY, self.DATA)
+        self._age(guidestore.MAX_AGE - 60)
+        self.assertTrue(guidestore.has(*self.KEY))
+        data = guidestore.load(*self.KEY)
+        self.assertEqual((data['batch_id'], list(data['guide_seqs'])), ('abc', ['s1+']))
+
+    def test_expired(self):
+        guidestore.save(*self.KEY, self.DATA)
+        self._age(guidestore.MAX_AGE + 60)
+        self.assertFalse(guidestore.has(*self.KEY))
+        self.assertIsNone(guidestore.load(*self.KEY))
+        guidestore.save(*self.KEY, dict(self.DATA, batch_id='def'))
+        self.assertEqual(CrisporGuideResult.objects.count(), 1)
+        self.assertEqual(guidestore.load(*self.KEY)['batch_id'], 'def')
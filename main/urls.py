@@ -31,6 +31,9 @@ urlpatterns = [
          never_cache(login_required(views.GuideDesignProgressView.as_view())),
          name='Guide Design Progress'
          ),
+    path('guide-design/<int:id>/progress/stream/',
+         never_cache(login_required(views.GuideDesignProgressStreamView.as_view())),
+         ),
     path('guide-design/<int:id>/guide-selection/',
          login_required(views.GuideSelectionView.as_view()),
          name='Guide Selection'
@@ -43,6 +46,9 @@ urlpatterns = [
          never_cache(login_required(views.PrimerDesignProgressView.as_view())),
          name='Primer Design Progress'
          ),
+    path('primer-design/<int:id>/progress/stream/',
+         never_cache(login_required(views.PrimerDesignProgressStreamView.as_view())),
+         ),
     path('primer-design/<int:id>/primer-selection/',
          login_required(views.PrimerSelectionView.as_view()),
          name='Primer Selection'
@@ -69,11 +75,19 @@ urlpatterns = [
         never_cache(login_required(views.AnalysisProgressView.as_view())),
         name='Analysis Progress'
     ),
+    path(
+        'analysis/<int:id>/progress/stream/',
+        never_cache(login_required(views.AnalysisProgressStreamView.as_view())),
+    ),
     path(
         'analysis/<int:id>/results/',
         login_required(views.ResultsView.as_view()),
         name='Results'
     ),
+    path(
+        'analysis/<int:id>/artifacts/<int:index>/<path:name>',
+        login_required(views.ReportArtifactView.as_view()),
+    ),
     path(
         'analysis/<int:id>/custom/',
         login_required(views.CustomAnalysisView.as_view()),
@@ -10,12 +10,13 @@ exception is PrimerDesign which depends on GuideSelection, two steps back in the
 sequence.
 """
 import copy
+import json
 import logging
+import mimetypes
 import os
 import time
 import urllib
 
-from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO, StringIO
 from itertools import islice
 from typing import Any, Optional
@@ -23,8 +24,9 @@ from typing import Any, Optional
 import openpyxl  # type: ignore
 import sample_sheet as illumina  # type: ignore
 
-from django.http import Http404
-from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect
+from django.conf import settings
+from django.http import FileResponse, Http404
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render
 from django.views import View
 from django.views.generic import DetailView, ListView
@@ -33,16 +35,17 @@ from django.views.generic.edit import CreateView
 
 
 import webscraperequest
+from webscraperequest import artifacts
 
 from crispresso.fastqs import find_matching_pairs, reverse_complement
 from crispresso.s3 import download_fastqs
-from protospacex import get_cds_chr_loc, get_cds_seq, get_ultramer_seq
+from protospacex import get_ultramer_seq
 
 from main import samplesheet
 from main.forms import *
 from main.models import *
-from utils import conversions
-from utils.validators import is_ensemble_transcript
+from main.targets import TargetResolver
+from utils import guidescan
 
 logger = logging.getLogger(__name__)
 
@@ -137,126 +140,6 @@ class GuideDesignView(CreatePlusView):
         else:
             return GuideDesignForm2
 
-    def _get_targets_chr_loc(self, targets, guide_design):
-        genome = guide_design.genome
-
-        if all(is_chr(t) for t in targets):
-            return targets
-
-        elif guide_design.is_hdr:
-            if not all(is_ensemble_transcript(t) or is_gene(t) for t in targets):
-                raise ValidationError(
-                    'Targets must all be ENST transcripts or gene symbols for HDR')
-            if genome != 'hg38':
-                raise ValidationError(
-                    'ENST transcripts are only currently implemented for the hg38 genome')
-            if guide_design.hdr_tag == 'per_target':
-                func = get_cds_chr_loc
-                cds_indexes = guide_design.cds_index
-                if not cds_indexes:
-                    raise ValidationError('You must specify "N" or "C" for each target')
-                cds_lengths = guide_design.cds_length
-                with ThreadPoolExecutor(4) as pool:
-                    return list(pool.map(func, targets, cds_indexes, cds_lengths))
-            else:
-                func = functools.partial(
-                    get_cds_chr_loc,
-                    cds_index=guide_design.cds_index,
-                    length=guide_design.cds_length)
-                with ThreadPoolExecutor(4) as pool:
-                    return list(pool.map(func, targets))
-
-        elif all(is_seq(t) for t in targets):
-            func = functools.partial(
-                conversions.seq_to_chr_loc,
-                genome=genome)
-            with ThreadPoolExecutor(4) as pool:
-                return list(pool.map(func, targets))
-
-        elif all(is_gene(t) or is_ensemble_transcript(t) for t in targets):
-            # TODO (gdingle): this still needs some work to get best region of gene and not the whole thing
-            func = functools.partial(
-                conversions.gene_to_chr_loc,
-                genome=genome)
-            with ThreadPoolExecutor(4) as pool:
-                return list(pool.map(func, targets))
-
-        raise ValidationError('Targets must be all of one accepted type')
-
-    def _get_target_seqs(self, targets, guide_design):
-        if all(is_seq(t) for t in targets):
-            return targets
-
-        genome = guide_design.genome
-
-        if guide_design.is_hdr:
-            if genome != 'hg38':
-                raise ValidationError(
-                    'ENST transcripts are only currently implemented for the hg38 genome')
-            if guide_design.hdr_tag == 'per_target':
-                func = get_cds_seq
-                cds_indexes = guide_design.cds_index
-                cds_lengths = guide_design.cds_length
-                with ThreadPoolExecutor(4) as pool:
-                    return list(pool.map(func, targets, cds_indexes, cds_lengths))
-            else:
-                func = functools.partial(
-                    get_cds_seq,
-                    cds_index=guide_design.cds_index,
-                    length=guide_design.cds_length)
-                with ThreadPoolExecutor(4) as pool:
-                    return list(pool.map(func, targets))
-
-        elif all(is_ensemble_transcript(t) for t in targets):
-            raise ValidationError(
-                'ENST transcripts are only currently implemented for HDR')
-
-        elif all(is_gene(t) for t in targets):
-            raise ValidationError(
-                'Targeting genes by name is only currently implemented for HDR')
-
-        elif all(is_chr(t) for t in targets):
-            func = functools.partial(
-                conversions.chr_loc_to_seq,
-                genome=genome)
-            with ThreadPoolExecutor(4) as pool:
-                return list(pool.map(func, targets))
-
-        raise ValidationError('Targets must be all of one accepted type')
-
-    def _get_target_genes(self, targets, guide_design):
-        if all(is_gene(t) for t in targets):
-            return targets
-
-        elif all(is_ensemble_transcript(t) for t in targets):
-            func = functools.partial(
-                conversions.enst_to_gene_or_unknown,
-                genome=guide_design.genome)
-
-        elif all(is_seq(t) for t in targets):
-            func1 = functools.partial(
-                conversions.seq_to_chr_loc,
-                genome=guide_design.genome)
-            func2 = functools.partial(
-                conversions.chr_loc_to_gene,
-                genome=guide_design.genome)
-
-            def func(target):  # type: ignore
-                return func2(func1(target))
-
-        elif all(is_chr(t) for t in targets):
-            func = functools.partial(
-                conversions.chr_loc_to_gene,
-                genome=guide_design.genome)
-
-        else:
-            raise ValidationError('Targets must be all of one accepted type')
-
-        # More than 4 starts causing strange 404 errors from togows.org
-        # and it causes 'You have exceeded the limit' errors from UCSC :(
-        with ThreadPoolExecutor(4) as pool:
-            return list(pool.map(func, targets))
-
     def plus(self, obj):
         obj.experiment = Experiment.objects.get(
             owner=self.request.user, id=self.kwargs['id'])
@@ -264,18 +147,19 @@ class GuideDesignView(CreatePlusView):
         targets_cleaned, target_tags = obj.parse_targets_raw()
         obj.target_tags = target_tags
 
+        resolver = TargetResolver(user=self.request.user.id)
         logger.info('Getting chromosome locations...')
-        obj.target_locs = self._get_targets_chr_loc(
+        obj.target_locs = resolver.get_targets_chr_loc(
             targets_cleaned,
             obj
         )
         logger.info('Getting target sequences...')
-        obj.target_seqs = self._get_target_seqs(
+        obj.target_seqs = resolver.get_target_seqs(
             targets_cleaned,
             obj
         )
         logger.info('Getting target genes...')
-        obj.target_genes = self._get_target_genes(
+        obj.target_genes = resolver.get_target_genes(
             targets_cleaned,
             obj
         )
@@ -288,10 +172,11 @@ class GuideDesignView(CreatePlusView):
             obj.genome,
             obj.pam,
             target,
-            obj.pre_filter]
+            obj.pre_filter,
+            obj.guides_per_target]
             for target, target_seq in zip(obj.target_locs, obj.target_seqs)]
         logger.info('Getting guides from Crispor...')
-        batch.start(largs, [-2])
+        batch.start(largs, [4])
 
         return obj
 
@@ -309,13 +194,111 @@ class GuideDesignProgressView(View):
         other_recent_usage = guide_design.other_recent_usage
 
         if not batch_status.is_successful:
+            local_guides = self._local_guides(guide_design)
             return render(request, self.template_name, locals())
         else:
-            # For unknown reason, redirecting too early causes 500 error
-            time.sleep(1)
             return HttpResponseRedirect(
                 self.success_url.format(id=self.kwargs['id']))
 
+    @staticmethod
+    def _local_guides(guide_design: GuideDesign, top: int = 3) -> dict:
+        """
+        Best guides of each target by efficiency, scanned locally while Crispor
+        computes specificity. See utils.guidescan. They are a preview only.
+        guide_data, and so guide selection, still comes entirely from Crispor.
+
+        Scans are cached by sequence, because the page is rendered on every
+        poll of the progress.
+        """
+        return dict(
+            (str(target_loc), guidescan.top_guides(target_seq, guide_design.pam, top))
+            for target_loc, target_seq in zip(guide_design.target_locs, guide_design.target_seqs))
+
+
+class BatchProgressStreamView(View):
+    """
+    Streams the statuses of rows of a batch as server-sent events, for the
+    progress templates. Only rows that changed since the last event are sent.
+    Rows are re-read as soon as results are written in this process, see
+    webscraperequest.shared_hub, and at least every POLL_SECONDS otherwise.
+
+    The stream ends when the batch is done, with a "done" event that has the
+    success_url if the batch is finished, or else after STREAM_SECONDS, after
+    which the browser reconnects in RETRY_MILLISECONDS. So a stream is a long
+    poll: each open progress page holds a server thread for at most
+    STREAM_SECONDS at a time. Size the threads of the web server for the
+    progress pages open at once, plus other requests. See the README.
+    """
+    model = None  # type: Any
+    batch_class = None  # type: Any
+    success_url = ''
+
+    # So that one browser tab does not hold a server thread for long
+    STREAM_SECONDS = 10
+    RETRY_MILLISECONDS = 2000
+    POLL_SECONDS = 2
+
+    def get(self, request, **kwargs):
+        instance = self.model.objects.get(
+            owner=self.request.user, id=kwargs['id'])
+        response = StreamingHttpResponse(
+            self._events(self.batch_class(instance)),
+            content_type='text/event-stream')
+        # Do not let proxies buffer events
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def is_finished(self, batch_status: webscraperequest.BatchStatus) -> bool:
+        """Whether to advance to success_url. Same as the progress view."""
+        return batch_status.is_successful
+
+    def _events(self, batch: webscraperequest.BaseBatchWebRequest):
+        key = batch.progress_key
+        deadline = time.monotonic() + self.STREAM_SECONDS
+        version = webscraperequest.shared_hub.version(key)
+        sent = {}  # type: dict
+        yield 'retry: {}\n\n'.format(self.RETRY_MILLISECONDS)
+        while True:
+            batch.model_instance.refresh_from_db(fields=[str(batch.field_name)])
+            batch_status = batch.get_batch_status()
+            rows = batch_status.rows
+            changed = [{'index': i, 'status': status, 'label': label}
+                       for i, (status, label) in rows.items()
+                       if sent.get(i) != (status, label)]
+            sent = rows
+            if changed:
+                yield self._event('rows', {
+                    'rows': changed,
+                    'completed': len(batch_status.completed),
+                    'total': len(batch_status.statuses),
+                    'percent_success': batch_status.percent_success,
+                    'percent_error': batch_status.percent_error,
+                })
+            else:
+                yield ': keep-alive\n\n'
+
+            if self.is_finished(batch_status):
+                yield self._event('done', {'url': self.success_url.format(id=self.kwargs['id'])})
+                return
+            elif batch_status.is_done:
+                yield self._event('done', {'url': None})
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            version = webscraperequest.shared_hub.wait(
+                key, version, min(self.POLL_SECONDS, remaining))
+
+    @staticmethod
+    def _event(name: str, data: dict) -> str:
+        return 'event: {}\ndata: {}\n\n'.format(name, json.dumps(data))
+
+
+class GuideDesignProgressStreamView(BatchProgressStreamView):
+    model = GuideDesign
+    batch_class = webscraperequest.CrisporGuideBatchWebRequest
+    success_url = GuideDesignProgressView.success_url
+
 
 class GuideSelectionView(CreatePlusView):
     template_name = 'guide-selection.html'
@@ -416,6 +399,8 @@ class PrimerDesignView(CreatePlusView):
         obj.guide_selection = guide_selection
 
         sheet = samplesheet.from_guide_selection(guide_selection)
+        if settings.PRIMER_DESIGN_BACKEND == 'primer3':
+            return self._plus_primer3(obj, sheet)
         batch = webscraperequest.CrisporPrimerBatchWebRequest(obj)
 
         largs = [[row['_crispor_batch_id'],
@@ -433,6 +418,21 @@ class PrimerDesignView(CreatePlusView):
         # https://github.com/chanzuckerberg/crispr-primer
         return obj
 
+    def _plus_primer3(self, obj, sheet):
+        """Same as Crispor, but designed in process. See LocalPrimerRequest."""
+        batch = webscraperequest.LocalPrimerBatchWebRequest(obj)
+        largs = [[str(row['target_loc']),
+                  str(row['guide_loc']),
+                  obj.guide_selection.guide_design.genome,
+                  obj.max_amplicon_length,
+                  obj.primer_temp,
+                  row['_guide_id'],
+                  self._get_hdr_dist_for_crispor(row)]
+                 for row in sheet.to_records()
+                 if row['guide_seq']]
+        batch.start(largs, [-2])
+        return obj
+
     @staticmethod
     def _get_hdr_dist_for_crispor(row):
         """
@@ -464,12 +464,20 @@ class PrimerDesignProgressView(View):
             if not batch_status.is_successful:
                 logger.warn('Advancing to PrimerSelectionView with errors')
                 # TODO (gdingle): remove errors
-            # For unknown reason, redirecting too early causes 500 error
-            time.sleep(1)
             return HttpResponseRedirect(
                 self.success_url.format(id=self.kwargs['id']))
 
 
+class PrimerDesignProgressStreamView(BatchProgressStreamView):
+    model = PrimerDesign
+    batch_class = webscraperequest.CrisporPrimerBatchWebRequest
+    success_url = PrimerDesignProgressView.success_url
+
+    def is_finished(self, batch_status):
+        # Primer errors are shown in PrimerSelectionView
+        return batch_status.is_done
+
+
 class PrimerSelectionView(CreatePlusView):
     template_name = 'primer-selection.html'
     form_class = PrimerSelectionForm
@@ -564,11 +572,11 @@ class PrimerSelectionView(CreatePlusView):
         targets_cleaned, _ = guide_design.parse_targets_raw()
 
         # TODO (gdingle): another instance of IO... how to avoid?
-        with ThreadPoolExecutor(4) as pool:
-            ultramer_seqs = list(pool.map(
-                lambda args: _get_ultramer_seq(*args),
-                zip(targets_cleaned, guide_design.cds_index, guide_design.target_locs),
-            ))
+        ultramer_seqs = webscraperequest.shared_scheduler.map(
+            'ensembl',
+            _get_ultramer_seq,
+            targets_cleaned, guide_design.cds_index, guide_design.target_locs,
+            user=self.request.user.id)
         return ultramer_seqs
 
     def _primerblast_urls(
@@ -822,6 +830,12 @@ class AnalysisProgressView(View):
                 self.success_url.format(id=self.kwargs['id']))
 
 
+class AnalysisProgressStreamView(BatchProgressStreamView):
+    model = Analysis
+    batch_class = webscraperequest.CrispressoBatchWebRequest
+    success_url = AnalysisProgressView.success_url
+
+
 class ResultsView(View):
     template_name = 'crispresso-results.html'
 
@@ -843,6 +857,47 @@ class ResultsView(View):
         return render(request, self.template_name, locals())
 
 
+class ReportArtifactView(View):
+    """
+    Serves a file of the Crispresso report of a sample from the local store,
+    by its name in the manifest of the results. See webscraperequest.artifacts.
+
+    Reports come from mirrors, so their files are untrusted. Files are served
+    sandboxed, which keeps scripts in HTML or SVG from running as this site,
+    and content types are not sniffed. Files that are not images or text, such
+    as zips and PDFs, are downloaded.
+    """
+
+    def get(self, request, *args, **kwargs):
+        analysis = Analysis.objects.get(
+            owner=self.request.user, id=self.kwargs['id'])
+        name = self.kwargs['name']
+        store = artifacts.get_store()
+        try:
+            digest = analysis.results_data[self.kwargs['index']]['artifacts'][name]
+        except (IndexError, KeyError, TypeError):
+            raise Http404('Report artifact does not exist')
+        try:
+            if store is None or not store.has(digest):
+                raise Http404('Report artifact is not stored')
+        except ValueError:
+            raise Http404('Report artifact does not exist')
+
+        content_type, _ = mimetypes.guess_type(name)
+        content_type = content_type or 'application/octet-stream'
+        response = FileResponse(
+            open(store.path(digest), 'rb'),
+            content_type=content_type,
+            as_attachment=not content_type.startswith(('image/', 'text/')),
+            filename=name.split('/')[-1])
+        response['Content-Security-Policy'] = 'sandbox'
+        response['X-Content-Type-Options'] = 'nosniff'
+        # Content never changes for a digest
+        response['ETag'] = '"{}"'.format(digest)
+        response['Cache-Control'] = 'private, max-age=86400'
+        return response
+
+
 # TODO (gdingle): is DetailView needed here?
 class OrderFormView(DetailView):
     """
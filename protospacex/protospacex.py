@@ -7,13 +7,11 @@ Protospacex: automated guide design for Cas9 knock-in experiments.
 The code here returns different regions of interest for HDR from a ENST transcript.
 """
 import logging
-import time
 
 from functools import lru_cache
 # lru_cache appears to reduce page time by 10s for 96 well plate!
 
 import requests
-import requests_cache  # type: ignore
 
 from Bio.Alphabet.IUPAC import IUPACUnambiguousDNA  # type: ignore
 from Bio.Seq import Seq  # type: ignore
@@ -21,33 +19,29 @@ from Bio.SeqFeature import FeatureLocation  # type: ignore
 from Bio.SeqFeature import SeqFeature  # type: ignore
 from Bio.SeqRecord import SeqRecord  # type: ignore
 
+from utils.ratelimit import RateLimitedAdapter
+from utils import httpcache
+
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.WARN)
 
 
-_cached_session = requests_cache.CachedSession(
-    cache_name=__name__ + '_cache',
-    # TODO (gdingle): what's the best timeout?
-    expire_after=3600 * 24 * 14,
-    allowable_methods=('GET', 'POST'),
-)
+# One cache for all clients, with TTLs per endpoint. See utils.httpcache.
+# Identical requests in flight are sent once. See utils.singleflight.
+_cached_session = httpcache.cached_session()
 
 # TODO (gdingle): refactor with conversions.py
 # Avoid too many connections error. See:
 # https://stackoverflow.com/questions/23632794/
-adapter = requests.adapters.HTTPAdapter(pool_connections=96 * 4, pool_maxsize=96 * 4)
+# Requests to Ensembl are rate limited across all clients. See utils.ratelimit.
+adapter = RateLimitedAdapter(pool_connections=96 * 4, pool_maxsize=96 * 4)
 _cached_session.mount('http://', adapter)
 _cached_session.mount('https://', adapter)
 
-# TODO (gdingle): use ratelimit intead of small number of threads
-# See https://github.com/tomasbasham/ratelimit
-# TODO (gdingle): why doesn't it work easy?
-
 
 @lru_cache(maxsize=1024)
 def fetch_ensembl_transcript(
-        ensembl_transcript_id: str,
-        is_retry: bool = False) -> SeqRecord:
+        ensembl_transcript_id: str) -> SeqRecord:
     """Fetch the requested Ensembl transcript.
 
     Get the requested Ensembl transcript, together with exon and
@@ -150,13 +144,6 @@ def fetch_ensembl_transcript(
     except requests.exceptions.HTTPError:
         log.error("Ensembl sequence REST query returned error "
                   "{}".format(response.text))
-        # You have exceeded the limit of 15 requests per second; please reduce your concurrent connections
-        if not is_retry and \
-                response.text.strip().startswith('You have exceeded the limit of'):
-            log.warn('Waiting 4 seconds then retrying fetch_ensembl_transcript')
-            time.sleep(4)
-            return fetch_ensembl_transcript(ensembl_transcript_id, is_retry=True)
-
         raise ValueError(response.text)
 
     response_data = response.json()
@@ -8,21 +8,21 @@ import re
 
 import pymysql
 import requests
-import requests_cache  # type: ignore
+
+from utils.ratelimit import RateLimitedAdapter
+from utils import httpcache
 
 # See also CHR_REGEX in validators.py
 CHR_REGEX = r'chr([0-9XY]+):([0-9,]+)-([0-9,]+[0-9])'
 
-_cached_session = requests_cache.CachedSession(
-    cache_name=__name__ + '_cache',
-    # TODO (gdingle): what's the best timeout?
-    expire_after=3600 * 24 * 14,
-    allowable_methods=('GET', 'POST'),
-)
+# One cache for all clients, with TTLs per endpoint. See httpcache.
+# Identical requests in flight are sent once. See singleflight.
+_cached_session = httpcache.cached_session()
 
 # Avoid too many connections error. See:
 # https://stackoverflow.com/questions/23632794/
-adapter = requests.adapters.HTTPAdapter(pool_connections=96 * 4, pool_maxsize=96 * 4)
+# Requests to each host are rate limited across all clients. See ratelimit.
+adapter = RateLimitedAdapter(pool_connections=96 * 4, pool_maxsize=96 * 4)
 _cached_session.mount('http://', adapter)
 _cached_session.mount('https://', adapter)
 
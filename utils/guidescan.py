@@ -0,0 +1,215 @@
+"""
+Local scan of target sequences for guides, and their on-target efficiency.
+
+Guides are found on both strands by their PAM, with the pam ids of Crispor,
+such as "s76+", so they can be joined with Crispor results. The number is
+the offset of the PAM in the target sequence. On the minus strand, it is the
+offset of the reverse complement of the PAM. See samplesheet._set_guide_cols.
+
+Efficiency is the Rule Set 1 score of Doench et al. 2014, as in Crispor,
+computed for all guides at once with numpy. Off-target specificity still
+requires Crispor, because it needs a genome-wide search.
+
+>>> guides = scan_guides('CCATGGCTGAGCTGGATCCGTTCGGC')
+>>> [(g.pam_id, g.guide_seq) for g in guides]
+[('s0-', 'GAACGGATCCAGCTCAGCCA TGG'), ('s22+', 'ATGGCTGAGCTGGATCCGTT CGG')]
+"""
+import functools
+import math
+import re
+
+from collections import namedtuple
+from typing import List, Sequence, Tuple
+
+import numpy
+
+Guide = namedtuple('Guide', [
+    'pam_id',
+    # guide and PAM, separated by a space, on the strand of the guide
+    'guide_seq',
+    # 4 bp before the guide, guide, PAM and 3 bp after, or '' if out of target
+    'context',
+])
+
+IUPAC = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T',
+    'R': '[AG]', 'Y': '[CT]', 'S': '[GC]', 'W': '[AT]', 'K': '[GT]', 'M': '[AC]',
+    'B': '[CGT]', 'D': '[AGT]', 'H': '[ACT]', 'V': '[ACG]', 'N': '[ACGT]',
+}
+
+COMPLEMENT = str.maketrans('ACGTRYSWKMBDHVN', 'TGCAYRSWMKVHDBN')
+
+# Copied from doenchScore.py of Crispor, from the supplement of
+# Doench et al. 2014. Positions are 0-based in the 30 bp context.
+DOENCH_2014_PARAMS = [
+    (1, 'G', -0.2753771), (2, 'A', -0.3238875), (2, 'C', 0.17212887), (3, 'C', -0.1006662),
+    (4, 'C', -0.2018029), (4, 'G', 0.24595663), (5, 'A', 0.03644004), (5, 'C', 0.09837684),
+    (6, 'C', -0.7411813), (6, 'G', -0.3932644), (11, 'A', -0.466099), (14, 'A', 0.08537695),
+    (14, 'C', -0.013814), (15, 'A', 0.27262051), (15, 'C', -0.1190226), (15, 'T', -0.2859442),
+    (16, 'A', 0.09745459), (16, 'G', -0.1755462), (17, 'C', -0.3457955), (17, 'G', -0.6780964),
+    (18, 'A', 0.22508903), (18, 'C', -0.5077941), (19, 'G', -0.4173736), (19, 'T', -0.054307),
+    (20, 'G', 0.37989937), (20, 'T', -0.0907126), (21, 'C', 0.05782332), (21, 'T', -0.5305673),
+    (22, 'T', -0.8770074), (23, 'C', -0.8762358), (23, 'G', 0.27891626), (23, 'T', -0.4031022),
+    (24, 'A', -0.0773007), (24, 'C', 0.28793562), (24, 'T', -0.2216372), (27, 'G', -0.6890167),
+    (27, 'T', 0.11787758), (28, 'C', -0.1604453), (29, 'G', 0.38634258), (1, 'GT', -0.6257787),
+    (4, 'GC', 0.30004332), (5, 'AA', -0.8348362), (5, 'TA', 0.76062777), (6, 'GG', -0.4908167),
+    (11, 'GG', -1.5169074), (11, 'TA', 0.7092612), (11, 'TC', 0.49629861), (11, 'TT', -0.5868739),
+    (12, 'GG', -0.3345637), (13, 'GA', 0.76384993), (13, 'GC', -0.5370252), (16, 'TG', -0.7981461),
+    (18, 'GG', -0.6668087), (18, 'TC', 0.35318325), (19, 'CC', 0.74807209), (19, 'TG', -0.3672668),
+    (20, 'AC', 0.56820913), (20, 'CG', 0.32907207), (20, 'GA', -0.8364568), (20, 'GG', -0.7822076),
+    (21, 'TC', -1.029693), (22, 'CG', 0.85619782), (22, 'CT', -0.4632077), (23, 'AA', -0.5794924),
+    (23, 'AG', 0.64907554), (24, 'AG', -0.0773007), (24, 'CG', 0.28793562), (24, 'TG', -0.2216372),
+    (26, 'GT', 0.11787758), (28, 'GG', -0.69774),
+]
+DOENCH_2014_INTERCEPT = 0.59763615
+DOENCH_2014_GC_HIGH = -0.1665878
+DOENCH_2014_GC_LOW = -0.2026259
+
+CONTEXT_LEN = 30
+
+BASES = 'ACGT'
+# Weights of each base and each pair of bases at each position of the context
+_SINGLE_WEIGHTS = numpy.zeros((CONTEXT_LEN, len(BASES)))
+_DOUBLE_WEIGHTS = numpy.zeros((CONTEXT_LEN - 1, len(BASES) ** 2))
+for _pos, _bases, _weight in DOENCH_2014_PARAMS:
+    if len(_bases) == 1:
+        _SINGLE_WEIGHTS[_pos, BASES.index(_bases)] += _weight
+    else:
+        _DOUBLE_WEIGHTS[_pos, BASES.index(_bases[0]) * 4 + BASES.index(_bases[1])] += _weight
+
+_CODES = numpy.full(256, -1, dtype=numpy.int8)
+for _i, _base in enumerate(BASES):
+    _CODES[ord(_base)] = _i
+
+
+def reverse_complement(seq: str) -> str:
+    """
+    >>> reverse_complement('ACGN')
+    'NCGT'
+    """
+    return seq.upper().translate(COMPLEMENT)[::-1]
+
+
+def scan_guides(seq: str, pam: str = 'NGG', guide_len: int = 20) -> List[Guide]:
+    """
+    All guides of seq on both strands, in order of offset. Guides with bases
+    other than ACGT are skipped, like in Crispor.
+
+    >>> scan_guides('AAAACGTACGTACGTACGTACGTACGGGAAA')[0]
+    Guide(pam_id='s24+', guide_seq='CGTACGTACGTACGTACGTA CGG', context='AAAACGTACGTACGTACGTACGTACGGGAA')
+    """
+    seq = seq.upper()
+    fwd = re.compile('(?=({}))'.format(''.join(IUPAC[c] for c in pam.upper())))
+    rev = re.compile('(?=({}))'.format(''.join(IUPAC[c] for c in reverse_complement(pam))))
+    guides = []
+
+    for match in fwd.finditer(seq):
+        offset = match.start()
+        if offset < guide_len:
+            continue
+        guide = seq[offset - guide_len:offset]
+        start = offset - guide_len - 4
+        end = offset + len(pam) + 3
+        context = seq[start:end] if start >= 0 and end <= len(seq) else ''
+        guides.append((offset, '+', guide, seq[offset:offset + len(pam)], context))
+
+    for match in rev.finditer(seq):
+        offset = match.start()
+        if offset + len(pam) + guide_len > len(seq):
+            continue
+        guide = reverse_complement(seq[offset + len(pam):offset + len(pam) + guide_len])
+        start = offset - 3
+        end = offset + len(pam) + guide_len + 4
+        context = reverse_complement(seq[start:end]) if start >= 0 and end <= len(seq) else ''
+        guides.append((offset, '-', guide, reverse_complement(seq[offset:offset + len(pam)]), context))
+
+    return [Guide('s{}{}'.format(offset, strand), guide + ' ' + pam_seq, context)
+            for offset, strand, guide, pam_seq, context in sorted(guides)
+            if set(guide) <= set(BASES)]
+
+
+def doench_2014_score(context: str) -> float:
+    """
+    Score of one 30 bp context, as in Crispor. For reference, see
+    doench_2014_scores.
+
+    >>> round(doench_2014_score('TATAGCTGCGATCTGAGGTAGGGAGGGACC'), 4)
+    0.7131
+    """
+    assert len(context) == CONTEXT_LEN, context
+    score = DOENCH_2014_INTERCEPT
+    gc_count = context[4:24].count('G') + context[4:24].count('C')
+    gc_weight = DOENCH_2014_GC_LOW if gc_count <= 10 else DOENCH_2014_GC_HIGH
+    score += abs(10 - gc_count) * gc_weight
+    for pos, bases, weight in DOENCH_2014_PARAMS:
+        if context[pos:pos + len(bases)] == bases:
+            score += weight
+    return 1.0 / (1.0 + math.exp(-score))
+
+
+def doench_2014_scores(contexts: Sequence[str]) -> numpy.ndarray:
+    """
+    Scores of many 30 bp contexts at once. Contexts that are empty or have
+    bases other than ACGT score NaN.
+
+    >>> contexts = ['TATAGCTGCGATCTGAGGTAGGGAGGGACC', 'AAAACGTACGTACGTACGTACGTACGGGAA', '']
+    >>> scores = doench_2014_scores(contexts)
+    >>> bool(numpy.allclose(scores[:2], [doench_2014_score(c) for c in contexts[:2]]))
+    True
+    >>> bool(numpy.isnan(scores[2]))
+    True
+    """
+    if not len(contexts):
+        return numpy.zeros(0)
+    padded = [c.upper() if len(c) == CONTEXT_LEN else 'N' * CONTEXT_LEN for c in contexts]
+    codes = _CODES[numpy.frombuffer(''.join(padded).encode('ascii'), dtype=numpy.uint8)]
+    codes = codes.reshape(len(contexts), CONTEXT_LEN).astype(numpy.intp)
+    valid = (codes >= 0).all(axis=1)
+    codes[codes < 0] = 0
+
+    positions = numpy.arange(CONTEXT_LEN)
+    score = DOENCH_2014_INTERCEPT + _SINGLE_WEIGHTS[positions, codes].sum(axis=1)
+    score += _DOUBLE_WEIGHTS[positions[:-1], codes[:, :-1] * 4 + codes[:, 1:]].sum(axis=1)
+    guide = codes[:, 4:24]
+    gc_count = ((guide == BASES.index('C')) | (guide == BASES.index('G'))).sum(axis=1)
+    score += numpy.abs(10 - gc_count) * numpy.where(
+        gc_count <= 10, DOENCH_2014_GC_LOW, DOENCH_2014_GC_HIGH)
+
+    scores = 1.0 / (1.0 + numpy.exp(-score))
+    scores[~valid] = numpy.nan
+    return scores
+
+
+def rank_guides(seq: str, pam: str = 'NGG') -> List[tuple]:
+    """
+    Guides of seq with their efficiency from 0 to 100 as by Crispor, best
+    first. Guides too close to the ends of seq to score are last, with None.
+
+    >>> [(g.pam_id, score) for g, score in rank_guides('TATAGCTGCGATCTGAGGTAGGGAGGGACC')]
+    [('s24+', 71), ('s20+', None), ('s23+', None)]
+    """
+    guides = scan_guides(seq, pam)
+    scores = doench_2014_scores([g.context for g in guides])
+    ranked = [(g, None if numpy.isnan(s) else int(round(s * 100)))
+              for g, s in zip(guides, scores)]
+    return sorted(ranked, key=lambda r: -1 if r[1] is None else r[1], reverse=True)
+
+
+@functools.lru_cache(maxsize=1024)
+def top_guides(seq: str, pam: str = 'NGG', top: int = 3) -> Tuple[tuple, ...]:
+    """
+    The first of rank_guides, cached by args, for pages that are rendered
+    again and again, such as progress pages, which poll.
+
+    >>> top_guides('TATAGCTGCGATCTGAGGTAGGGAGGGACC', top=1)[0][1]
+    71
+    >>> top_guides('TATAGCTGCGATCTGAGGTAGGGAGGGACC', top=1) is top_guides(
+    ...     'TATAGCTGCGATCTGAGGTAGGGAGGGACC', top=1)
+    True
+    """
+    return tuple(rank_guides(seq, pam)[:top])
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,737 @@
+"""
+One response cache shared by all web clients in the process.
+
+This replaces the separate blanket-expiry SQLite files of each client with:
+
+* a pluggable store: SQLite in WAL mode by default, or a sharded directory of
+  files, which has no single-writer lock
+* a maximum size on disk, enforced by evicting least recently used responses
+* a TTL per endpoint, enforced by the cache itself. See TTL_RULES.
+* counters of hits, misses and bytes. See ResponseCache.stats.
+* compression of stored responses, which are mostly large HTML pages
+* parsed results of responses, stored next to them or instead of them, so that
+  hits skip both unpickling the page and parsing it. See get_parsed.
+
+Configure with environment variables:
+
+HTTP_CACHE_BACKEND: 'sqlite' (default) or 'sharded'
+HTTP_CACHE_PATH: path without extension, default 'http_cache' in the working dir
+HTTP_CACHE_MAX_BYTES: default 4 GB
+HTTP_CACHE_COMPRESSION: 'zlib' (default), 'zstd', which requires zstandard, or
+    'none'. Entries of any compression are read.
+HTTP_CACHE_PARSED: 'alongside' (default), 'instead', which drops a response
+    once it is parsed, if its client allows it, or 'off'. See save_parsed.
+
+Responses of the clients' legacy requests_cache files are copied in by the
+management command importhttpcache, once, after upgrading.
+
+>>> ttl_for('http://togows.org/api/ucsc/hg38/chr1:1-10.fasta') is None
+True
+>>> ttl_for(CRISPRESSO_STATUS_EXAMPLE)
+0
+>>> ttl_for('http://example.com/') == DEFAULT_TTL
+True
+
+>>> import tempfile
+>>> cache = ResponseCache(SQLiteStore(tempfile.mktemp()), max_bytes=10 ** 6)
+>>> response = requests.Response()
+>>> response.status_code, response._content = 200, b'ACGT'
+>>> response.url = 'http://togows.org/api/ucsc/hg38/chr1:1-4.fasta'
+>>> response.request = requests.Request('GET', response.url).prepare()
+>>> cache.save_response('k', response)
+>>> cache.get_response_and_time('k')[0].text
+'ACGT'
+>>> cache.get_response_and_time('missing')
+(None, None)
+>>> stats = cache.stats()
+>>> stats['hits'], stats['misses'], stats['bytes_written'] > 0
+(1, 1, True)
+>>> [r.text for r in cache.iter_responses()]
+['ACGT']
+
+Parsed results are kept by kind of parser, for as long as their response.
+
+>>> cache.get_parsed('k', 'fasta') is None
+True
+>>> cache.save_parsed('k', 'fasta', {'seq': 'ACGT'})
+>>> cache.get_parsed('k', 'fasta')
+{'seq': 'ACGT'}
+>>> cache.delete('k')
+>>> cache.has_key('k'), cache.get_parsed('k', 'fasta')
+(False, None)
+
+Routes outlive the responses.
+
+>>> for store in (SQLiteStore(tempfile.mktemp()), ShardedStore(tempfile.mktemp())):
+...     store.put_route('mirror:crispor:batch', 'http://mirror')
+...     store.put('k', b'x', 0)
+...     store.expire(time.time()), store.evict(0)
+...     store.clear()
+...     store.get_route('mirror:crispor:batch'), store.size()
+(1, 0)
+('http://mirror', 0)
+(1, 0)
+('http://mirror', 0)
+"""
+import hashlib
+import logging
+import os
+import pickle
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+from datetime import datetime
+from typing import Any, Iterator, List, Optional, Tuple
+
+import requests
+
+from requests_cache.backends.base import BaseCache  # type: ignore
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+try:
+    from utils.singleflight import SingleFlightCachedSession
+except ImportError:
+    # For doctest, which is not run from the project root
+    from singleflight import SingleFlightCachedSession  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+DAY = 3600 * 24
+DEFAULT_TTL = 14 * DAY
+
+CRISPRESSO_STATUS_EXAMPLE = 'http://ec2-34-219-237-20.us-west-2.compute.amazonaws.com:81/status/P2S84K'
+
+# TTL in seconds by regex of request URL. First match wins.
+# None means never expire. 0 means never cache.
+TTL_RULES = [
+    # Crispresso status and progress pages change until the report is done
+    (r'/status/\w+$', 0),
+    (r'/check_progress/', 0),
+    # Genome sequences and locations do not change
+    (r'togows\.org/api/ucsc/', None),
+    (r'rest\.ensembl\.org/sequence/', None),
+    (r'gggenome\.dbcls\.jp/', None),
+]  # type: List[Tuple[str, Optional[int]]]
+
+
+# First byte of stored values, by compression. Values of older versions, and of
+# compression 'none', are plain pickles, which start with PICKLE_MARK.
+ZLIB_MARK = b'z'
+ZSTD_MARK = b's'
+PICKLE_MARK = b'\x80'
+# A response that was dropped after it was parsed. See HTTP_CACHE_PARSED.
+PARSED_ONLY = b'p'
+
+# Prefix of keys of parsed results in the store
+PARSED_PREFIX = 'parsed:'
+
+# Access times of SQLiteStore are written in batches of this many reads, or
+# this many seconds, whichever comes first. Eviction is by approximate LRU.
+TOUCH_BATCH = 256
+TOUCH_SECONDS = 60
+
+
+def encode(obj: Any, compression: str = 'zlib') -> bytes:
+    """
+    >>> len(encode('ACGT' * 1000)) < 100
+    True
+    >>> [decode(encode('ACGT', c)) for c in ('zlib', 'none')]
+    ['ACGT', 'ACGT']
+    """
+    return compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), compression)
+
+
+def compress(value: bytes, compression: str) -> bytes:
+    if compression == 'zlib':
+        return ZLIB_MARK + zlib.compress(value, 6)
+    if compression == 'zstd':
+        return ZSTD_MARK + zstandard.ZstdCompressor(level=6).compress(value)
+    return value
+
+
+def decode(value: bytes) -> Any:
+    """None for PARSED_ONLY"""
+    mark = value[:1]
+    if mark == ZLIB_MARK:
+        value = zlib.decompress(value[1:])
+    elif mark == ZSTD_MARK:
+        if zstandard is None:
+            raise ValueError('Entry is compressed with zstd, which is not installed')
+        value = zstandard.ZstdDecompressor().decompress(value[1:])
+    elif mark == PARSED_ONLY:
+        return None
+    return pickle.loads(value)
+
+
+def ttl_for(url: str) -> Optional[int]:
+    for pattern, ttl in TTL_RULES:
+        if re.search(pattern, url):
+            return ttl
+    return DEFAULT_TTL
+
+
+class SQLiteStore:
+    """
+    Responses in one SQLite file in WAL mode, so that readers do not block the
+    writer. There is one connection per thread.
+
+    Reads do not write. Access times are kept in memory and written in a batch
+    now and then, and before eviction. See TOUCH_BATCH.
+
+    Routes, such as which mirror has which batch, are kept in their own table,
+    which expiry, eviction and clear do not touch.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.filename = path + '.sqlite'
+        self._local = threading.local()
+        self._touch_lock = threading.Lock()
+        self._touched = {}  # type: dict
+        self._touched_since = time.time()
+        con = self._connection()
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('CREATE TABLE IF NOT EXISTS responses '
+                    '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, expires REAL, accessed REAL)')
+        con.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        con.execute('CREATE TABLE IF NOT EXISTS aliases (key TEXT PRIMARY KEY, target TEXT)')
+        con.execute('CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, target TEXT)')
+
+    def _connection(self) -> sqlite3.Connection:
+        if not hasattr(self._local, 'con'):
+            con = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            con.execute('PRAGMA synchronous=NORMAL')
+            self._local.con = con
+        return self._local.con
+
+    def get(self, key: str) -> Optional[Tuple[bytes, Optional[float]]]:
+        con = self._connection()
+        row = con.execute('SELECT value, expires FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self._touch(key)
+        return bytes(row[0]), row[1]
+
+    def _touch(self, key: str) -> None:
+        now = time.time()
+        with self._touch_lock:
+            self._touched[key] = now
+            if len(self._touched) < TOUCH_BATCH and now - self._touched_since < TOUCH_SECONDS:
+                return
+        self.flush_access()
+
+    def flush_access(self) -> None:
+        """Write access times of reads since the last flush"""
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+            self._touched_since = time.time()
+        if not touched:
+            return
+        con = self._connection()
+        con.execute('BEGIN')
+        try:
+            con.executemany('UPDATE responses SET accessed = ? WHERE key = ?',
+                            [(accessed, key) for key, accessed in touched.items()])
+            con.execute('COMMIT')
+        except sqlite3.Error as e:
+            con.execute('ROLLBACK')
+            logger.warning('Failed to write cache access times: {}'.format(e))
+
+    def put(self, key: str, value: bytes, expires: Optional[float]) -> None:
+        self._connection().execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+            (key, value, len(value), expires, time.time()))
+
+    def delete(self, key: str) -> None:
+        con = self._connection()
+        con.execute('DELETE FROM responses WHERE key = ?', (key,))
+        con.execute('DELETE FROM aliases WHERE key = ? OR target = ?', (key, key))
+
+    def get_alias(self, key: str) -> Optional[str]:
+        row = self._connection().execute(
+            'SELECT target FROM aliases WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def put_alias(self, key: str, target: str) -> None:
+        self._connection().execute('INSERT OR REPLACE INTO aliases VALUES (?, ?)', (key, target))
+
+    def get_route(self, key: str) -> Optional[str]:
+        row = self._connection().execute(
+            'SELECT target FROM routes WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def put_route(self, key: str, target: str) -> None:
+        self._connection().execute('INSERT OR REPLACE INTO routes VALUES (?, ?)', (key, target))
+
+    def clear(self) -> None:
+        con = self._connection()
+        con.execute('DELETE FROM responses')
+        con.execute('DELETE FROM aliases')
+
+    def values(self) -> Iterator[bytes]:
+        for row in self._connection().execute('SELECT value FROM responses'):
+            yield bytes(row[0])
+
+    def expire(self, now: float) -> int:
+        """Delete responses that expired before now"""
+        con = self._connection()
+        count = con.execute('DELETE FROM responses WHERE expires < ?', (now,)).rowcount
+        con.execute('DELETE FROM aliases WHERE target NOT IN (SELECT key FROM responses)')
+        return count
+
+    def size(self) -> int:
+        return self._connection().execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def evict(self, max_bytes: int) -> int:
+        """Delete least recently used responses until under max_bytes."""
+        self.flush_access()
+        con = self._connection()
+        excess = self.size() - max_bytes
+        evicted = 0
+        rows = con.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall()
+        for key, size in rows:
+            if excess <= 0:
+                break
+            self.delete(key)
+            excess -= size
+            evicted += 1
+        return evicted
+
+
+class ShardedStore:
+    """
+    Responses in a directory of files, sharded by key prefix. Files are written
+    atomically, so many threads and processes can write at once. The mtime of
+    a file is its last access, for eviction.
+
+    The size of the store is walked once, and then kept as a running total of
+    the writes and deletes of this process. Eviction walks again, so writes of
+    other processes are counted then.
+
+    Routes, such as which mirror has which batch, are kept in a directory of
+    their own, which expiry, eviction and clear do not walk, and which is not
+    counted in the size.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.root = path + '.d'
+        self.routes = path + '.routes'
+        os.makedirs(self.root, exist_ok=True)
+        self._size_lock = threading.Lock()
+        self._size = sum(size for _, size, _ in self._files())
+
+    def _path(self, key: str, kind: str = 'r') -> str:
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.root, name[:2], kind + name)
+
+    def _read(self, path: str) -> Any:
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _write(self, path: str, obj: Any, counted: bool = True) -> int:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        old_size = self._file_size(path)
+        os.replace(tmp, path)
+        if counted:
+            self._add_size(size - old_size)
+        return size
+
+    def _remove(self, path: str) -> bool:
+        size = self._file_size(path)
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        self._add_size(-size)
+        return True
+
+    def _file_size(self, path: str) -> int:
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return 0
+
+    def _add_size(self, delta: int) -> None:
+        with self._size_lock:
+            self._size = max(0, self._size + delta)
+
+    def get(self, key: str) -> Optional[Tuple[bytes, Optional[float]]]:
+        path = self._path(key)
+        entry = self._read(path)
+        if entry is None:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key: str, value: bytes, expires: Optional[float]) -> None:
+        self._write(self._path(key), (value, expires))
+
+    def delete(self, key: str) -> None:
+        for kind in ('r', 'a'):
+            self._remove(self._path(key, kind))
+
+    def get_alias(self, key: str) -> Optional[str]:
+        return self._read(self._path(key, 'a'))
+
+    def put_alias(self, key: str, target: str) -> None:
+        self._write(self._path(key, 'a'), target)
+
+    def _route_path(self, key: str) -> str:
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.routes, name[:2], name)
+
+    def get_route(self, key: str) -> Optional[str]:
+        return self._read(self._route_path(key))
+
+    def put_route(self, key: str, target: str) -> None:
+        self._write(self._route_path(key), target, counted=False)
+
+    def clear(self) -> None:
+        for path, _, _ in self._files():
+            self._remove(path)
+
+    def _files(self) -> List[Tuple[str, int, float]]:
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def values(self) -> Iterator[bytes]:
+        for path, _, _ in self._files():
+            if os.path.basename(path).startswith('r'):
+                entry = self._read(path)
+                if entry is not None:
+                    yield entry[0]
+
+    def expire(self, now: float) -> int:
+        """Delete responses that expired before now"""
+        count = 0
+        for path, _, _ in self._files():
+            if not os.path.basename(path).startswith('r'):
+                continue
+            entry = self._read(path)
+            if entry is not None and entry[1] is not None and entry[1] < now:
+                count += self._remove(path)
+        return count
+
+    def size(self) -> int:
+        return self._size
+
+    def evict(self, max_bytes: int) -> int:
+        files = sorted(self._files(), key=lambda f: f[2])
+        with self._size_lock:
+            self._size = sum(size for _, size, _ in files)
+        excess = self._size - max_bytes
+        evicted = 0
+        for path, size, _ in files:
+            if excess <= 0:
+                break
+            if not self._remove(path):
+                continue
+            excess -= size
+            evicted += 1
+        return evicted
+
+
+class ResponseCache(BaseCache):
+    """
+    A requests_cache backend over a store. Expiry is per response, by TTL_RULES,
+    so sessions should have expire_after=None.
+
+    Requests with a content_key attribute are cached under it. See
+    CrispressoRequest.cache_key.
+
+    Besides responses, there are parsed results of responses, by key and kind
+    of parser. See get_parsed and save_parsed.
+    """
+
+    def __init__(self,
+                 store: Any,
+                 max_bytes: int,
+                 compression: str = 'zlib',
+                 parsed: str = 'alongside') -> None:
+        super().__init__()
+        if compression not in ('zlib', 'zstd', 'none'):
+            raise ValueError('Unknown compression: "{}"'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise RuntimeError('zstd compression requires zstandard')
+        if parsed not in ('alongside', 'instead', 'off'):
+            raise ValueError('Unknown parsed mode: "{}"'.format(parsed))
+        self.store = store
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.parsed = parsed
+        self._lock = threading.Lock()
+        self._stats = dict(hits=0, misses=0, bytes_read=0, bytes_written=0,
+                           # Before compression
+                           bytes_uncompressed=0,
+                           parsed_hits=0, parsed_misses=0, evictions=0)
+        self._approx_size = store.size()
+
+    def create_key(self, request: requests.PreparedRequest) -> str:
+        return getattr(request, 'content_key', None) or super().create_key(request)
+
+    def _picklable_field(self, response: requests.Response, name: str) -> Any:
+        value = super()._picklable_field(response, name)
+        # Streamed bodies, such as uploads of FASTQs, are neither picklable nor
+        # worth keeping. See utils.multipart.
+        if name == 'request' and not isinstance(value.body, (bytes, str, type(None))):
+            value.body = None
+        return value
+
+    def save_response(self, key: str, response: requests.Response) -> None:
+        first = response.history[0] if response.history else response
+        url = first.request.url if first.request is not None else response.url
+        ttl = ttl_for(url)
+        if ttl == 0:
+            return
+        obj = (self.reduce_response(response), datetime.utcnow())
+        self._put(key, obj, None if ttl is None else time.time() + ttl)
+
+    def _put(self, key: str, obj: Any, expires: Optional[float]) -> None:
+        raw = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        value = compress(raw, self.compression)
+        self.store.put(key, value, expires)
+        with self._lock:
+            self._stats['bytes_written'] += len(value)
+            self._stats['bytes_uncompressed'] += len(raw)
+            self._approx_size += len(value)
+            over = self._approx_size > self.max_bytes
+        if over:
+            self._evict()
+
+    def add_key_mapping(self, new_key: str, key_to_response: str) -> None:
+        self.store.put_alias(new_key, key_to_response)
+
+    def _lookup(self, key: str) -> Optional[Tuple[bytes, Optional[float]]]:
+        entry = self.store.get(key)
+        if entry is None:
+            target = self.store.get_alias(key)
+            if target:
+                key, entry = target, self.store.get(target)
+        if entry is not None and entry[1] is not None and entry[1] < time.time():
+            self.store.delete(key)
+            return None
+        return entry
+
+    def get_response_and_time(self, key: str, default: tuple = (None, None)) -> tuple:
+        entry = self._lookup(key)
+        with self._lock:
+            # A response dropped after parsing is sent again by whoever wants it
+            if entry is None or entry[0][:1] == PARSED_ONLY:
+                self._stats['misses'] += 1
+                return default
+            self._stats['hits'] += 1
+            self._stats['bytes_read'] += len(entry[0])
+        try:
+            response, timestamp = decode(entry[0])
+        except Exception as e:
+            logger.warning('Bad cache entry {}: {}'.format(key, e))
+            self.store.delete(key)
+            return default
+        return self.restore_response(response), timestamp
+
+    def get_parsed(self, key: str, kind: str) -> Any:
+        """
+        The result of parsing the response of key by a parser of the given kind,
+        or None. A kind should change when its parser changes.
+        """
+        entry = None if self.parsed == 'off' else self._lookup(PARSED_PREFIX + key)
+        parsed = None
+        if entry is not None:
+            try:
+                parsed = decode(entry[0]).get(kind)
+            except Exception as e:
+                logger.warning('Bad parsed cache entry {}: {}'.format(key, e))
+                self.store.delete(PARSED_PREFIX + key)
+        with self._lock:
+            self._stats['parsed_hits' if parsed is not None else 'parsed_misses'] += 1
+        return parsed
+
+    def save_parsed(self, key: str, kind: str, parsed: Any, droppable: bool = False) -> None:
+        """
+        Store the result of parsing the response of key, which must be cached,
+        until the response expires.
+
+        With parsed mode 'instead', a droppable response itself is dropped,
+        but has_key stays true. Once dropped, a parse of another kind is a
+        miss, so the request is sent again. So only responses of requests that
+        are safe to send again, and that are parsed by one kind only, may be
+        droppable. Responses of requests that start jobs, such as POSTs to
+        Crispor, or that are parsed by kinds that vary by request, are kept.
+
+        >>> import tempfile
+        >>> cache = ResponseCache(SQLiteStore(tempfile.mktemp()), 10 ** 6, parsed='instead')
+        >>> cache.store.put('k', encode('response'), None)
+        >>> cache.save_parsed('k', 'a', 1)
+        >>> decode(cache.store.get('k')[0])
+        'response'
+        >>> cache.save_parsed('k', 'b', 2, droppable=True)
+        >>> decode(cache.store.get('k')[0]), cache.get_parsed('k', 'a'), cache.has_key('k')
+        (None, 1, True)
+        """
+        if self.parsed == 'off' or parsed is None:
+            return
+        entry = self._lookup(key)
+        if entry is None:
+            return
+        current = self._lookup(PARSED_PREFIX + key)
+        try:
+            kinds = decode(current[0]) if current is not None else {}
+        except Exception:
+            kinds = {}
+        kinds[kind] = parsed
+        self._put(PARSED_PREFIX + key, kinds, entry[1])
+        if self.parsed == 'instead' and droppable and entry[0][:1] != PARSED_ONLY:
+            self.store.put(key, PARSED_ONLY, entry[1])
+            with self._lock:
+                self._approx_size -= len(entry[0])
+
+    def delete(self, key: str) -> None:
+        self.store.delete(key)
+        self.store.delete(PARSED_PREFIX + key)
+
+    def clear(self) -> None:
+        self.store.clear()
+        with self._lock:
+            self._approx_size = 0
+
+    def has_key(self, key: str) -> bool:
+        return self._lookup(key) is not None
+
+    def iter_responses(self) -> Iterator[requests.Response]:
+        """All cached responses, in no order. For offline tools, such as benchmarks."""
+        for value in self.store.values():
+            try:
+                entry = decode(value)
+            except Exception:
+                continue
+            # Not parsed results, nor responses dropped after parsing
+            if isinstance(entry, tuple):
+                yield self.restore_response(entry[0])
+
+    def remove_old_entries(self, created_before: datetime = None) -> int:
+        """
+        Delete responses, and their parsed results, that expired by TTL_RULES.
+        Returns the number deleted. Expired responses are also deleted when
+        they are read, so this only frees space.
+
+        created_before is ignored, because expiry is per response. It is here
+        for the interface of requests_cache.
+
+        >>> import tempfile
+        >>> cache = ResponseCache(ShardedStore(tempfile.mktemp()), max_bytes=10 ** 6)
+        >>> cache.store.put('old', b'x', time.time() - 1)
+        >>> cache.store.put('new', b'x', None)
+        >>> size = cache.store.size()
+        >>> cache.remove_old_entries(), cache.has_key('new'), cache.store.size() < size
+        (1, True, True)
+        """
+        count = self.store.expire(time.time())
+        size = self.store.size()
+        with self._lock:
+            self._approx_size = size
+        logger.info('Removed {} expired entries from cache'.format(count))
+        return count
+
+    def import_requests_cache(self, filename: str) -> int:
+        """
+        Copy responses from a legacy requests_cache SQLite file, such as
+        webscraperequest.scraperequest_cache.sqlite. Returns the number copied.
+        See the management command importhttpcache.
+        """
+        con = sqlite3.connect(filename)
+        count = 0
+        for key, value in con.execute('SELECT key, value FROM responses'):
+            value = bytes(value)
+            try:
+                response, _ = pickle.loads(value)
+            except Exception as e:
+                logger.warning('Skipping bad cache entry {}: {}'.format(key, e))
+                continue
+            ttl = ttl_for(response.url or '')
+            if ttl == 0:
+                continue
+            self.store.put(key, compress(value, self.compression),
+                           None if ttl is None else time.time() + ttl)
+            count += 1
+        for key, target in con.execute('SELECT key, value FROM urls'):
+            self.store.put_alias(key, target)
+        con.close()
+        with self._lock:
+            self._approx_size = self.store.size()
+        return count
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['size'] = self.store.size()
+        if stats['bytes_written']:
+            stats['compression_ratio'] = round(stats['bytes_uncompressed'] / stats['bytes_written'], 1)
+        return stats
+
+    def _evict(self) -> None:
+        # Evict to 90% so as not to evict on every write
+        evicted = self.store.evict(int(self.max_bytes * 0.9))
+        size = self.store.size()
+        with self._lock:
+            self._stats['evictions'] += evicted
+            self._approx_size = size
+        logger.info('Evicted {} responses from cache. Size now {} bytes'.format(evicted, size))
+
+
+def _create_shared_cache() -> ResponseCache:
+    path = os.environ.get('HTTP_CACHE_PATH', 'http_cache')
+    backend = os.environ.get('HTTP_CACHE_BACKEND', 'sqlite')
+    stores = {'sqlite': SQLiteStore, 'sharded': ShardedStore}
+    if backend not in stores:
+        raise ValueError('Unknown HTTP_CACHE_BACKEND: "{}"'.format(backend))
+    max_bytes = int(os.environ.get('HTTP_CACHE_MAX_BYTES', 4 * 1024 ** 3))
+    return ResponseCache(
+        stores[backend](path),
+        max_bytes,
+        compression=os.environ.get('HTTP_CACHE_COMPRESSION', 'zlib'),
+        parsed=os.environ.get('HTTP_CACHE_PARSED', 'alongside'),
+    )
+
+
+shared_cache = _create_shared_cache()
+
+
+def cached_session(cache: ResponseCache = shared_cache) -> SingleFlightCachedSession:
+    """A session over the shared cache. See also singleflight."""
+    return SingleFlightCachedSession(
+        backend=cache,
+        # Expiry is by TTL_RULES
+        expire_after=None,
+        allowable_methods=('GET', 'POST'),
+    )
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
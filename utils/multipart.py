@@ -0,0 +1,103 @@
+"""
+A multipart/form-data body that streams files from disk.
+
+requests builds multipart bodies in memory, so uploading a pair of FASTQs reads
+both of them whole, several at once with several workers. MultipartBody reads
+files in chunks as the body is sent, and knows its length in advance, so that
+requests sends a Content-Length instead of chunked encoding. Pass it as data,
+with its content_type as header.
+
+>>> import tempfile
+>>> with tempfile.NamedTemporaryFile(suffix='.fastq') as f:
+...     _ = f.write(b'ACGT')
+...     f.flush()
+...     body = MultipartBody({'name': 'x'}, {'fastq': f.name}, boundary='b', chunk_size=4)
+...     content = b''.join(body)
+>>> len(body) == len(content)
+True
+>>> print(content.decode().replace('\\r\\n', '|').replace(f.name.split('/')[-1], 'F'))
+--b|Content-Disposition: form-data; name="name"||x|--b|Content-Disposition: form-data; name="fastq"; filename="F"|Content-Type: application/octet-stream||ACGT|--b--|
+"""
+import os
+
+from typing import Dict, Iterator, List, Union
+
+CHUNK_SIZE = 1024 * 1024
+
+# Same as urllib3.filepost.choose_boundary, as patched in scraperequest
+BOUNDARY = 'crispycrunch_super_special_form_boundary'
+
+
+class MultipartBody:
+    """
+    Fields and files, in order of name, like requests does for dicts.
+
+    There are two public methods: read and close. It is also iterable by chunk.
+    """
+
+    def __init__(self,
+                 fields: Dict[str, str],
+                 files: Dict[str, str],
+                 boundary: str = BOUNDARY,
+                 chunk_size: int = CHUNK_SIZE) -> None:
+        self.boundary = boundary
+        self.chunk_size = chunk_size
+        self.content_type = 'multipart/form-data; boundary={}'.format(boundary)
+
+        # Bytes as is, and str as paths of files to stream
+        self._parts = []  # type: List[Union[bytes, str]]
+        for name, value in sorted(fields.items()):
+            self._parts.append(self._header(name) + str(value).encode() + b'\r\n')
+        for name, path in sorted(files.items()):
+            self._parts.append(self._header(name, os.path.basename(path)))
+            self._parts.append(path)
+            self._parts.append(b'\r\n')
+        self._parts.append('--{}--\r\n'.format(boundary).encode())
+
+        self.len = sum(os.path.getsize(part) if isinstance(part, str) else len(part)
+                       for part in self._parts)
+        self._chunks = None  # type: Iterator[bytes]
+        self._buffer = b''
+        self._pos = 0
+
+    def _header(self, name: str, filename: str = None) -> bytes:
+        header = '--{}\r\nContent-Disposition: form-data; name="{}"'.format(self.boundary, name)
+        if filename is not None:
+            header += '; filename="{}"\r\nContent-Type: application/octet-stream'.format(filename)
+        return (header + '\r\n\r\n').encode()
+
+    def __len__(self) -> int:
+        return self.len
+
+    def __iter__(self) -> Iterator[bytes]:
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    yield chunk
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Like a file, for http.client, which sends bodies with read in blocks.
+        Reads may be short, but are empty only at the end.
+        """
+        if self._chunks is None:
+            self._chunks = iter(self)
+        if size < 0:
+            rest = self._buffer[self._pos:] + b''.join(self._chunks)
+            self._buffer, self._pos = b'', 0
+            return rest
+        if self._pos >= len(self._buffer):
+            self._buffer, self._pos = next(self._chunks, b''), 0
+        result = self._buffer[self._pos:self._pos + size]
+        self._pos += len(result)
+        return result
+
+    def close(self) -> None:
+        """Close any file left open by a partial read"""
+        if self._chunks is not None:
+            self._chunks.close()  # type: ignore
+        self._chunks = None
+        self._buffer, self._pos = b'', 0
@@ -0,0 +1,154 @@
+"""
+Design of PCR primers around a guide with Primer3, in process.
+
+Follows what Crispor does for its primer page, see CrisporPrimerRequest: the
+amplicon must contain the cut site of the guide, and, for HDR, the insert site,
+with some flank on each side for sequencing. Results are the same: forward
+primer, reverse primer and product.
+
+Requires primer3-py. See https://libnano.github.io/primer3-py/.
+
+>>> template = 'A' * 100 + 'GATTACA' + 'C' * 100
+>>> get_target_region(len(template), 103, None, 250)
+(53, 101)
+>>> args, _ = primer3_args(template, (53, 101), 250, 60)
+>>> args['SEQUENCE_TARGET'], args['SEQUENCE_ID']
+([53, 101], 'crispycrunch')
+"""
+import logging
+
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import primer3  # type: ignore
+except ImportError:
+    primer3 = None
+
+try:
+    from utils.chrloc import ChrLoc, GuideChrLoc
+except ImportError:
+    from chrloc import ChrLoc, GuideChrLoc  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Max bp between the cut or insert site and the inner end of each primer
+TARGET_FLANK = 50
+# Smallest product as a fraction of max amplicon length
+MIN_PRODUCT_FRACTION = 0.5
+# Primer3 allows this much below and above the given melting temperature
+TM_TOLERANCE = 3
+
+
+def get_cut(guide_loc: GuideChrLoc) -> int:
+    """
+    Genome position of the cut of a guide. See get_guide_cut_to_insert.
+
+    >>> get_cut(GuideChrLoc('chr5:1-20:+')), get_cut(GuideChrLoc('chr5:1-20:-'))
+    (18, 4)
+    """
+    return guide_loc.end - 2 if guide_loc.strand == '+' else guide_loc.start + 3
+
+
+def get_template_loc(target_loc: ChrLoc, guide_loc: GuideChrLoc, amp_len: int) -> ChrLoc:
+    """
+    Enough genome on both sides of the cut for any amplicon of amp_len, on the
+    strand of the target, because primers are given on the strand of the target.
+
+    >>> get_template_loc(ChrLoc('chr5:1000-1040:-'), GuideChrLoc('chr5:1001-1020:+'), 250)
+    ChrLoc('chr5:768-1268:-')
+    """
+    cut = get_cut(guide_loc)
+    return ChrLoc('chr{}:{}-{}:{}'.format(
+        target_loc.chr, cut - amp_len, cut + amp_len, target_loc.strand or '+'))
+
+
+def get_target_region(
+        template_len: int,
+        cut: int,
+        hdr_dist: Optional[int],
+        amp_len: int) -> Tuple[int, int]:
+    """
+    Start and length of the region of the template that the amplicon must
+    contain. The HDR insert may be on either side of the cut, depending on the
+    strand convention of hdr_dist, so both sides are included.
+
+    >>> get_target_region(501, 250, None, 250)
+    (200, 101)
+    >>> get_target_region(501, 250, -12, 250)
+    (188, 125)
+
+    Flanks are smaller for short amplicons.
+
+    >>> get_target_region(201, 100, None, 100)
+    (75, 51)
+    """
+    flank = min(TARGET_FLANK, amp_len // 4) + abs(hdr_dist or 0)
+    start = max(0, cut - flank)
+    end = min(template_len - 1, cut + flank)
+    return start, end - start + 1
+
+
+def primer3_args(
+        template: str,
+        target_region: Tuple[int, int],
+        amp_len: int,
+        tm: int) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Sequence args and global args of Primer3"""
+    seq_args = {
+        'SEQUENCE_ID': 'crispycrunch',
+        'SEQUENCE_TEMPLATE': template.upper(),
+        'SEQUENCE_TARGET': list(target_region),
+    }
+    global_args = {
+        'PRIMER_NUM_RETURN': 1,
+        'PRIMER_OPT_SIZE': 20,
+        'PRIMER_MIN_SIZE': 18,
+        'PRIMER_MAX_SIZE': 25,
+        'PRIMER_OPT_TM': float(tm),
+        'PRIMER_MIN_TM': float(tm - TM_TOLERANCE),
+        'PRIMER_MAX_TM': float(tm + TM_TOLERANCE),
+        'PRIMER_MIN_GC': 20.0,
+        'PRIMER_MAX_GC': 80.0,
+        'PRIMER_PRODUCT_SIZE_RANGE': [[int(amp_len * MIN_PRODUCT_FRACTION), amp_len]],
+        'PRIMER_EXPLAIN_FLAG': 1,
+    }
+    return seq_args, global_args
+
+
+def design_primers(
+        template: str,
+        cut: int,
+        hdr_dist: Optional[int],
+        amp_len: int,
+        tm: int) -> List[str]:
+    """
+    Forward primer, reverse primer and product, or empty if Primer3 finds no
+    pair. cut is the index of the cut site in template.
+
+    Pure CPU work, so it is run in a process pool. See localrequest.
+    """
+    if primer3 is None:
+        raise RuntimeError('Local primer design requires primer3-py')
+
+    target_region = get_target_region(len(template), cut, hdr_dist, amp_len)
+    seq_args, global_args = primer3_args(template, target_region, amp_len, tm)
+    # Renamed in primer3-py 1.0
+    design = getattr(primer3.bindings, 'design_primers', None) or \
+        primer3.bindings.designPrimers
+    result = design(seq_args, global_args)
+
+    if not result.get('PRIMER_PAIR_NUM_RETURNED'):
+        logger.info('No primers: {}'.format(result.get('PRIMER_PAIR_EXPLAIN')))
+        return []
+    left_start, _ = result['PRIMER_LEFT_0']
+    right_end, _ = result['PRIMER_RIGHT_0']
+    return [
+        result['PRIMER_LEFT_0_SEQUENCE'],
+        result['PRIMER_RIGHT_0_SEQUENCE'],
+        seq_args['SEQUENCE_TEMPLATE'][left_start:right_end + 1],
+    ]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,199 @@
+"""
+Per-host rate limiting of outbound HTTP requests, shared by every client in the
+process.
+
+Each host has a token bucket that refills at the allowed rate of the host. When
+a host answers that we are going too fast, with status 429 or a message such as
+Ensembl's "You have exceeded the limit of 15 requests per second", the rate of
+the host is halved and the request is retried after a pause. The rate recovers
+gradually on success.
+
+Some hosts fail under concurrency rather than say so, such as togows.org with
+404s, so they also have a cap on requests in flight. See HOST_CONCURRENCY.
+
+Mount RateLimitedAdapter on a session to use it. Cached responses never reach
+the adapter, so they do not count against the limit.
+
+>>> bucket = TokenBucket(rate=100, burst=2)
+>>> start = time.monotonic()
+>>> for _ in range(4):
+...     bucket.acquire()
+>>> 0.01 < time.monotonic() - start < 0.5
+True
+>>> bucket.penalize()
+>>> bucket.rate
+50.0
+>>> for _ in range(100):
+...     bucket.reward()
+>>> bucket.rate
+100
+"""
+import logging
+import threading
+import time
+import urllib.parse
+
+from typing import Dict, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Allowed requests per second and burst size, per host.
+# Hosts not listed here are not limited.
+HOST_RATES = {
+    # See https://github.com/Ensembl/ensembl-rest/wiki/Rate-Limits
+    'rest.ensembl.org': (15, 15),
+    # Also capped in flight. See HOST_CONCURRENCY.
+    'togows.org': (8, 4),
+    'genome.ucsc.edu': (4, 4),
+    'api.genome.ucsc.edu': (4, 4),
+    'gggenome.dbcls.jp': (8, 8),
+}
+
+# Max requests in flight, per host. A token bucket limits the rate, but not
+# how many slow requests are in flight at once. These caps are the concurrency
+# that was known to work, until more is measured.
+HOST_CONCURRENCY = {
+    # More than 4 concurrent requests caused strange 404 errors from togows.org
+    'togows.org': 4,
+    # and 'You have exceeded the limit' errors from UCSC :(
+    'genome.ucsc.edu': 4,
+    'api.genome.ucsc.edu': 4,
+}
+
+LIMIT_MESSAGES = (
+    'You have exceeded the limit',
+    'Too Many Requests',
+)
+
+# How many times to retry a request that was refused for going too fast
+MAX_RETRIES = 4
+# Seconds to pause a host that refused without Retry-After, such as Ensembl
+# with its limit message, which used to be retried after 4 seconds
+REFUSED_PAUSE = 4
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket with adaptive rate.
+
+    There are three public methods: acquire, penalize and reward.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def penalize(self, retry_after: Optional[float] = None) -> None:
+        """The host refused a request. Slow down, and pause all requests."""
+        with self._lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self._tokens = 0
+            pause = retry_after if retry_after is not None else REFUSED_PAUSE
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def reward(self) -> None:
+        """The host accepted a request. Speed up again, slowly."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimiter:
+    """Buckets and caps of requests in flight by host. See HOST_RATES and HOST_CONCURRENCY."""
+
+    def __init__(self, rates: Dict[str, tuple], concurrency: Dict[str, int] = {}) -> None:
+        self._buckets = dict((host, TokenBucket(rate, burst))
+                             for host, (rate, burst) in rates.items())
+        self._in_flight = dict((host, threading.BoundedSemaphore(limit))
+                               for host, limit in concurrency.items())
+
+    def bucket(self, url: str) -> Optional[TokenBucket]:
+        return self._buckets.get(urllib.parse.urlparse(url).hostname or '')
+
+    def in_flight(self, url: str) -> Optional[threading.BoundedSemaphore]:
+        return self._in_flight.get(urllib.parse.urlparse(url).hostname or '')
+
+
+shared_limiter = RateLimiter(HOST_RATES, HOST_CONCURRENCY)
+
+
+def is_rate_limited(response: requests.Response) -> bool:
+    if response.status_code == 429:
+        return True
+    if response.status_code < 400:
+        return False
+    return any(message in response.text for message in LIMIT_MESSAGES)
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    """
+    >>> response = requests.Response()
+    >>> response.headers['Retry-After'] = '1.5'
+    >>> _retry_after(response)
+    1.5
+    """
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    """
+    An HTTPAdapter that waits for a token of the host before each request, and
+    backs off and retries when the host refuses for going too fast.
+    """
+
+    def __init__(self, *args, limiter: RateLimiter = shared_limiter, **kwargs) -> None:
+        self.limiter = limiter
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):  # type: ignore
+        in_flight = self.limiter.in_flight(request.url)
+        if in_flight is None:
+            return self._send_limited(request, **kwargs)
+        with in_flight:
+            return self._send_limited(request, **kwargs)
+
+    def _send_limited(self, request, **kwargs):  # type: ignore
+        bucket = self.limiter.bucket(request.url)
+        if bucket is None:
+            return super().send(request, **kwargs)
+
+        for retries in range(MAX_RETRIES, -1, -1):
+            bucket.acquire()
+            response = super().send(request, **kwargs)
+            if not is_rate_limited(response):
+                bucket.reward()
+                return response
+            bucket.penalize(_retry_after(response))
+            logger.warning('Rate limited by {}. {} retries left. Now at {:.1f} requests per second'
+                           .format(request.url, retries, bucket.rate))
+            if retries:
+                # Give the connection back to the pool before retrying
+                response.close()
+        return response
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,117 @@
+"""
+Single-flight deduplication of identical calls in flight.
+
+A response cache is filled only after a response arrives, so identical requests
+made at the same moment all miss the cache and all hit the upstream. With
+single-flight, the first caller for a key makes the call and later callers wait
+for it and share its result, or its exception.
+
+>>> import threading, time
+>>> flights = SingleFlight()
+>>> calls = []
+>>> def slow(x):
+...     calls.append(x)
+...     time.sleep(0.2)
+...     return x * 2
+>>> results = []
+>>> threads = [threading.Thread(target=lambda: results.append(flights.do('k', slow, 21)))
+...            for _ in range(5)]
+>>> for t in threads:
+...     t.start()
+>>> for t in threads:
+...     t.join()
+>>> results, calls
+([42, 42, 42, 42, 42], [21])
+
+A key is free again once its call is done.
+
+>>> flights.do('k', slow, 1)
+2
+"""
+import asyncio
+import copy
+import logging
+import threading
+
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+import requests
+import requests_cache  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    There are two public methods: do, and do_async for coroutines.
+    """
+
+    def __init__(self) -> None:
+        self._calls = {}  # type: Dict[Hashable, Future]
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        future, is_leader = self._join(key)
+        if not is_leader:
+            logger.debug('Waiting on call in flight: {}'.format(key))
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._leave(key)
+            future.set_exception(e)
+            raise
+        self._leave(key)
+        future.set_result(result)
+        return result
+
+    async def do_async(self, key: Hashable, fn: Callable[..., Awaitable], *args: Any) -> Any:
+        future, is_leader = self._join(key)
+        if not is_leader:
+            logger.debug('Waiting on call in flight: {}'.format(key))
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn(*args)
+        except BaseException as e:
+            self._leave(key)
+            future.set_exception(e)
+            raise
+        self._leave(key)
+        future.set_result(result)
+        return result
+
+    def _join(self, key: Hashable) -> Tuple[Future, bool]:
+        with self._lock:
+            if key in self._calls:
+                return self._calls[key], False
+            future = Future()  # type: Future
+            future.set_running_or_notify_cancel()
+            self._calls[key] = future
+            return future, True
+
+    def _leave(self, key: Hashable) -> None:
+        with self._lock:
+            del self._calls[key]
+
+
+class SingleFlightCachedSession(requests_cache.CachedSession):
+    """
+    A CachedSession where identical GETs in flight are sent only once, keyed
+    by cache key. Each caller gets its own shallow copy of the response.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._flights = SingleFlight()
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+        if request.method != 'GET' or kwargs.get('stream'):
+            return super().send(request, **kwargs)
+        key = self.cache.create_key(request)
+        return copy.copy(self._flights.do(key, super().send, request, **kwargs))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,3 +1,6 @@
 # type: ignore
 from .batchrequest import *
+from .localrequest import LocalCrispressoRequest, LocalPrimerRequest
+from .progress import shared_hub
+from .scheduler import shared_scheduler, Scheduler, UPSTREAM_LIMITS
 from .scraperequest import *
@@ -0,0 +1,183 @@
+"""
+A local store of the artifacts of Crispresso reports, such as plots and
+tables, so that results pages load them from disk instead of from the mirror
+that made them, which may be slow, gone, or have deleted old reports.
+
+Once a report is done, its zip is streamed to the store, and the files in it
+are stored one by one. If the zip cannot be had, the report files are fetched
+instead, several at a time. See fetch_report. Results keep a manifest of the
+names of their artifacts to digests, which main.views.ReportArtifactView
+serves from.
+
+Artifacts are stored by the sha256 of their content, under
+CRISPRESSO_ARTIFACT_DIR/ab/abcdef..., so that identical files, such as those
+of a report shared by the samples of a batch, are stored once, and a stored
+file never changes. The store is off without Django settings, such as in
+doctests, or with settings.CRISPRESSO_ARTIFACT_DIR empty. Errors are logged
+and the report is left remote, because the store is only a copy.
+
+>>> import tempfile
+>>> store = ArtifactStore(tempfile.mkdtemp())
+>>> digest = store.put([b'AC', b'GT'])
+>>> digest == hashlib.sha256(b'ACGT').hexdigest()
+True
+>>> store.put([b'ACGT']) == digest, store.has(digest)
+(True, True)
+>>> open(store.path(digest), 'rb').read()
+b'ACGT'
+>>> store.path('../' + digest)  # doctest: +ELLIPSIS
+Traceback (most recent call last):
+...
+ValueError: Not a digest: '../...'
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import zipfile
+
+from typing import Dict, Iterable, Optional
+
+import requests
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    from .engine import shared_engine
+except ImportError:
+    # For doctest, which is not run in package context
+    from engine import shared_engine  # type: ignore # noqa
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# Report files fetched at a time, per report, when there is no zip
+MAX_FETCHES = 8
+# Seconds without bytes before a download fails
+DOWNLOAD_TIMEOUT = 60
+
+
+def get_store() -> Optional['ArtifactStore']:
+    try:
+        from django.conf import settings
+        root = getattr(settings, 'CRISPRESSO_ARTIFACT_DIR', '')
+    except ImproperlyConfigured:
+        # For doctest, which runs without Django settings
+        return None
+    return ArtifactStore(root) if root else None
+
+
+class ArtifactStore:
+    """
+    Files by digest, in directories by the first two hex digits of the
+    digest. Files are written to a temporary file and renamed into place, so
+    that readers never see part of a file, and processes that store the same
+    file do not clash.
+
+    There are three public methods: put, has and path.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        # Digests come from results, but must never be paths
+        if not isinstance(digest, str) or not re.fullmatch(r'[0-9a-f]{64}', digest):
+            raise ValueError('Not a digest: {!r}'.format(digest))
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def put(self, chunks: Iterable[bytes]) -> str:
+        """Stores the content of chunks, as they come, and returns its digest"""
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.partial-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+            path = self.path(digest.hexdigest())
+            if os.path.exists(path):
+                os.unlink(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return digest.hexdigest()
+
+
+def fetch_zip(session: requests.Session, url: str, store: ArtifactStore) -> Dict[str, str]:
+    """
+    Manifest of the zip at url, by its name, and of the files in it, by their
+    paths in the zip. The zip is never read into memory whole.
+    """
+    logger.info('GET request to: {}'.format(url))
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        zip_digest = store.put(response.iter_content(CHUNK_SIZE))
+
+    manifest = {url.split('/')[-1]: zip_digest}
+    with zipfile.ZipFile(store.path(zip_digest)) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            with archive.open(info) as f:
+                manifest[info.filename] = store.put(iter(lambda: f.read(CHUNK_SIZE), b''))
+    return manifest
+
+
+def fetch_file(session: requests.Session, url: str, store: ArtifactStore) -> Optional[str]:
+    """Digest of the file at url, or None if there is no such file"""
+    logger.info('GET request to: {}'.format(url))
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return store.put(response.iter_content(CHUNK_SIZE))
+
+
+async def fetch_report(session: requests.Session,
+                       zip_url: str,
+                       file_urls: Dict[str, str],
+                       store: ArtifactStore = None) -> Dict[str, str]:
+    """
+    Manifest of the artifacts of a report, from its zip, or else from
+    file_urls, which are by name in the manifest. Empty if the store is off,
+    or if nothing could be fetched.
+
+    session must not be cached, because responses are streamed to the store.
+    """
+    store = store or get_store()
+    if store is None:
+        return {}
+    try:
+        return await shared_engine.call(fetch_zip, session, zip_url, store)
+    except (requests.RequestException, zipfile.BadZipFile, OSError) as e:
+        logger.warning('Report zip {} failed: {}. Fetching {} files instead.'.format(
+            zip_url, e, len(file_urls)))
+
+    fetches = asyncio.Semaphore(MAX_FETCHES)
+
+    async def fetch(url: str) -> Optional[str]:
+        async with fetches:
+            try:
+                return await shared_engine.call(fetch_file, session, url, store)
+            except (requests.RequestException, OSError) as e:
+                logger.warning('Report file {} failed: {}'.format(url, e))
+                return None
+
+    digests = await asyncio.gather(*[fetch(url) for url in file_urls.values()])
+    return dict((name, digest) for name, digest in zip(file_urls, digests) if digest)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
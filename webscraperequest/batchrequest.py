@@ -3,32 +3,64 @@ import functools
 import time  # noqa
 
 from abc import abstractmethod
-from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Dict, Iterable, List, Mapping, Sequence, Tuple, Type
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Mapping, Sequence, Tuple, Type
 from unittest import mock  # noqa
 
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models
 
 try:
+    from . import jobqueue
+    from .localrequest import LocalCrispressoRequest, LocalPrimerRequest
+    from .resultwriter import shared_writer
+    from .scheduler import shared_scheduler
     from .scraperequest import *
-except ModuleNotFoundError:
+except ImportError:
     # For doctest, which is not run in package context
+    import jobqueue  # type: ignore # noqa
+    from localrequest import LocalCrispressoRequest, LocalPrimerRequest  # type: ignore # noqa
+    from resultwriter import shared_writer  # type: ignore # noqa
+    from scheduler import shared_scheduler  # type: ignore # noqa
     from scraperequest import *  # type: ignore # noqa
 
 logger = logging.getLogger(__name__)
 
 
+def _setting(name: str, default: Any) -> Any:
+    try:
+        from django.conf import settings
+        return getattr(settings, name, default)
+    except ImproperlyConfigured:
+        # For doctest, which runs without Django settings
+        return default
+
+
 class BaseBatchWebRequest:
     """
     Manages a parallel batch of web requests. Intermediate and final results are
     saved into a given Django model instance.
 
+    Requests run on the process-wide shared_scheduler, in the lane of the
+    upstream they call. Concurrency is capped per lane across all batches of all
+    users. See scheduler.UPSTREAM_LIMITS.
+
+    With settings.DURABLE_BATCH_JOBS, requests are instead persisted as jobs and
+    run by separate worker processes. See jobqueue.
+
+    Requests that must wait before a retry, such as Crispor guides stuck in its
+    job queue, give up their lane slot until the retry is due, so that other
+    requests proceed. See RetryLater. Retries show in get_batch_status.
+
     There are two abstract properties to override: requester and field_name.
+    Subclasses that request groups also override _arequest_group.
 
-    There are two public methods: start and get_batch_status.
+    There are two public methods: start and get_batch_status. There is one
+    public property: progress_key.
     """
 
-    max_workers = 8  # Number of threads to use
+    lane = 'crispor'  # Upstream lane of shared_scheduler
 
     def __init__(self, model_instance: models.Model) -> None:
         self.model_instance = model_instance
@@ -42,18 +74,40 @@ class BaseBatchWebRequest:
         """The field name of model_instance that should contain request results."""
 
     def start(self, largs: List[list], keys: List[int] = []) -> None:
-        """Start all requests, each in a thread, with the given list of args"""
+        """Start all requests on the shared scheduler with the given list of args"""
         self._init_instance_field(largs, keys)
 
-        pool = ThreadPoolExecutor(self.max_workers)
+        if jobqueue.use_durable_queue():
+            jobqueue.enqueue(self, largs)
+            return
+
+        # Coroutine clients hold a lane slot only for each call. See scheduler.
+        request = self._arequest if self.requester.is_async() else self._request
         for i, args in enumerate(largs):
-            logger.debug('{} submitted to thread pool'.format(self.requester.__class__))
-            pool.submit(self._request, args).add_done_callback(
-                functools.partial(self._insert, index=i))
-        pool.shutdown(wait=False)
+            logger.debug('{} submitted to {} lane'.format(self.requester.__class__, self.lane))
+            shared_scheduler.submit(
+                self.lane, request, args,
+                user=self._user, group=self._group,
+            ).add_done_callback(functools.partial(self._insert, index=i))
+
+    @property
+    def _user(self):
+        """For fair sharing of lanes between users"""
+        return getattr(self.model_instance, 'owner_id', None)
+
+    @property
+    def _group(self):
+        """For fair sharing of lanes between batches of one user"""
+        return (self.model_instance.__class__.__name__, self.model_instance.pk)
+
+    @property
+    def progress_key(self) -> tuple:
+        """For waiting on writes of results. See progress.shared_hub."""
+        return (self.model_instance.__class__.__name__, self.model_instance.pk, str(self.field_name))
 
     def get_batch_status(self) -> 'BatchStatus':  # forward ref for typing
         completed, running, errorred = [], [], []
+        retrying = {}
         current_results = getattr(self.model_instance, str(self.field_name))
         for i, result in enumerate(current_results):
             key = tuple([i,
@@ -62,34 +116,65 @@ class BaseBatchWebRequest:
                          ] + result['request_key'])
             if result['in_cache']:
                 key += ('in cache',)
+            retries = result.get('retries', 0)
             if result['success'] is True:
                 duration = round(result['end_time'] - result['start_time'], 1)
                 key += (f'{duration}s',)
+                if retries:
+                    key += (f'{retries} retries',)
                 completed.append(key)
             elif result['success'] is False:
+                if retries:
+                    key += (f'{retries} retries',)
                 errorred.append(key + (result['error'],))
             elif result['success'] is None:
+                if retries:
+                    retry_at = time.strftime('%H:%M:%S', time.localtime(result['retry_at']))
+                    key += (f'retry {retries} at {retry_at}', result['retry_reason'])
+                    retrying[i] = dict((k, result[k]) for k in ('retries', 'retry_at', 'retry_reason'))
                 running.append(key)
             else:
                 assert False
 
-        return BatchStatus(completed, errorred, running)
+        return BatchStatus(completed, errorred, running, retrying)
 
     def _init_instance_field(self, largs: List[list], keys: List[int]) -> None:
+        requesters = [self.requester(*args) for args in largs]  # type: ignore
         setattr(self.model_instance, str(self.field_name), [
             {'success': None,
              'request_key': [args[k] for k in keys],
-             'in_cache': self.requester(*args).in_cache(),  # type: ignore
-             'cache_key': self.requester(*args).cache_key,  # type: ignore
+             'in_cache': requester.in_cache(),
+             'cache_key': requester.cache_key,
              'start_time': time.time()}
-            for i, args in enumerate(largs)
+            for args, requester in zip(largs, requesters)
         ])
         self.model_instance.save()
         logger.debug('{} initial values saved'.format(self.requester.__class__))
 
     def _request(self, args: list) -> Dict[str, Any]:
         try:
-            return self.requester(*args).run()  # type: ignore
+            requester = self.requester(*args)  # type: ignore
+            requester.user = self._user
+            return requester.run_coalesced()
+        except (Exception) as e:
+            logger.exception(e)
+            return {
+                'success': False,
+                'error': getattr(e, 'message', str(e)),
+            }
+
+    async def _arequest(self, args: list) -> Dict[str, Any]:
+        requester = self.requester(*args)  # type: ignore
+        requester.defer_retries = True
+        requester.user = self._user
+        return await self._aresume(requester.arun_coalesced)
+
+    async def _aresume(self, arun: Callable[[], Awaitable]) -> Dict[str, Any]:
+        """RetryLater is raised to _insert, which schedules the retry."""
+        try:
+            return await arun()
+        except RetryLater:
+            raise
         except (Exception) as e:
             logger.exception(e)
             return {
@@ -97,7 +182,48 @@ class BaseBatchWebRequest:
                 'error': getattr(e, 'message', str(e)),
             }
 
+    def _retry_later(self, retry: RetryLater, index: int) -> None:
+        """Queue the retry when due, without holding a lane slot meanwhile."""
+        logger.info('{} retry {} of index {} in {}s: {}'.format(
+            self.requester.__name__, retry.retries, index, retry.delay, retry.reason))
+        shared_writer.write(self.model_instance, str(self.field_name), index, retry.status)
+        shared_scheduler.submit_later(
+            retry.delay, self.lane, self._aresume, retry.resume,
+            user=self._user, group=self._group,
+        ).add_done_callback(functools.partial(self._insert, index=index))
+
+    def _start_groups(self, largs: List[list], groups: Iterable[List[int]]) -> None:
+        """Each group of indexes into largs is requested at once. See _arequest_group."""
+        for indexes in groups:
+            logger.debug('{} requests submitted to {} lane'.format(len(indexes), self.lane))
+            shared_scheduler.submit(
+                self.lane, self._arequest_group, [largs[i] for i in indexes],
+                user=self._user, group=self._group,
+            ).add_done_callback(functools.partial(self._insert_group, indexes=indexes))
+
+    @abstractmethod
+    async def _arequest_group(self, largs: List[list]) -> List[Any]:
+        """
+        Results in order of largs. A result may be an exception. Only needed by
+        subclasses that call _start_groups.
+        """
+
+    def _insert_group(self, future, indexes: List[int]) -> None:
+        for i, index in enumerate(indexes):
+            done = Future()  # type: Future
+            try:
+                result = future.result()[i]
+                if isinstance(result, RetryLater):
+                    done.set_exception(result)
+                else:
+                    done.set_result(result)
+            except Exception as e:
+                done.set_result({'success': False, 'error': str(e)})
+            self._insert(done, index=index)
+
     def _insert(self, future, index=None) -> None:
+        if not future.cancelled() and isinstance(future.exception(), RetryLater):
+            return self._retry_later(future.exception(), index)
         try:
             result = future.result()
             result['success'] = result.get('success', True)
@@ -105,12 +231,14 @@ class BaseBatchWebRequest:
         except Exception as e:
             logger.error('Error inserting into index {}: {}'
                          .format(index, str(e)))
-            result['success'] = result.get('success', False)
-            result['error'] = getattr(e, 'message', str(e))
-        finally:
-            result['end_time'] = int(time.time())
-            self.model_instance.__dict__[str(self.field_name)][index].update(result)
-            self.model_instance.save()
+            # No result to amend, such as when the request raised
+            result = {
+                'success': False,
+                'error': getattr(e, 'message', str(e)),
+            }
+        result['end_time'] = int(time.time())
+        # Only the element at index is written. See resultwriter.
+        shared_writer.write(self.model_instance, str(self.field_name), index, result)
 
 
 class BatchStatus:
@@ -120,10 +248,14 @@ class BatchStatus:
         completed: Sequence[Tuple[Any, ...]],
         errored: Sequence[Tuple[Any, ...]],
         running: Sequence[Tuple[Any, ...]],
+        retrying: Mapping[int, Dict[str, Any]] = None,
     ) -> None:
         self.completed = completed
         self.errored = errored
         self.running = running
+        # Running rows that wait for a retry, by index, with their number of
+        # retries, time of next attempt and reason. See RetryLater.status.
+        self.retrying = retrying or {}
 
     def __str__(self) -> str:
         return 'BatchStatus({}, {}, {})'.format(
@@ -133,6 +265,18 @@ class BatchStatus:
     def statuses(self):
         return self.completed + self.errored + self.running
 
+    @property
+    def rows(self) -> Dict[int, Tuple[str, str]]:
+        """
+        Status and label of each row by index.
+
+        >>> BatchStatus([(1, '2.0s')], [], [(0,)]).rows
+        {1: ('completed', "(1, '2.0s')"), 0: ('running', '(0,)')}
+        """
+        return dict((key[0], (name, str(key)))
+                    for name in ('completed', 'errored', 'running')
+                    for key in getattr(self, name))
+
     @property
     def percent_success(self):
         return 100 * len(self.completed) // len(self.statuses)
@@ -163,13 +307,15 @@ class CrisporGuideBatchWebRequest(BaseBatchWebRequest):
     """
     requester = CrisporGuideRequest
     field_name = 'guide_data'
-    # More than 8 threads appears to cause a 'no output' Crispor error
-    # TODO (gdingle): create global worker pool? somehow?
-    max_workers = 4
+    lane = 'crispor'
 
 
 class CrisporPrimerBatchWebRequest(BaseBatchWebRequest):
     """
+    Primers are requested per guide. Crispor has no page of the primers of
+    several guides, so requesting them per Crispor batch needs a change to the
+    mirror first.
+
     >>> batch = CrisporPrimerBatchWebRequest(mock.Mock())
     >>> largs = [['9cJNEsbfWiSKa8wlaJMZ', 's185+']]
     >>> batch.start(largs, [0, 1])
@@ -181,7 +327,17 @@ class CrisporPrimerBatchWebRequest(BaseBatchWebRequest):
     """
     requester = CrisporPrimerRequest
     field_name = 'primer_data'
-    max_workers = 4
+    lane = 'crispor_primers'
+
+
+class LocalPrimerBatchWebRequest(BaseBatchWebRequest):
+    """
+    Like CrisporPrimerBatchWebRequest, but with Primer3 in process. Results go
+    to the same field, so status and progress are read the same way.
+    """
+    requester = LocalPrimerRequest
+    field_name = 'primer_data'
+    lane = 'primer3'
 
 
 class CrispressoBatchWebRequest(BaseBatchWebRequest):
@@ -201,7 +357,38 @@ class CrispressoBatchWebRequest(BaseBatchWebRequest):
     """
     requester = CrispressoRequest
     field_name = 'results_data'
-    max_workers = 4
+    lane = 'crispresso'
+
+    def start(self, largs: List[list], keys: List[int] = []) -> None:
+        """
+        With settings.CRISPRESSO_BATCH_SIZE over 1, samples of the same trim,
+        which is the fifth arg, are packed into Crispresso batches of up to
+        that many samples. See CrispressoBatchRequest.
+        """
+        size = int(_setting('CRISPRESSO_BATCH_SIZE', 1))
+        if size <= 1 or jobqueue.use_durable_queue():
+            return super().start(largs, keys)
+        self._init_instance_field(largs, keys)
+
+        by_trim = OrderedDict()  # type: Dict[str, List[int]]
+        for i, args in enumerate(largs):
+            by_trim.setdefault(args[4], []).append(i)
+        self._start_groups(largs, [
+            indexes[start:start + size]
+            for indexes in by_trim.values()
+            for start in range(0, len(indexes), size)
+        ])
+
+    async def _arequest_group(self, largs: List[list]) -> List[Any]:
+        samples = [self.requester(*args) for args in largs]  # type: ignore
+        try:
+            results = await CrispressoBatchRequest(samples).arun()
+        except Exception as e:
+            logger.exception(e)
+            results = [e] * len(largs)
+        return [{'success': False, 'error': getattr(r, 'message', str(r))}
+                if isinstance(r, Exception) else r
+                for r in results]
 
     @staticmethod
     def _get_primer_product(row, analysis) -> str:
@@ -227,8 +414,11 @@ class CrispressoBatchWebRequest(BaseBatchWebRequest):
     def start_analysis(
             analysis: models.Model,
             records: Iterable[Mapping[str, str]]) -> None:
-
-        batch = CrispressoBatchWebRequest(analysis)
+        """By a Crispresso mirror, or in process. See settings.CRISPRESSO_BACKEND."""
+        if _setting('CRISPRESSO_BACKEND', 'crispresso') == 'local':
+            batch = LocalCrispressoBatchWebRequest(analysis)  # type: BaseBatchWebRequest
+        else:
+            batch = CrispressoBatchWebRequest(analysis)
         largs = [[
             CrispressoBatchWebRequest._get_primer_product(row, analysis),
             row['guide_seq'],
@@ -243,6 +433,16 @@ class CrispressoBatchWebRequest(BaseBatchWebRequest):
         return batch.start(largs, [-1, 1])
 
 
+class LocalCrispressoBatchWebRequest(BaseBatchWebRequest):
+    """
+    Like CrispressoBatchWebRequest, but quantified in process. Results go to the
+    same field, so status and progress are read the same way.
+    """
+    requester = LocalCrispressoRequest
+    field_name = 'results_data'
+    lane = 'quantify'
+
+
 if __name__ == '__main__':
     # TODO (gdingle): re-run tests on new crispor server, save in cache
     doctest.testmod()
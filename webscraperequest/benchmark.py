@@ -0,0 +1,159 @@
+"""
+Benchmark of extraction from Crispor guide pages: parse time and peak memory
+per page, for the single-pass reader of crisporpage with each available parser,
+and for the legacy approach of a full BeautifulSoup tree with many text passes.
+
+Pages are read from the HTTP cache, see utils.httpcache, or from HTML files
+given as arguments. Without either, a synthetic page of SYNTHETIC_ROWS guide
+rows is used. Its rows have cells like those of real rows, with off-targets, scores
+and links, so it is about 650 KB, which is about the size of the page of a
+2000 bp target. Real pages are better, if there are any.
+
+    python -m webscraperequest.benchmark [page.html ...]
+"""
+import argparse
+import statistics
+import time
+import tracemalloc
+
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+from bs4 import BeautifulSoup
+
+from . import scraperequest
+from .crisporpage import HTML_PARSER, read_guide_page
+from .scraperequest import CRISPOR_BASE_URL, GUIDE_PAGE_EXAMPLE, CrisporGuideRequest
+
+SYNTHETIC_ROWS = 400
+REPEATS = 5
+
+# Cells of a guide row after those of GUIDE_PAGE_EXAMPLE: efficiency scores,
+# counts of off-targets by mismatches, the top off-targets, and links.
+SYNTHETIC_CELLS = (
+    '<td><span title="Doench 2016 score">{i}</span></td>'
+    '<td><span title="Moreno-Mateos score">{j}</span></td>'
+    '<td><span title="Out-of-frame score">{k}</span></td>'
+    '<td><div class="offtargetCounts">0 - 0 - {i} - {j} - {k}</div>'
+    '<div class="offtargets">{offtargets}'
+    '<a href="crispor.py?batchId=ZvHQ5Xm1zo5UWfoUF8Jz&amp;pamId=s{i}%2B&amp;showAll=1">'
+    'show all</a></div></td>'
+    '<td><a href="crispor.py?batchId=ZvHQ5Xm1zo5UWfoUF8Jz&amp;pamId=s{i}%2B&amp;pam=NGG">'
+    'Cloning / PCR primers</a><br><small>Restriction enzymes: BsaI,HpyCH4V</small></td>'
+)
+SYNTHETIC_OFFTARGET = (
+    '<div class="offtarget"><tt>GC<u>A</u>AGGACCC<u>T</u>CCGGCCA<u>G</u>C</tt> '
+    '<small>AGG</small> <span title="CFD score">0.{m}{i}</span> '
+    '<a href="http://genome.ucsc.edu/cgi-bin/hgTracks?db=hg38&amp;position=chr{m}:{i}{j}{k}-{i}{j}{k}23"'
+    ' target="_blank">intron:GENE{j}</a></div>'
+)
+SYNTHETIC_OFFTARGETS = 4
+
+
+def cached_pages() -> List[Tuple[str, str]]:
+    return [(response.url, response.text)
+            for response in scraperequest._cache.iter_responses()
+            if (response.url or '').startswith(CRISPOR_BASE_URL) and
+            'guideRow' in response.text]
+
+
+def synthetic_page(rows: int = SYNTHETIC_ROWS) -> str:
+    lines = GUIDE_PAGE_EXAMPLE.split('\n')
+    row = next(line for line in lines if 'guideRow' in line)
+    body = '\n'.join(
+        row.replace('s5+', 's{}+'.format(i)).replace('</tr>', _synthetic_cells(i) + '</tr>')
+        for i in range(rows))
+    return GUIDE_PAGE_EXAMPLE.replace(row, body)
+
+
+def _synthetic_cells(i: int) -> str:
+    j, k = i * 7 % 100, i * 13 % 100
+    offtargets = ''.join(SYNTHETIC_OFFTARGET.format(i=i, j=j, k=k, m=m)
+                         for m in range(1, SYNTHETIC_OFFTARGETS + 1))
+    return SYNTHETIC_CELLS.format(i=i, j=j, k=k, offtargets=offtargets)
+
+
+def legacy_extract(html: str) -> None:
+    """The extractor before it was single-pass: a full tree and many text passes."""
+    soup = BeautifulSoup(html, 'html.parser')
+    for _ in range(4):
+        soup.get_text()
+    soup.find(class_='title')
+    table = soup.find('table', {'id': 'otTable'})
+    soup.find('input', {'name': 'batchId'})
+    rows = [[cell for cell in row.find_all('td')[1:8]]
+            for row in table.find_all(class_='guideRow')]
+    rows = [r for r in rows
+            if 'primers' in r[0].get_text() and
+            r[1].get_text().strip().isdigit()]
+    for _ in range(2):
+        [[c.get_text().strip() for c in r[1:4]] for r in rows]
+    [r[0].find_next('tt').get_text() for r in rows]
+
+
+def single_pass_read(parser: str) -> Callable[[str], None]:
+    def read(html: str) -> None:
+        read_guide_page(html, parser)
+    return read
+
+
+def single_pass_extract(html: str) -> None:
+    CrisporGuideRequest('', pre_filter=0)._extract_data(html, CRISPOR_BASE_URL)
+
+
+def measure(extract: Callable[[str], None], html: str) -> Tuple[float, int]:
+    """Best seconds of REPEATS, and peak bytes allocated in one traced run."""
+    seconds = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        extract(html)
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    extract(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(seconds), peak
+
+
+def available_parsers() -> List[str]:
+    return ['html.parser'] + (['lxml'] if HTML_PARSER == 'lxml' else [])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('files', nargs='*', help='Saved Crispor guide pages')
+    args = parser.parse_args()
+
+    if args.files:
+        pages = [(path, open(path).read()) for path in args.files]
+    else:
+        pages = cached_pages()
+    if not pages:
+        print('No Crispor guide pages in cache. Using a synthetic page of {} rows.'
+              .format(SYNTHETIC_ROWS))
+        pages = [('synthetic', synthetic_page())]
+
+    extractors = OrderedDict([('legacy bs4 html.parser', legacy_extract)] + [
+        ('single-pass read ' + name, single_pass_read(name)) for name in available_parsers()
+    ] + [
+        ('single-pass extract ' + HTML_PARSER, single_pass_extract),
+    ])  # type: Dict[str, Callable[[str], None]]
+    results = OrderedDict((name, []) for name in extractors)  # type: Dict[str, list]
+    for source, html in pages:
+        print('{} ({} KB)'.format(source, len(html) // 1024))
+        for name, extract in extractors.items():
+            seconds, peak = measure(extract, html)
+            results[name].append((seconds, peak))
+            print('  {:<32} {:>8.1f} ms {:>8.1f} MB peak'.format(
+                name, seconds * 1000, peak / 2 ** 20))
+
+    print('Median over {} pages'.format(len(pages)))
+    for name, measures in results.items():
+        print('  {:<32} {:>8.1f} ms {:>8.1f} MB peak'.format(
+            name,
+            statistics.median(s for s, _ in measures) * 1000,
+            statistics.median(p for _, p in measures) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
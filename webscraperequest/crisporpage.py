@@ -0,0 +1,239 @@
+"""
+Single-pass reader of Crispor guide pages.
+
+A results page for a 2000 bp target can be hundreds of kilobytes. Instead of
+building a BeautifulSoup tree and walking it once per piece of data, the page is
+read in one streaming pass of parser events, by lxml when it is installed, or by
+html.parser of the standard library otherwise. No tree is built. The pass
+collects:
+
+* the text of the page, to detect errors and waiting states
+* the batchId and the text of the title
+* the id, and the text and first <tt> of each cell, of each guide row of otTable
+
+>>> page = read_guide_page(
+...     '<div class="title">Not <b>found</b></div><table id="otTable">'
+...     '<tr id="s1+" class="guideRow"><td>1</td><td><tt>ACGT</tt> primers</td><td>50</td></tr>'
+...     '</table><input type="hidden" name="batchId" value="abc">', 'html.parser')
+>>> page.title, page.batch_id, page.has_table
+('Not found', 'abc', True)
+>>> page.rows
+[('s1+', ['1', 'ACGT primers', '50'], [None, 'ACGT', None])]
+>>> page.text
+'Not found1ACGT primers50'
+
+Crispor also offers guides and off-targets as TSV downloads, which are read
+into columns by header name. See read_tsv.
+"""
+import csv
+import io
+import logging
+import re
+
+from collections import OrderedDict
+
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import lxml.etree  # type: ignore
+    # Several times faster than html.parser on big pages
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+logger = logging.getLogger(__name__)
+
+# id, texts of cells, and texts of first <tt> of cells
+GuideRow = Tuple[str, List[str], List[Optional[str]]]
+
+
+class GuidePage:
+    """
+    Collects data from parser events. Follows the target interface of lxml, so
+    there are four public methods: start, end, data and close.
+
+    Missing end tags of rows and cells are tolerated. Nested tables in otTable
+    are skipped.
+    """
+
+    def __init__(self) -> None:
+        self.text = ''
+        self.title = None  # type: Optional[str]
+        self.batch_id = None  # type: Optional[str]
+        self.has_table = False
+        self.rows = []  # type: List[GuideRow]
+
+        self._texts = []  # type: List[str]
+        self._title = None  # type: Optional[list]
+        self._table_depth = 0
+        self._row = None  # type: Optional[GuideRow]
+        self._cell = None  # type: Optional[List[str]]
+        self._tt = None  # type: Optional[List[str]]
+
+    def start(self, tag: str, attrs: Dict[str, Any]) -> None:
+        classes = (attrs.get('class') or '').split()
+        if self._title is not None:
+            if tag == self._title[0]:
+                self._title[1] += 1
+        elif 'title' in classes:
+            # tag, depth, texts
+            self._title = [tag, 1, []]
+
+        if tag == 'input' and attrs.get('name') == 'batchId':
+            self.batch_id = attrs.get('value')
+        elif tag == 'table':
+            if self._table_depth:
+                self._table_depth += 1
+            elif attrs.get('id') == 'otTable':
+                self._table_depth = 1
+                self.has_table = True
+        elif self._table_depth != 1:
+            pass
+        elif tag == 'tr':
+            self._end_row()
+            if 'guideRow' in classes:
+                self._row = (attrs.get('id') or '', [], [])
+                self.rows.append(self._row)
+        elif tag == 'td' and self._row is not None:
+            self._end_cell()
+            self._cell = []
+            self._row[2].append(None)
+        elif tag == 'tt' and self._cell is not None and self._row[2][-1] is None:
+            # Only the first <tt> of a cell
+            self._tt = []
+
+    def end(self, tag: str) -> None:
+        if self._title is not None and tag == self._title[0]:
+            self._title[1] -= 1
+            if not self._title[1]:
+                self.title = ''.join(self._title[2])
+                self._title = None
+
+        if tag == 'table' and self._table_depth:
+            self._table_depth -= 1
+            if not self._table_depth:
+                self._end_row()
+        elif self._table_depth != 1:
+            pass
+        elif tag == 'tr':
+            self._end_row()
+        elif tag == 'td':
+            self._end_cell()
+        elif tag == 'tt':
+            self._end_tt()
+
+    def data(self, data: str) -> None:
+        self._texts.append(data)
+        if self._title is not None:
+            self._title[2].append(data)
+        if self._cell is not None:
+            self._cell.append(data)
+        if self._tt is not None:
+            self._tt.append(data)
+
+    def close(self) -> 'GuidePage':
+        self._end_row()
+        self.text = ''.join(self._texts)
+        self._texts = []
+        return self
+
+    def _end_tt(self) -> None:
+        if self._tt is not None and self._row is not None:
+            self._row[2][-1] = ''.join(self._tt)
+        self._tt = None
+
+    def _end_cell(self) -> None:
+        if self._cell is None or self._row is None:
+            return
+        self._end_tt()
+        self._row[1].append(''.join(self._cell))
+        self._cell = None
+
+    def _end_row(self) -> None:
+        self._end_cell()
+        self._row = None
+
+
+class _HTMLParserEvents(HTMLParser):
+    """Sends the events of html.parser to a target in the form of lxml."""
+
+    def __init__(self, target: GuidePage) -> None:
+        super().__init__()
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+def read_guide_page(html: str, parser: str = HTML_PARSER) -> GuidePage:
+    page = GuidePage()
+    if parser == 'lxml':
+        lxml_parser = lxml.etree.HTMLParser(target=page)
+        lxml_parser.feed(html)
+        return lxml_parser.close()
+    events = _HTMLParserEvents(page)
+    events.feed(html)
+    events.close()
+    return page.close()
+
+
+# A minimal guides TSV of Crispor, for doctests
+GUIDES_TSV_EXAMPLE = (
+    "#seqId\tguideId\ttargetSeq\tmitSpecScore\tcfdSpecScore\tofftargetCount\t"
+    "targetGenomeGeneLocus\tDoench '16-Score\tMoreno-Mateos-Score\tOut-of-Frame-Score\n"
+    "ATL2\t5forw\tGCTAGGACCCGCCGGCCACCCGG\t85\t90\t12\texon:ATL2\t60\t48\t55\n"
+    "ATL2\t9rev\tCCGGCTCCCGGGAGGTTGATAGG\tNone\tNone\t1000\tintergenic\t40\t51\t50\n"
+)
+
+
+def to_pam_id(guide_id: str) -> str:
+    """
+    The id of a guide in TSV downloads is not the same as on the results page.
+
+    >>> to_pam_id('91forw'), to_pam_id('7rev'), to_pam_id('s5+')
+    ('s91+', 's7-', 's5+')
+    """
+    match = re.fullmatch(r'(\d+)(forw|rev)', guide_id)
+    if not match:
+        return guide_id
+    return 's{}{}'.format(match.group(1), '+' if match.group(2) == 'forw' else '-')
+
+
+def read_tsv(text: str) -> Dict[str, list]:
+    """
+    Columns of a Crispor TSV download by header name, with guide ids as on the
+    results page. Values are strings, as on the results page.
+
+    >>> columns = read_tsv(GUIDES_TSV_EXAMPLE)
+    >>> columns['guideId'], columns['mitSpecScore']
+    (['s5+', 's9-'], ['85', 'None'])
+    >>> list(columns)[:3]
+    ['seqId', 'guideId', 'targetSeq']
+    """
+    reader = csv.reader(io.StringIO(text), delimiter='\t')
+    header = next(reader, [])
+    if not header:
+        raise ValueError('Crispor TSV is empty')
+    header[0] = header[0].lstrip('#')
+    if 'guideId' not in header:
+        raise ValueError('Crispor TSV has no guideId: "{}"'.format(text[:200]))
+    columns = OrderedDict((name, []) for name in header)  # type: Dict[str, list]
+    for row in reader:
+        if not row or row[0].startswith('#'):
+            continue
+        for name, value in zip(header, row):
+            columns[name].append(value)
+    columns['guideId'] = [to_pam_id(g) for g in columns['guideId']]
+    return columns
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,99 @@
+"""
+An asyncio engine for scrape requests.
+
+One event loop runs in a daemon thread for the life of the process. Coroutine
+clients (see AbstractScrapeRequest.arun) run on it, so that waiting on a slow
+service, such as polling Crispresso for minutes, is a cheap timer instead of a
+parked OS thread. Blocking HTTP calls and HTML parsing are handed to a small
+shared pool of threads, which all use the one pooled keep-alive session of
+scraperequest.
+
+Coroutines that are run by a lane of the scheduler take a slot of the lane for
+each blocking call, and hold none while they wait, such as between polls. See
+current_slot.
+
+>>> async def add(a, b):
+...     await asyncio.sleep(0)
+...     return await shared_engine.call(sum, [a, b])
+>>> shared_engine.run(add(1, 2))
+3
+>>> shared_engine.submit(add(3, 4)).result()
+7
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# Max number of blocking calls in flight, summed over all lanes.
+# See scheduler.UPSTREAM_LIMITS.
+IO_WORKERS = 32
+
+# The slot of the lane that runs the current coroutine, if any, which is
+# acquired for each blocking call. See scheduler.Lane.
+current_slot = contextvars.ContextVar('current_slot', default=None)  # type: contextvars.ContextVar
+
+
+class Engine:
+    """
+    There are four public methods: submit, run, call and call_in.
+    """
+
+    def __init__(self, io_workers: int = IO_WORKERS) -> None:
+        self._executor = ThreadPoolExecutor(io_workers, thread_name_prefix='engine-io')
+        self._loop = None  # type: Any
+        self._thread = None  # type: Any
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name='engine-loop', daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def submit(self, coro: Awaitable) -> Future:
+        """Schedule a coroutine on the engine loop from any other thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)  # type: ignore
+
+    def run(self, coro: Awaitable) -> Any:
+        """Block until the coroutine is done. Not for use on the engine loop."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError('Cannot block on the engine loop. Use await.')
+        return self.submit(coro).result()
+
+    async def call(self, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        """Run a blocking function in the shared pool of threads."""
+        return await self.call_in(self._executor, fn, *args, **kwargs)
+
+    async def call_in(self, executor: Executor, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        """
+        Run a blocking function in executor, holding a slot of the lane of the
+        current coroutine meanwhile, if any.
+        """
+        slot = current_slot.get()
+        if slot is not None:
+            await slot.acquire()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            if slot is not None:
+                slot.release()
+
+
+shared_engine = Engine()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
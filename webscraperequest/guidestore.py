@@ -0,0 +1,180 @@
+"""
+A shared store of parsed Crispor guide results, keyed by target sequence,
+genome, PAM and ingest mode. See CRISPOR_INGEST.
+
+The same targets come up again and again across experiments, such as the
+termini of popular genes. Without the store, each repeat is re-read from the
+HTTP cache and re-parsed, or re-fetched once the cache expires. With it, a
+repeat is one indexed lookup. Whether a guide has primers is stored too, once
+pre_filter has checked it.
+
+Results are stored without their target, which is given per request, and only
+if Crispor returned guides. They hold the batch id and urls of a Crispor
+batch, which the mirror purges in time, so they expire after MAX_AGE, like
+pages of Crispor in the HTTP cache. An expired result is a miss, and is
+replaced when the target is requested again. Rows are CrisporGuideResult and CrisporGuide of
+main.models. The store is off without Django settings, such as in doctests, or
+with settings.CRISPOR_RESULT_STORE off. Database errors are logged and treated
+as misses, because the store is only a shortcut.
+
+Functions of the store use the connection of the calling thread, and leave
+it open. From coroutines, run them with call, which closes the connections
+of the worker thread when done.
+
+>>> seq_hash('acgt ') == seq_hash('ACGT')
+True
+"""
+import functools
+import hashlib
+import logging
+import os
+
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Callable, Dict, Optional
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+
+try:
+    from .engine import shared_engine
+except ImportError:
+    # For doctest, which is not run in package context
+    from engine import shared_engine  # type: ignore # noqa
+
+try:
+    from utils.httpcache import DEFAULT_TTL
+except ImportError:
+    # For doctest, which is not run from the project root
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils.httpcache import DEFAULT_TTL
+
+logger = logging.getLogger(__name__)
+
+# Fields of results that are stored, apart from guides
+RESULT_FIELDS = ('url', 'batch_id')
+
+# Seconds that a result is used for. Same as Crispor pages in the HTTP cache.
+MAX_AGE = DEFAULT_TTL
+
+
+def is_enabled() -> bool:
+    try:
+        from django.conf import settings
+        return bool(getattr(settings, 'CRISPOR_RESULT_STORE', False))
+    except ImproperlyConfigured:
+        # For doctest, which runs without Django settings
+        return False
+
+
+def seq_hash(seq: str) -> str:
+    return hashlib.sha256(seq.strip().upper().encode()).hexdigest()
+
+
+async def call(func: Callable, *args) -> Any:
+    """Runs a function of the store on a worker thread of the engine."""
+    return await shared_engine.call(_closing_connections, func, *args)
+
+
+def _closing_connections(func: Callable, *args) -> Any:
+    # Worker threads are not in a request, so nothing else closes them
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+def _db_call(default: Any) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except DatabaseError as e:
+                logger.warning('Crispor result store failed: {}'.format(e))
+                return default
+        return wrapper
+    return decorator
+
+
+def _filter(seq: str, genome: str, pam: str, ingest: str):
+    """Results of the key, expired or not"""
+    from main.models import CrisporGuideResult
+    return CrisporGuideResult.objects.filter(
+        seq_hash=seq_hash(seq), genome=genome, pam=pam, ingest=ingest)
+
+
+def _fresh(seq: str, genome: str, pam: str, ingest: str):
+    return _filter(seq, genome, pam, ingest).filter(
+        create_time__gte=timezone.now() - timedelta(seconds=MAX_AGE))
+
+
+@_db_call(default=False)
+def has(seq: str, genome: str, pam: str, ingest: str) -> bool:
+    return _fresh(seq, genome, pam, ingest).exists()
+
+
+@_db_call(default=None)
+def load(seq: str, genome: str, pam: str, ingest: str) -> Optional[Dict[str, Any]]:
+    """
+    Stored data like that of CrisporGuideRequest._extract_guides, but without
+    target and download urls, and with has_primers by guide id where known.
+    """
+    result = _fresh(seq, genome, pam, ingest).prefetch_related('guides').first()
+    if result is None:
+        return None
+    guides = list(result.guides.all())
+    data = dict(
+        url=result.url,
+        batch_id=result.batch_id,
+        guide_seqs=OrderedDict((g.pam_id, g.guide_seq) for g in guides),
+        scores=OrderedDict(
+            (g.pam_id, [g.specificity, g.efficiency, g.out_of_frame]) for g in guides),
+        primer_urls=OrderedDict((g.pam_id, g.primer_url) for g in guides),
+        has_primers=dict((g.pam_id, g.has_primers) for g in guides if g.has_primers is not None),
+    )  # type: Dict[str, Any]
+    if result.score_columns is not None:
+        data['score_columns'] = result.score_columns
+    return data
+
+
+@_db_call(default=None)
+def save(seq: str, genome: str, pam: str, ingest: str, data: Dict[str, Any]) -> None:
+    """Replaces any stored result of the same key, expired or not."""
+    from main.models import CrisporGuide, CrisporGuideResult
+    with transaction.atomic(using=CrisporGuideResult.objects.db):
+        _filter(seq, genome, pam, ingest).delete()
+        result = CrisporGuideResult.objects.create(
+            seq_hash=seq_hash(seq),
+            seq=seq,
+            genome=genome,
+            pam=pam,
+            ingest=ingest,
+            score_columns=data.get('score_columns'),
+            **dict((f, data[f]) for f in RESULT_FIELDS))
+        CrisporGuide.objects.bulk_create([
+            CrisporGuide(
+                result=result,
+                rank=rank,
+                pam_id=pam_id,
+                guide_seq=guide_seq,
+                specificity=data['scores'][pam_id][0],
+                efficiency=data['scores'][pam_id][1],
+                out_of_frame=data['scores'][pam_id][2],
+                primer_url=data['primer_urls'][pam_id],
+            )
+            for rank, (pam_id, guide_seq) in enumerate(data['guide_seqs'].items())
+        ])
+
+
+@_db_call(default=None)
+def save_primer_checks(seq: str, genome: str, pam: str, ingest: str, checks: Dict[str, bool]) -> None:
+    from main.models import CrisporGuide
+    result_ids = _filter(seq, genome, pam, ingest).values('id')
+    for has_primers in (True, False):
+        CrisporGuide.objects.filter(
+            result__in=result_ids,
+            pam_id__in=[g for g, checked in checks.items() if checked is has_primers],
+        ).update(has_primers=has_primers)
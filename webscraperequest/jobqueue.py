@@ -0,0 +1,346 @@
+"""
+A durable, restartable queue for batch web requests.
+
+When settings.DURABLE_BATCH_JOBS is on, BaseBatchWebRequest.start persists one
+BatchJob row per request instead of running threads in the web process. One or
+more `manage.py runworker` processes claim jobs with a lease, run them on the
+shared scheduler, and write results into the model instance.
+
+Claiming is a conditional UPDATE, so it is safe with many workers on postgres
+and on the local SQLite stand-in. Leases are renewed while a job runs. If a
+worker dies, its leases expire and the jobs are claimed again by another
+worker, unless that was the last attempt. Failed jobs are retried with
+backoff, up to BatchJob.max_attempts. Only the worker that holds the lease of a
+job may finish it.
+Requests that ask to be retried later, see RetryLater, keep their lease and
+are queued again on the shared scheduler when due, without holding a lane slot
+meanwhile.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+try:
+    from .engine import shared_engine
+    from .resultwriter import update_elements
+    from .scheduler import shared_scheduler
+    from .scraperequest import RetryLater
+except ImportError:
+    # For doctest, which is not run in package context
+    from engine import shared_engine  # type: ignore # noqa
+    from resultwriter import update_elements  # type: ignore # noqa
+    from scheduler import shared_scheduler  # type: ignore # noqa
+    from scraperequest import RetryLater  # type: ignore # noqa
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 120
+POLL_SECONDS = 2
+BACKOFF_SECONDS = 60
+
+
+def use_durable_queue() -> bool:
+    try:
+        from django.conf import settings
+        return bool(getattr(settings, 'DURABLE_BATCH_JOBS', False))
+    except ImproperlyConfigured:
+        # For doctest, which runs without Django settings
+        return False
+
+
+def enqueue(batch: Any, largs: List[list]) -> None:
+    """Persist one job per args of a batch. See BaseBatchWebRequest.start."""
+    from main.models import BatchJob
+    instance = batch.model_instance
+    BatchJob.objects.bulk_create([
+        BatchJob(
+            batch_class=batch.__class__.__name__,
+            model_label=instance._meta.label,
+            object_id=instance.pk,
+            index=i,
+            args=json.dumps(args, default=str),
+            user_id=getattr(instance, 'owner_id', None),
+        )
+        for i, args in enumerate(largs)
+    ])
+    logger.info('{} jobs queued for {}'.format(len(largs), instance))
+
+
+def get_batch_class(name: str) -> type:
+    try:
+        from .batchrequest import BaseBatchWebRequest
+    except ImportError:
+        from batchrequest import BaseBatchWebRequest  # type: ignore
+
+    def subclasses(cls):
+        for sub in cls.__subclasses__():
+            yield sub
+            yield from subclasses(sub)
+
+    for cls in subclasses(BaseBatchWebRequest):
+        if cls.__name__ == name:
+            return cls
+    raise ValueError('Unknown batch class: "{}"'.format(name))
+
+
+def _claimable() -> Q:
+    now = timezone.now()
+    from main.models import BatchJob
+    return (Q(state=BatchJob.QUEUED, run_after__lte=now) |
+            Q(state=BatchJob.RUNNING, lease_expires__lt=now, attempts__lt=F('max_attempts')))
+
+
+def _exhausted() -> Q:
+    """Jobs whose worker died on their last attempt, such as by a crash"""
+    from main.models import BatchJob
+    return Q(state=BatchJob.RUNNING, lease_expires__lt=timezone.now(),
+             attempts__gte=F('max_attempts'))
+
+
+def fail_exhausted() -> int:
+    """
+    Fail jobs that were lost on their last attempt, instead of claiming them
+    again, so that a job that keeps crashing its worker is not retried forever.
+    Returns the number failed.
+    """
+    from main.models import BatchJob
+    failed = 0
+    for job in BatchJob.objects.filter(_exhausted()):
+        error = 'Lost after {} attempts'.format(job.attempts)
+        # Conditional, in case another worker got there first
+        if not BatchJob.objects.filter(_exhausted(), id=job.id).update(
+                state=BatchJob.FAILED, lease_expires=None, error=error):
+            continue
+        failed += 1
+        logger.warning('{} failed: {}'.format(job, error))
+        try:
+            field_name = str(get_batch_class(job.batch_class).field_name)
+            _write_result(job, field_name, {
+                'success': False, 'error': error, 'end_time': int(time.time())})
+        except Exception as e:
+            logger.exception(e)
+    return failed
+
+
+def claim(worker_id: str, limit: int = 1) -> list:
+    """
+    Claim up to limit jobs. Each candidate is claimed by a conditional update,
+    so a job that is claimed concurrently by another worker is skipped.
+    """
+    from main.models import BatchJob
+    fail_exhausted()
+    candidates = list(BatchJob.objects
+                      .filter(_claimable())
+                      .order_by('run_after', 'id')
+                      .values_list('id', flat=True)[:limit * 2])
+    claimed = []
+    for job_id in candidates:
+        if len(claimed) >= limit:
+            break
+        updated = BatchJob.objects.filter(_claimable(), id=job_id).update(
+            state=BatchJob.RUNNING,
+            lease_owner=worker_id,
+            lease_expires=timezone.now() + timedelta(seconds=LEASE_SECONDS),
+            attempts=F('attempts') + 1,
+        )
+        if updated:
+            claimed.append(BatchJob.objects.get(id=job_id))
+    return claimed
+
+
+def _write_result(job: Any, field_name: str, result: Dict[str, Any]) -> None:
+    """
+    Only the element of the job is written. See resultwriter. The write is not
+    deferred, so that a job is never marked done before its result is saved.
+    """
+    model = apps.get_model(job.model_label)
+    update_elements(model, job.object_id, field_name, {job.index: result})
+
+
+class Worker:
+    """
+    Claims jobs and runs them on the shared scheduler, keeping at most
+    `concurrency` jobs in flight.
+
+    There are three public methods: run_forever, run_once and renew_leases.
+    """
+
+    def __init__(self, concurrency: int = 16, worker_id: str = '') -> None:
+        self.concurrency = concurrency
+        self.worker_id = worker_id or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._in_flight = {}  # type: Dict[int, Any]
+        self._lock = threading.Lock()
+
+    def run_forever(self) -> None:
+        logger.info('Worker {} started'.format(self.worker_id))
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        while True:
+            close_old_connections()
+            if not self.run_once():
+                time.sleep(POLL_SECONDS)
+
+    def run_once(self) -> int:
+        """Claim jobs for free slots and start them. Returns the number started."""
+        with self._lock:
+            free = self.concurrency - len(self._in_flight)
+        if free <= 0:
+            return 0
+        jobs = claim(self.worker_id, free)
+        for job in jobs:
+            self._start(job)
+        return len(jobs)
+
+    @property
+    def num_in_flight(self) -> int:
+        with self._lock:
+            return len(self._in_flight)
+
+    def _start(self, job: Any) -> None:
+        with self._lock:
+            self._in_flight[job.id] = job
+        try:
+            batch_class = get_batch_class(job.batch_class)
+        except Exception as e:
+            # There is no field to write the error to
+            logger.exception(e)
+            self._finish(job, batch_class=None, error=e, retry=False)
+            return
+        try:
+            requester = batch_class.requester(*json.loads(job.args))
+        except Exception as e:
+            # Bad args, such as a missing FASTQ, will never succeed
+            logger.exception(e)
+            self._finish(job, batch_class, error=e, retry=False)
+            return
+        requester.user = job.user_id
+        # Coroutine clients hold a lane slot only for each call. See scheduler.
+        if requester.is_async():
+            requester.defer_retries = True
+            run, call = self._arun, requester.arun_coalesced
+        else:
+            run, call = self._run, requester.run_coalesced
+        shared_scheduler.submit(
+            batch_class.lane,
+            run, job, batch_class, call,
+            user=job.user_id,
+            group=(job.model_label, job.object_id),
+        )
+
+    def _run(self, job: Any, batch_class: type, run: Callable) -> None:
+        logger.info('Running {} attempt {}'.format(job, job.attempts))
+        try:
+            result = run()
+        except Exception as e:
+            logger.warning('{} failed: {}'.format(job, e))
+            self._finish(job, batch_class, error=e)
+        else:
+            self._finish(job, batch_class, result=result)
+        finally:
+            close_old_connections()
+
+    async def _arun(self, job: Any, batch_class: Any, arun: Callable[[], Awaitable]) -> None:
+        logger.info('Running {} attempt {}'.format(job, job.attempts))
+        try:
+            result = await arun()
+        except RetryLater as e:
+            logger.info('{} retry {} in {}s: {}'.format(job, e.retries, e.delay, e.reason))
+            shared_scheduler.submit_later(
+                e.delay,
+                batch_class.lane,
+                self._arun, job, batch_class, e.resume,
+                user=job.user_id,
+                group=(job.model_label, job.object_id),
+            )
+            # The job keeps its lease, so only the status is written
+            await shared_engine.call(_write_result, job, str(batch_class.field_name), e.status)
+        except Exception as e:
+            logger.warning('{} failed: {}'.format(job, e))
+            await shared_engine.call(self._finish, job, batch_class, error=e)
+        else:
+            await shared_engine.call(self._finish, job, batch_class, result=result)
+
+    def _finish(self,
+                job: Any,
+                batch_class: Any,
+                result: dict = None,
+                error: Exception = None,
+                retry: bool = True) -> None:
+        from main.models import BatchJob
+        try:
+            # ValueError is raised for bad input, which will never succeed
+            if error is not None and not isinstance(error, ValueError) and \
+                    retry and job.attempts < job.max_attempts:
+                delay = BACKOFF_SECONDS * job.attempts
+                BatchJob.objects.filter(id=job.id, lease_owner=self.worker_id).update(
+                    state=BatchJob.QUEUED,
+                    run_after=timezone.now() + timedelta(seconds=delay),
+                    lease_expires=None,
+                    error=str(error),
+                )
+                logger.info('{} retrying in {}s'.format(job, delay))
+                return
+
+            if error is not None:
+                result = {
+                    'success': False,
+                    'error': getattr(error, 'message', str(error)),
+                }
+            else:
+                result = dict(result)  # type: ignore
+                result['success'] = result.get('success', True)
+            result['end_time'] = int(time.time())
+            owned = BatchJob.objects.filter(
+                id=job.id, state=BatchJob.RUNNING, lease_owner=self.worker_id)
+            if not owned.exists():
+                # The lease expired and another worker claimed the job
+                logger.warning('{} lost its lease, so its result is dropped'.format(job))
+                return
+            if batch_class is not None:
+                _write_result(job, str(batch_class.field_name), result)
+            owned.update(
+                state=BatchJob.DONE if result['success'] else BatchJob.FAILED,
+                lease_expires=None,
+                error=result.get('error', ''),
+            )
+        except Exception as e:
+            # The lease will expire and the job will be claimed again
+            logger.exception(e)
+        finally:
+            with self._lock:
+                self._in_flight.pop(job.id, None)
+
+    def renew_leases(self) -> int:
+        """
+        Renew leases of running jobs so that other workers leave them alone.
+        Returns the number renewed.
+        """
+        from main.models import BatchJob
+        with self._lock:
+            ids = list(self._in_flight)
+        if not ids:
+            return 0
+        return BatchJob.objects.filter(
+            id__in=ids, state=BatchJob.RUNNING, lease_owner=self.worker_id,
+        ).update(lease_expires=timezone.now() + timedelta(seconds=LEASE_SECONDS))
+
+    def _heartbeat(self) -> None:
+        while True:
+            time.sleep(LEASE_SECONDS / 3)
+            try:
+                self.renew_leases()
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                close_old_connections()
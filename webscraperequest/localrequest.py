@@ -0,0 +1,220 @@
+"""
+Requests that are served in process instead of by a web service, with the
+same interface and results as the scrape requests they replace.
+
+LocalPrimerRequest designs primers with Primer3 in a pool of processes,
+instead of asking Crispor, which runs Primer3 for us behind a queue shared with
+guide design. Only the template sequence is fetched, through the cached
+conversions.chr_loc_to_seq. See settings.PRIMER_DESIGN_BACKEND.
+
+LocalCrispressoRequest quantifies editing outcomes with crispresso.quantify in
+the same pool, instead of uploading fastqs to Crispresso, which runs 3 reports
+at a time. See settings.CRISPRESSO_BACKEND.
+"""
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+import urllib.parse
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional
+
+try:
+    from .engine import shared_engine
+    from .scraperequest import NOT_FOUND, AbstractScrapeRequest
+except ImportError:
+    # For doctest, which is not run in package context
+    from engine import shared_engine  # type: ignore # noqa
+    from scraperequest import NOT_FOUND, AbstractScrapeRequest  # type: ignore # noqa
+
+from crispresso import quantify
+from utils import conversions, primerdesign
+from utils.chrloc import ChrLoc, GuideChrLoc
+
+logger = logging.getLogger(__name__)
+
+# Primer3 and quantification are CPU bound, so one process per core
+PRIMER3_PROCESSES = os.cpu_count() or 2
+
+UCSC_BROWSER_URL = 'https://genome.ucsc.edu/cgi-bin/hgTracks'
+
+_pool = None  # type: Optional[ProcessPoolExecutor]
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawn, because forking a threaded web process is unsafe
+            _pool = ProcessPoolExecutor(
+                PRIMER3_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+class LocalPrimerRequest(AbstractScrapeRequest):
+    """
+    Gets primers for a guide from Primer3. Results are like those of
+    CrisporPrimerRequest, with a genome browser url of the template instead of
+    a Crispor url.
+
+    >>> req = LocalPrimerRequest('chr1:11130540-11130751:+', 'chr1:11130600-11130619:+', hdr_dist=-5)
+    >>> str(req.template_loc)
+    'chr1:11130367-11130867:+'
+    >>> req.cache_key
+    'primer3:chr1:11130367-11130867:+?genome=hg38&cut=250&hdr_dist=-5&amp_len=250&tm=60'
+    >>> req.in_cache()
+    False
+    """
+
+    def __init__(
+            self,
+            target_loc: str,
+            guide_loc: str,
+            genome: str = 'hg38',
+            amp_len: int = 250,
+            tm: int = 60,
+            target: str = '',
+            hdr_dist: int = None) -> None:
+
+        self.template_loc = primerdesign.get_template_loc(
+            ChrLoc(target_loc), GuideChrLoc(guide_loc), amp_len)
+        self.genome = genome
+        # Template is centered on the cut on either strand
+        self.cut = amp_len
+        self.hdr_dist = hdr_dist
+        self.amp_len = amp_len
+        self.tm = tm
+        self.target = target  # just for metadata
+
+        self.endpoint = 'primer3:{}?'.format(self.template_loc) + urllib.parse.urlencode([
+            ('genome', genome),
+            ('cut', self.cut),
+            ('hdr_dist', hdr_dist),
+            ('amp_len', amp_len),
+            ('tm', tm),
+        ])
+
+    def __repr__(self):
+        return 'LocalPrimerRequest({})'.format(self.endpoint)
+
+    @property
+    def cache_key(self):
+        """For coalescing only. Results are not cached, but templates are."""
+        return self.endpoint
+
+    def in_cache(self) -> bool:
+        return False
+
+    def run(self) -> Dict[str, Any]:
+        return shared_engine.run(self.arun())
+
+    async def arun(self) -> Dict[str, Any]:
+        template = await shared_engine.call(
+            conversions.chr_loc_to_seq, str(self.template_loc), self.genome)
+        primers = await shared_engine.call_in(
+            _get_pool(),
+            functools.partial(
+                primerdesign.design_primers,
+                template, self.cut, self.hdr_dist, self.amp_len, self.tm))
+        return dict(
+            target=self.target,
+            url=UCSC_BROWSER_URL + '?' + urllib.parse.urlencode([
+                ('db', self.genome),
+                ('position', 'chr{}:{}-{}'.format(
+                    self.template_loc.chr, self.template_loc.start, self.template_loc.end)),
+            ]),
+            template_loc=str(self.template_loc),
+            # Like Crispor when Primer3 finds nothing
+            ontarget_primers=primers or [NOT_FOUND],
+        )
+
+
+class LocalCrispressoRequest(AbstractScrapeRequest):
+    """
+    Quantifies editing outcomes of a pair of fastqs in process. Takes the same
+    args as CrispressoRequest, and returns the same stats, but no report. trim
+    is not used, because adapters are cut off by merging pairs of reads.
+
+    >>> amplicon = 'cgaggagatacaggcggagggcgaggagatacaggcggagggcgaggagatacaggcggagagcgGCGCTAGGACCCGCCGGCCACCCCGCCGGCTCCCGGGAGGTTGATAAAGCGGCGGCGGCGTTTGACGTCAGTGGGGAGTTAATTTTAAATCGGTACAAGATGGCGGAGGGGGACGAGGCAGCGCGAGGGCAGCAACCGCACCAGGGGCTGTGGCGCCGGCGACGGACCAGCGACCCAAGCGCCGCGGTTAACCACGTCTCGTCCAC'
+    >>> sgRNA = 'AATCGGTACAAGATGGCGGA'
+    >>> fastq_r1 = '../crispresso/fastqs/A1-ATL2-N-sorted-180212_S1_L001_R1_001.fastq.gz'
+    >>> fastq_r2 = '../crispresso/fastqs/A1-ATL2-N-sorted-180212_S1_L001_R2_001.fastq.gz'
+    >>> req = LocalCrispressoRequest(amplicon, sgRNA, fastq_r1, fastq_r2, 'TruSeq3-PE.fa')
+    >>> req.cache_key.startswith('quantify:')
+    True
+    """
+
+    def __init__(self,
+                 amplicon: str,
+                 sgRNA: str,
+                 fastq_r1: str,
+                 fastq_r2: str,
+                 trim: str,
+                 amplicon_seq_after_hdr: str = '',
+                 optional_name: str = '') -> None:
+        self.amplicon = amplicon
+        self.sgRNA = sgRNA
+        self.fastq_r1 = fastq_r1
+        self.fastq_r2 = fastq_r2
+        self.amplicon_seq_after_hdr = amplicon_seq_after_hdr
+        self.optional_name = optional_name
+        # Like the fields of the Crispresso form, for display of inputs
+        self.data = {
+            'amplicon': amplicon,
+            'sgRNA': sgRNA,
+            'hdr_seq': amplicon_seq_after_hdr,
+            'optional_name': optional_name,
+            'optradio_trim': trim,
+            'optradio_wc': str(quantify.WINDOW_CENTER),
+            'optradio_ws': str(quantify.WINDOW_SIZE),
+            'optradio_hs': str(quantify.MIN_HOMOLOGY),
+        }
+        self.endpoint = 'quantify:' + urllib.parse.urlencode([
+            ('amplicon', amplicon),
+            ('sgRNA', sgRNA),
+            ('hdr_seq', amplicon_seq_after_hdr),
+            ('fastq_r1', fastq_r1),
+            ('fastq_r2', fastq_r2),
+        ])
+
+    def __repr__(self):
+        return 'LocalCrispressoRequest({}, {})'.format(self.fastq_r1, self.fastq_r2)
+
+    @property
+    def cache_key(self):
+        """For coalescing only. Results are not cached."""
+        return self.endpoint
+
+    def in_cache(self) -> bool:
+        return False
+
+    def run(self) -> Dict[str, Any]:
+        return shared_engine.run(self.arun())
+
+    async def arun(self) -> Dict[str, Any]:
+        report_stats = await shared_engine.call_in(
+            _get_pool(),
+            functools.partial(
+                quantify.quantify,
+                self.amplicon, self.sgRNA, self.fastq_r1, self.fastq_r2,
+                self.amplicon_seq_after_hdr))
+        return {
+            'report_url': '',
+            'report_zip': '',
+            'log_params': 'crispycrunch quantify ' + ' '.join(
+                '--{}={}'.format(name, value) for name, value in sorted(self.data.items()) if value),
+            'report_files': [],
+            'report_stats': report_stats,
+            'input_data': self.data,
+            'input_files': [self.fastq_r1, self.fastq_r2],
+            # Keep for display of custom analysis
+            'optional_name': self.optional_name,
+        }
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,324 @@
+"""
+Routing of requests to Crispor and Crispresso over pools of mirrors.
+
+The base URL of each service is the first mirror of its pool. Clients build
+URLs on it, and responses are cached by them, no matter which mirror answers.
+MirrorAdapter, mounted on a base URL, sends each request to one mirror:
+
+* of those with a batch or report of the request, if any. Batches and reports
+  exist only on the mirror that made them, unless mirrors share storage.
+  See MirrorPool.affinity.
+* of those that are healthy, by probes every PROBE_SECONDS and by errors
+* with the fewest outstanding requests
+
+Slow idempotent GETs, such as primer pages, are hedged: if there is no
+response after HEDGE_SECONDS, the request is also sent to a second mirror,
+and the first good response wins.
+
+With one mirror, requests are sent as is. Configure with environment
+variables:
+
+CRISPOR_MIRRORS: base URLs of Crispor, separated by commas
+CRISPRESSO_MIRRORS: base URLs of Crispresso, separated by commas
+MIRRORS_SHARED: '1' if the mirrors of a service share batches and reports
+MIRRORS_HEDGE_SECONDS: default 10
+
+>>> pool = MirrorPool('test', ['http://a/crispor.py', 'http://b/crispor.py'],
+...                   affinity=r'batchId=(\\w+)', hedge=r'pamId=')
+>>> pool.rewrite('http://a/crispor.py?batchId=x1', pool.mirrors[1])
+'http://b/crispor.py?batchId=x1'
+>>> pool.affinity_key('http://a/crispor.py?batchId=x1&pamId=s1%2B')
+'x1'
+>>> pool.mirrors[0].outstanding = 2
+>>> pool.choose(None).base_url
+'http://b/crispor.py'
+>>> pool.remember('x1', pool.mirrors[0])
+>>> pool.choose('x1').base_url
+'http://a/crispor.py'
+>>> pool.is_hedged('GET', 'http://a/crispor.py?batchId=x1&pamId=s1%2B')
+True
+"""
+import logging
+import os
+import re
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional
+
+import requests
+
+try:
+    from utils.ratelimit import RateLimitedAdapter
+except ImportError:
+    # For doctest, which is not run from the project root
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils.ratelimit import RateLimitedAdapter
+
+logger = logging.getLogger(__name__)
+
+
+def _from_env(name: str, default: str) -> List[str]:
+    return [url.strip().rstrip('/') for url in os.environ.get(name, default).split(',')
+            if url.strip()]
+
+
+CRISPOR_MIRRORS = _from_env(
+    'CRISPOR_MIRRORS', 'http://ec2-34-219-237-20.us-west-2.compute.amazonaws.com/crispor.py')
+CRISPRESSO_MIRRORS = _from_env(
+    'CRISPRESSO_MIRRORS', 'http://ec2-34-219-237-20.us-west-2.compute.amazonaws.com:81')
+MIRRORS_SHARED = os.environ.get('MIRRORS_SHARED', '0') == '1'
+
+HEDGE_SECONDS = float(os.environ.get('MIRRORS_HEDGE_SECONDS', 10))
+PROBE_SECONDS = 30
+PROBE_TIMEOUT = 10
+# Consecutive errors after which a mirror is unhealthy until its next good probe
+MAX_FAILURES = 3
+
+# For hedged requests, which wait on each other
+_hedge_executor = ThreadPoolExecutor(16, thread_name_prefix='mirror-hedge')
+
+
+class Mirror:
+
+    def __init__(self, base_url: str) -> None:
+        self.base_url = base_url
+        self.outstanding = 0
+        # Requests ever sent, so that ties go round-robin
+        self.sent = 0
+        self.healthy = True
+        self.failures = 0
+
+    def __repr__(self):
+        return 'Mirror({}, outstanding={}, healthy={})'.format(
+            self.base_url, self.outstanding, self.healthy)
+
+
+class MirrorPool:
+    """
+    Mirrors of one service, and which of them has which batch or report.
+
+    affinity is a regex of URLs, response headers and POST responses, whose
+    first group is the id of a batch or report. Requests with an id go only to
+    mirrors that are known to have it. Ids are kept in store, if given, with
+    get_route and put_route like httpcache stores, so that all processes route
+    them the same way, and cache expiry and eviction do not forget them.
+
+    hedge is a regex of URLs of idempotent GETs that may be hedged.
+
+    There are five public methods for routing: choose, rewrite, affinity_key,
+    remember and is_hedged. There are four for health: started, finished,
+    probe and ensure_probing.
+    """
+
+    def __init__(self,
+                 name: str,
+                 base_urls: List[str],
+                 affinity: str = None,
+                 hedge: str = None,
+                 health_path: str = '',
+                 store: Any = None) -> None:
+        assert base_urls, 'Must have a mirror'
+        self.name = name
+        self.mirrors = [Mirror(url) for url in base_urls]
+        self.base_url = self.mirrors[0].base_url
+        self.affinity = re.compile(affinity) if affinity else None
+        self.hedge = re.compile(hedge) if hedge else None
+        self.health_path = health_path
+        self.store = store
+        self._affinities = {}  # type: Dict[str, List[Mirror]]
+        self._lock = threading.Lock()
+        self._prober = None  # type: Optional[threading.Thread]
+
+    def __len__(self) -> int:
+        return len(self.mirrors)
+
+    def choose(self, key: Optional[str], exclude: List[Mirror] = []) -> Optional[Mirror]:
+        """The least busy healthy mirror that has key, or None if none is left."""
+        with self._lock:
+            candidates = self._with_key(key) if key else self.mirrors
+            candidates = [m for m in candidates if m not in exclude]
+            # Better an unhealthy mirror than none
+            healthy = [m for m in candidates if m.healthy] or candidates
+            if not healthy:
+                return None
+            return min(healthy, key=lambda m: (m.outstanding, m.sent))
+
+    def _with_key(self, key: str) -> List[Mirror]:
+        """Must hold lock."""
+        if key not in self._affinities and self.store is not None:
+            base_url = self.store.get_route(self._store_key(key))
+            mirrors = [m for m in self.mirrors if m.base_url == base_url]
+            if mirrors:
+                self._affinities[key] = mirrors
+        # Unknown ids go to the first mirror, like before there were mirrors
+        return self._affinities.get(key, self.mirrors[:1])
+
+    def _store_key(self, key: str) -> str:
+        return 'mirror:{}:{}'.format(self.name, key)
+
+    def rewrite(self, url: str, mirror: Mirror) -> str:
+        if not url.startswith(self.base_url):
+            return url
+        return mirror.base_url + url[len(self.base_url):]
+
+    def affinity_key(self, text: Optional[str]) -> Optional[str]:
+        if self.affinity is None or not text:
+            return None
+        match = self.affinity.search(text)
+        if match is None:
+            return None
+        return next((g for g in match.groups() if g), None)
+
+    def remember(self, key: str, mirror: Mirror) -> None:
+        """mirror has the batch or report key"""
+        with self._lock:
+            mirrors = self._affinities.setdefault(key, [])
+            if mirror in mirrors:
+                return
+            mirrors.append(mirror)
+        if self.store is not None:
+            self.store.put_route(self._store_key(key), mirror.base_url)
+
+    def is_hedged(self, method: str, url: str) -> bool:
+        return method == 'GET' and self.hedge is not None and bool(self.hedge.search(url))
+
+    def started(self, mirror: Mirror) -> None:
+        with self._lock:
+            mirror.outstanding += 1
+            mirror.sent += 1
+
+    def finished(self, mirror: Mirror, ok: bool) -> None:
+        with self._lock:
+            mirror.outstanding -= 1
+            mirror.failures = 0 if ok else mirror.failures + 1
+            if mirror.failures >= MAX_FAILURES and mirror.healthy:
+                logger.warning('Mirror {} is unhealthy after {} errors'.format(
+                    mirror.base_url, mirror.failures))
+                mirror.healthy = False
+
+    def probe(self) -> None:
+        """Check the health of each mirror"""
+        for mirror in self.mirrors:
+            try:
+                healthy = requests.get(
+                    mirror.base_url + self.health_path, timeout=PROBE_TIMEOUT).status_code < 500
+            except requests.RequestException:
+                healthy = False
+            with self._lock:
+                if healthy != mirror.healthy:
+                    logger.info('Mirror {} is {}'.format(
+                        mirror.base_url, 'healthy' if healthy else 'unhealthy'))
+                mirror.healthy = healthy
+                if healthy:
+                    mirror.failures = 0
+
+    def ensure_probing(self) -> None:
+        with self._lock:
+            if self._prober is not None:
+                return
+            self._prober = threading.Thread(
+                target=self._probe_forever, name='mirror-probe-' + self.name, daemon=True)
+            self._prober.start()
+
+    def _probe_forever(self) -> None:
+        while True:
+            time.sleep(PROBE_SECONDS)
+            try:
+                self.probe()
+            except Exception as e:
+                logger.exception(e)
+
+
+class MirrorAdapter(RateLimitedAdapter):
+    """
+    Sends requests for the base URL of a pool to one of its mirrors. Mount it
+    on the base URL.
+    """
+
+    def __init__(self, pool: MirrorPool, *args, **kwargs) -> None:
+        self.pool = pool
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):  # type: ignore
+        if len(self.pool) == 1:
+            return super().send(request, **kwargs)
+        self.pool.ensure_probing()
+
+        key = self.pool.affinity_key(request.url)
+        mirror = self.pool.choose(key)
+        if self.pool.is_hedged(request.method, request.url):
+            return self._send_hedged(request, key, mirror, **kwargs)
+        return self._send_to(mirror, request, **kwargs)
+
+    def _send_to(self, mirror: Mirror, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        routed = request.copy()
+        routed.url = self.pool.rewrite(request.url, mirror)
+        self.pool.started(mirror)
+        try:
+            response = super().send(routed, **kwargs)
+        except requests.RequestException:
+            self.pool.finished(mirror, ok=False)
+            raise
+        self.pool.finished(mirror, ok=response.status_code < 500)
+
+        # New batches and reports are in redirects, or in the page of a POST
+        texts = [response.headers.get('Location')]
+        if request.method == 'POST' and not kwargs.get('stream'):
+            texts.append(response.text)
+        for text in texts:
+            key = self.pool.affinity_key(text)
+            if key:
+                self.pool.remember(key, mirror)
+                break
+        return response
+
+    def _send_hedged(self,
+                     request: requests.PreparedRequest,
+                     key: Optional[str],
+                     mirror: Mirror,
+                     **kwargs) -> requests.Response:
+        futures = [_hedge_executor.submit(self._send_to, mirror, request, **kwargs)]
+        if not wait(futures, timeout=HEDGE_SECONDS).done:
+            second = self.pool.choose(key, exclude=[mirror])
+            if second is not None:
+                logger.info('Hedging {} to {}'.format(request.url, second.base_url))
+                futures.append(_hedge_executor.submit(self._send_to, second, request, **kwargs))
+
+        pending = list(futures)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                if _is_good(future):
+                    _close_losers(futures, future)
+                    return future.result()
+        # No good response, so the first as is
+        _close_losers(futures, futures[0])
+        return futures[0].result()
+
+
+def _is_good(future: Future) -> bool:
+    return future.exception() is None and future.result().status_code == 200
+
+
+def _close_losers(futures: List[Future], winner: Future) -> None:
+    """
+    Responses of the other futures are closed when they come, so that their
+    connections go back to the pool.
+    """
+    for future in futures:
+        if future is not winner:
+            future.add_done_callback(_close_response)
+
+
+def _close_response(future: Future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,61 @@
+"""
+Notifies waiting progress streams when batch results are written, so that they
+can re-read the results at once instead of polling on a timer.
+
+Keys are (model name, pk, field name). Each key has a version that goes up on
+every write. A waiter passes the last version it saw and wakes when it changes.
+
+Results written by worker processes (see jobqueue) are not seen by this
+process, so waiters should also re-read on timeout.
+
+>>> hub = ProgressHub()
+>>> key = ('GuideDesign', 1, 'guide_data')
+>>> hub.version(key)
+0
+>>> hub.publish(key)
+>>> hub.wait(key, 0, timeout=0)
+1
+>>> hub.wait(key, 1, timeout=0.01)
+1
+"""
+import logging
+import threading
+
+from typing import Any, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+Key = Tuple[str, Any, str]
+
+
+class ProgressHub:
+    """
+    There are three public methods: version, publish and wait.
+    """
+
+    def __init__(self) -> None:
+        self._versions = {}  # type: Dict[Key, int]
+        self._cond = threading.Condition()
+
+    def version(self, key: Key) -> int:
+        with self._cond:
+            return self._versions.get(key, 0)
+
+    def publish(self, key: Key) -> None:
+        with self._cond:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._cond.notify_all()
+
+    def wait(self, key: Key, version: int, timeout: float) -> int:
+        """Block until the version of key is not the given version, or timeout."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._versions.get(key, 0) != version, timeout)
+            return self._versions.get(key, 0)
+
+
+shared_hub = ProgressHub()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
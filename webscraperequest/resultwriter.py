@@ -0,0 +1,199 @@
+"""
+Writes results of batch web requests into a JSON list field of a model instance.
+
+Instead of re-saving the whole instance on every completion, only the changed
+elements are written, with one targeted jsonb_set UPDATE per instance.
+Completions that land within a short window are coalesced into one write, so
+the number and size of writes stay flat as plates grow.
+
+On databases other than postgres, writes fall back to a locked read-modify-write.
+Objects that are not saved model instances, such as mocks in doctests, are
+simply saved.
+
+Waiting progress streams are notified after each write. See progress.
+
+>>> writer = ResultWriter(window=0)
+>>> writer._merge({}, 3, {'success': True})
+{3: {'success': True}}
+>>> writer._merge({3: {'a': 1}}, 3, {'b': 2})
+{3: {'a': 1, 'b': 2}}
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, connections, models, router, transaction
+from django.utils import timezone
+
+try:
+    from .progress import shared_hub
+except ImportError:
+    # For doctest, which is not run in package context
+    from progress import shared_hub  # type: ignore # noqa
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for more completions before writing
+WRITE_WINDOW = 0.5
+# Failed writes of the same updates before they are dropped
+MAX_WRITE_ATTEMPTS = 5
+
+
+def update_elements(model: type, pk: Any, field_name: str, updates: Dict[int, dict]) -> None:
+    """
+    Merge each dict of updates into the element at its index of a JSON list
+    field, in one statement. Elements that are not in updates are not touched.
+    """
+    db = router.db_for_write(model)
+    connection = connections[db]
+    if connection.vendor != 'postgresql':
+        return _update_elements_locked(model, pk, field_name, updates)
+
+    qn = connection.ops.quote_name
+    column = qn(model._meta.get_field(field_name).column)
+    expr = column
+    params = []  # type: list
+    for index, result in sorted(updates.items()):
+        # COALESCE because jsonb_set returns NULL when given NULL
+        expr = "jsonb_set({}, %s::text[], COALESCE({} -> %s, '{{}}'::jsonb) || %s::jsonb)".format(
+            expr, column)
+        params += ['{%d}' % index, index, json.dumps(result, cls=DjangoJSONEncoder)]
+
+    sets = ['{} = {}'.format(column, expr)]
+    if any(f.name == 'update_time' for f in model._meta.fields):
+        sets.append('{} = %s'.format(qn('update_time')))
+        params.append(timezone.now())
+
+    sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+        qn(model._meta.db_table), ', '.join(sets), qn(model._meta.pk.column))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [pk])
+
+
+def _update_elements_locked(model: type, pk: Any, field_name: str, updates: Dict[int, dict]) -> None:
+    """Only the field is saved, so that other fields written meanwhile are kept."""
+    update_fields = [field_name]
+    if any(f.name == 'update_time' for f in model._meta.fields):
+        update_fields.append('update_time')
+    with transaction.atomic(using=router.db_for_write(model)):
+        instance = model.objects.select_for_update().get(pk=pk)
+        values = getattr(instance, field_name)
+        for index, result in updates.items():
+            values[index].update(result)
+        instance.save(update_fields=update_fields)
+
+
+class ResultWriter:
+    """
+    Coalesces element updates per (model, pk, field) and writes them from a
+    background thread after at most `window` seconds. Pending updates are also
+    written at exit of the process, see flush.
+
+    Updates that fail to be written, such as on a lost connection, are pending
+    again, under any newer updates, and retried in the next window. They are
+    dropped after MAX_WRITE_ATTEMPTS.
+
+    There are two public methods: write and flush.
+    """
+
+    def __init__(self, window: float = WRITE_WINDOW) -> None:
+        self.window = window
+        # (model, pk, field_name) -> index -> result
+        self._pending = OrderedDict()  # type: OrderedDict
+        self._cond = threading.Condition()
+        # Held while writing, so that a flush at exit waits for a write in progress
+        self._writing = threading.Lock()
+        self._thread = None  # type: Any
+        # (model, pk, field_name) -> failed writes in a row
+        self._attempts = {}  # type: Dict[Tuple[type, Any, str], int]
+
+    def write(self, instance: Any, field_name: str, index: int, result: Dict[str, Any]) -> None:
+        """
+        Update the element in memory, then schedule the write. Objects that are
+        not saved model instances are saved at once.
+        """
+        with self._cond:
+            instance.__dict__[field_name][index].update(result)
+            if not isinstance(instance, models.Model) or instance.pk is None:
+                instance.save()
+                shared_hub.publish((instance.__class__.__name__, instance.pk, field_name))
+                return
+            key = (instance.__class__, instance.pk, field_name)
+            self._merge(self._pending.setdefault(key, {}), index, result)
+            self._ensure_thread()
+            self._cond.notify()
+
+    def flush(self) -> None:
+        """
+        Write all pending updates now. Called at exit, and by runworker on
+        shutdown, so that finished results are not lost with the window.
+        """
+        with self._writing:
+            with self._cond:
+                pending, self._pending = self._pending, OrderedDict()
+            self._write_all(pending)
+
+    @staticmethod
+    def _merge(updates: Dict[int, dict], index: int, result: Dict[str, Any]) -> Dict[int, dict]:
+        updates.setdefault(index, {}).update(result)
+        return updates
+
+    def _ensure_thread(self) -> None:
+        """Must hold lock."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, name='result-writer', daemon=True)
+            self._thread.start()
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # Let more completions arrive before writing
+            time.sleep(self.window)
+            self.flush()
+            close_old_connections()
+
+    def _write_all(self, pending: Dict[Tuple[type, Any, str], Dict[int, dict]]) -> None:
+        for key, updates in pending.items():
+            model, pk, field_name = key
+            try:
+                update_elements(model, pk, field_name, updates)
+            except Exception as e:
+                logger.exception(e)
+                self._retry(key, updates)
+                continue
+            self._attempts.pop(key, None)
+            shared_hub.publish((model.__name__, pk, field_name))
+            logger.debug('{} results written to {} {}'.format(len(updates), model.__name__, pk))
+
+    def _retry(self, key: Tuple[type, Any, str], updates: Dict[int, dict]) -> None:
+        attempts = self._attempts.get(key, 0) + 1
+        if attempts >= MAX_WRITE_ATTEMPTS:
+            self._attempts.pop(key, None)
+            logger.error('Dropped {} results of {} {} after {} failed writes: {}'.format(
+                len(updates), key[0].__name__, key[1], attempts, updates))
+            return
+        self._attempts[key] = attempts
+        with self._cond:
+            newer = self._pending.get(key, {})
+            for index, result in newer.items():
+                self._merge(updates, index, result)
+            self._pending[key] = updates
+            self._ensure_thread()
+            self._cond.notify()
+
+
+shared_writer = ResultWriter()
+atexit.register(shared_writer.flush)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
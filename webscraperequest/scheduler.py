@@ -0,0 +1,297 @@
+"""
+A process-wide scheduler for outbound web requests.
+
+Every batch, view and sub-request shares one set of worker threads per upstream
+"lane", so the total concurrency against each mirror or web service is capped no
+matter how many plates are in flight. Within a lane, queued work is served
+round-robin first by user and then by batch, so one big plate cannot starve
+everyone else.
+
+Coroutine functions are run on the engine loop. They hold a slot of their lane
+only for each blocking call, see engine.current_slot, and neither a slot nor a
+thread while they wait, such as while polling Crispresso. So a lane caps the
+requests in flight to its upstream, and may have hundreds of coroutines
+waiting. Slots for calls are granted round-robin like work. Work that should
+only start later, such as a retry, is queued by submit_later after a timer on
+the engine loop, holding neither a slot nor a thread meanwhile.
+
+>>> s = Scheduler({'test': 2})
+>>> s.map('test', lambda x: x * 2, [1, 2, 3])
+[2, 4, 6]
+>>> s.submit('test', sum, [1, 2]).result()
+3
+>>> s.submit_later(0.01, 'test', sum, [3, 4]).result()
+7
+>>> async def double(x):
+...     return x * 2
+>>> s.map('test', double, [4, 5])
+[8, 10]
+
+Waits do not count against the limit, only calls do.
+
+>>> async def wait_then_call(x):
+...     await asyncio.sleep(0.1)
+...     return await shared_engine.call(sum, [x, x])
+>>> s = Scheduler({'one': 1})
+>>> start = time.time()
+>>> s.map('one', wait_then_call, range(20))[-1], time.time() - start < 1
+(38, True)
+>>> s.submit('unknown', sum, [1, 2])
+Traceback (most recent call last):
+...
+ValueError: Unknown upstream lane: "unknown"
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time  # noqa
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Mapping
+
+try:
+    from .engine import current_slot, shared_engine
+    from .mirrors import CRISPOR_MIRRORS, CRISPRESSO_MIRRORS
+except ImportError:
+    # For doctest, which is not run in package context
+    from engine import current_slot, shared_engine  # type: ignore # noqa
+    from mirrors import CRISPOR_MIRRORS, CRISPRESSO_MIRRORS  # type: ignore # noqa
+
+logger = logging.getLogger(__name__)
+
+# Max number of concurrent requests per upstream lane.
+UPSTREAM_LIMITS = {
+    # More than 8 threads appears to cause a 'no output' Crispor error.
+    # Guides and primers hit the same mirror, so together they stay at 8 per
+    # mirror. See mirrors.
+    'crispor': 4 * len(CRISPOR_MIRRORS),
+    'crispor_primers': 4 * len(CRISPOR_MIRRORS),
+    # The Crispresso mirror runs 3 Celery workers. See README.
+    'crispresso': 4 * len(CRISPRESSO_MIRRORS),
+    # Public web services are also rate limited per host, so their lanes can be
+    # wider than their allowed rate. See utils.ratelimit.HOST_RATES.
+    'ensembl': 16,
+    # More than 4 concurrent requests caused strange 404 errors from togows.org,
+    # which cannot be told from real 404s, and 'You have exceeded the limit'
+    # errors from UCSC. So these stay at 4 until more is measured. See
+    # utils.ratelimit.HOST_CONCURRENCY.
+    'togows': 4,
+    'ucsc': 4,
+    'gggenome': 8,
+    # Not upstreams: local Primer3 and quantification of Crispresso stats run
+    # in a pool of processes. See localrequest.
+    'primer3': 16,
+    'quantify': 16,
+}
+
+
+# The fn of a work item that grants a slot to a blocking call of a coroutine
+_GRANT = object()
+
+
+class Lane:
+    """
+    A fixed number of slots serving one upstream. Slots are held by worker
+    threads, or by coroutines on the engine loop during each blocking call.
+    Threads are started lazily and live for the life of the process.
+    """
+
+    def __init__(self, name: str, max_workers: int) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        # user -> group -> queue of work items
+        self._queues = OrderedDict()  # type: OrderedDict
+        self._cond = threading.Condition()
+        self._num_threads = 0
+        self._num_idle = 0
+        self._num_running = 0
+
+    def submit(self, fn: Callable, args: tuple, user: Hashable, group: Hashable) -> Future:
+        future = Future()  # type: Future
+        self._enqueue((future, fn, args, user, group))
+        return future
+
+    def _enqueue(self, item: tuple) -> None:
+        user, group = item[3:]
+        with self._cond:
+            groups = self._queues.setdefault(user, OrderedDict())
+            groups.setdefault(group, deque()).append(item)
+            if not self._num_idle and self._num_threads < self.max_workers:
+                self._num_threads += 1
+                threading.Thread(
+                    target=self._work,
+                    name='{}-{}'.format(self.name, self._num_threads),
+                    daemon=True,
+                ).start()
+            self._cond.notify()
+
+    @property
+    def num_queued(self) -> int:
+        with self._cond:
+            return sum(len(q) for groups in self._queues.values() for q in groups.values())
+
+    def _next(self) -> tuple:
+        """Round-robin over users, then over groups of the user. Must hold lock."""
+        user, groups = self._queues.popitem(last=False)
+        group, queue = groups.popitem(last=False)
+        item = queue.popleft()
+        if queue:
+            groups[group] = queue
+        if groups:
+            self._queues[user] = groups
+        return item
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queues or self._num_running >= self.max_workers:
+                    self._num_idle += 1
+                    self._cond.wait()
+                    self._num_idle -= 1
+                future, fn, args, user, group = self._next()
+                # Coroutines take a slot only for each call. See _Slot.
+                is_coroutine = asyncio.iscoroutinefunction(fn)
+                if not is_coroutine:
+                    self._num_running += 1
+
+            if fn is _GRANT:
+                loop = args
+                loop.call_soon_threadsafe(self._grant, future)
+                continue
+            if not future.set_running_or_notify_cancel():
+                if not is_coroutine:
+                    self._release()
+                continue
+            if is_coroutine:
+                shared_engine.submit(self._run_coroutine(fn, args, user, group)).add_done_callback(
+                    functools.partial(_chain, future))
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                self._release()
+
+    async def _run_coroutine(self, fn: Callable, args: tuple, user: Hashable, group: Hashable) -> Any:
+        # Set in the context of the task of the coroutine only
+        current_slot.set(_Slot(self, user, group))
+        return await fn(*args)
+
+    def _grant(self, waiter: asyncio.Future) -> None:
+        """On the engine loop. A call that gave up waiting gives back its slot."""
+        if waiter.done():
+            self._release()
+        else:
+            waiter.set_result(None)
+
+    def _release(self) -> None:
+        with self._cond:
+            self._num_running -= 1
+            self._cond.notify()
+
+
+class _Slot:
+    """
+    A slot of a lane for the blocking calls of one coroutine, queued with the
+    user and group of the coroutine. See engine.Engine.call_in.
+    """
+
+    def __init__(self, lane: Lane, user: Hashable, group: Hashable) -> None:
+        self.lane = lane
+        self.user = user
+        self.group = group
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self.lane._enqueue((waiter, _GRANT, loop, self.user, self.group))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Granted, but cancelled before the call could start
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.lane._release()
+
+
+class Scheduler:
+    """
+    Routes work to lanes. See UPSTREAM_LIMITS.
+
+    There are three public methods: submit, submit_later and map.
+    """
+
+    def __init__(self, limits: Mapping[str, int]) -> None:
+        self._lanes = dict((name, Lane(name, limit)) for name, limit in limits.items())
+
+    def submit(self,
+               lane: str,
+               fn: Callable,
+               *args: Any,
+               user: Hashable = None,
+               group: Hashable = None) -> Future:
+        """Queue fn(*args) on lane. Work of the same user and group is run in order."""
+        return self._get_lane(lane).submit(fn, args, user, group)
+
+    def submit_later(self,
+                     delay: float,
+                     lane: str,
+                     fn: Callable,
+                     *args: Any,
+                     user: Hashable = None,
+                     group: Hashable = None) -> Future:
+        """Like submit, but fn is only queued after delay seconds."""
+        lane_ = self._get_lane(lane)
+        future = Future()  # type: Future
+
+        def enqueue() -> None:
+            lane_.submit(fn, args, user, group).add_done_callback(
+                functools.partial(_chain, future))
+
+        loop = shared_engine.loop
+        loop.call_soon_threadsafe(loop.call_later, delay, enqueue)
+        return future
+
+    def map(self,
+            lane: str,
+            fn: Callable,
+            *iterables: Iterable,
+            user: Hashable = None,
+            group: Hashable = None) -> List[Any]:
+        """Like ThreadPoolExecutor.map, but blocks and returns a list."""
+        futures = [self.submit(lane, fn, *args, user=user, group=group)
+                   for args in zip(*iterables)]
+        return [f.result() for f in futures]
+
+    def stats(self) -> Dict[str, int]:
+        return dict((name, lane.num_queued) for name, lane in self._lanes.items())
+
+    def _get_lane(self, name: str) -> Lane:
+        try:
+            return self._lanes[name]
+        except KeyError:
+            raise ValueError('Unknown upstream lane: "{}"'.format(name))
+
+
+def _chain(future: Future, done: Future) -> None:
+    """Copy the outcome of done into future."""
+    try:
+        future.set_result(done.result())
+    except BaseException as e:
+        future.set_exception(e)
+
+
+shared_scheduler = Scheduler(UPSTREAM_LIMITS)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
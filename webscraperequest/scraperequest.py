@@ -4,15 +4,21 @@ A collection of web clients that make requests to various websites. The clients
 return data extracted from HTML. The clients may make multiple
 dependent requests to get results. They may also retry in case of failure.
 
-Server responses are cached by default using requests_cache.
+Server responses are cached by default using requests_cache. See utils.httpcache.
+Results extracted from large pages are cached too, so that hits skip parsing.
+See _send_parsed.
 
 Doctests will run slow on the first run before the cahce is warm.
 
 See also SampleSheetTestCase for sample return data.
 """
 
+import asyncio
+import functools
+import hashlib
 import io
 import logging
+import os
 import re
 import time
 import urllib.parse
@@ -20,40 +26,244 @@ import urllib.parse
 from abc import abstractmethod
 # TODO (gdingle): OrderedDict no longer needed in python3.7
 from collections import OrderedDict
-from typing import Any, Dict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
 
 import pandas
 import requests
-import requests_cache  # type: ignore
 import urllib3
 
 from bs4 import BeautifulSoup
+try:
+    from .crisporpage import GUIDES_TSV_EXAMPLE, HTML_PARSER, GuidePage, read_guide_page, read_tsv
+    from . import artifacts
+    from . import guidestore
+    from .engine import IO_WORKERS, shared_engine
+    from .mirrors import CRISPOR_MIRRORS, CRISPRESSO_MIRRORS, MIRRORS_SHARED, MirrorAdapter, MirrorPool
+    from .scheduler import UPSTREAM_LIMITS, shared_scheduler
+    from .statuspoller import StatusPoller
+except ImportError:
+    # For doctest, which is not run in package context
+    from crisporpage import GUIDES_TSV_EXAMPLE, HTML_PARSER, GuidePage, read_guide_page, read_tsv  # type: ignore # noqa
+    import artifacts  # type: ignore # noqa
+    import guidestore  # type: ignore # noqa
+    from engine import IO_WORKERS, shared_engine  # type: ignore # noqa
+    from mirrors import CRISPOR_MIRRORS, CRISPRESSO_MIRRORS, MIRRORS_SHARED, MirrorAdapter, MirrorPool  # type: ignore # noqa
+    from scheduler import UPSTREAM_LIMITS, shared_scheduler  # type: ignore # noqa
+    from statuspoller import StatusPoller  # type: ignore # noqa
+
+try:
+    from utils.ratelimit import RateLimitedAdapter
+except ImportError:
+    # For doctest, which is not run from the project root
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils.ratelimit import RateLimitedAdapter
+from utils import httpcache
+from utils.multipart import MultipartBody
+from utils.singleflight import SingleFlight
 
 NOT_FOUND = 'not found'
 
 logger = logging.getLogger(__name__)
-_cached_session = requests_cache.CachedSession(
-    cache_name=__name__ + '_cache',
-    # TODO (gdingle): what's the best timeout?
-    expire_after=3600 * 24 * 14,
-    allowable_methods=('GET', 'POST'),
-)
+# One cache for all clients, with TTLs per endpoint. See utils.httpcache.
+# Identical requests in flight are sent once. See utils.singleflight.
+_cached_session = httpcache.cached_session()
+# One pool of keep-alive connections per host, shared by all engine threads.
+# Requests to each host are rate limited across all clients. See utils.ratelimit.
+_adapter = RateLimitedAdapter(pool_maxsize=IO_WORKERS)
+_cached_session.mount('http://', _adapter)
+_cached_session.mount('https://', _adapter)
+# For requests that must never be cached, such as status polls
+_session = requests.Session()
+_session.mount('http://', _adapter)
+_session.mount('https://', _adapter)
 _cache = _cached_session.cache
 # _cache.clear()
 
-# NOTE: This monkey-patch is needed for a stable cache key for file uploads.
+# NOTE: This monkey-patch was needed for a stable cache key for file uploads.
+# Crispresso uploads are now keyed by content digest and streamed with a fixed
+# boundary, see utils.multipart, but keep it for any other multipart requests.
 urllib3.filepost.choose_boundary = lambda: 'crispycrunch_super_special_form_boundary'
 
 # CRISPOR_BASE_URL = 'http://crispor.tefor.net/crispor.py'
-CRISPOR_BASE_URL = 'http://ec2-34-219-237-20.us-west-2.compute.amazonaws.com/crispor.py'
-
-CRISPRESSO_BASE_URL = 'http://ec2-34-219-237-20.us-west-2.compute.amazonaws.com:81'
+# The first mirror. See mirrors.
+CRISPOR_BASE_URL = CRISPOR_MIRRORS[0]
+
+# How guides are read from Crispor: 'html' from the cells of the results page,
+# or 'tsv' from the guides download, which has all score columns.
+CRISPOR_INGEST = os.environ.get('CRISPOR_INGEST', 'html')
+
+# A minimal Crispor results page, for doctests and benchmark
+GUIDE_PAGE_EXAMPLE = """<html><body>
+<form><input type="hidden" name="batchId" value="ZvHQ5Xm1zo5UWfoUF8Jz"></form>
+<table id="otTable">
+<tr id="s5+" class="guideRow"><td>5 / fw</td><td><tt>GCTAGGACCCGCCGGCCACC</tt> <a>primers</a></td><td>85</td><td>60</td><td>55</td></tr>
+<tr id="s9-" class="guideRow"><td>9 / rev</td><td><tt>CCGGCTCCCGGGAGGTTGAT</tt> <a>primers</a></td><td>12</td><td>40</td><td>50</td></tr>
+</table>
+</body></html>"""
+
+# The first mirror. See mirrors.
+CRISPRESSO_BASE_URL = CRISPRESSO_MIRRORS[0]
 # CRISPRESSO_BASE_URL = 'http://ec2-52-12-22-81.us-west-2.compute.amazonaws.com'
 # CRISPRESSO_BASE_URL = 'http://crispresso.pinellolab.partners.org'
 
+# Requests to the base URLs are routed over their mirrors. Batches and reports
+# are routed to the mirror that made them, unless the mirrors share them.
+# Only primer pages and report files are hedged, because they are idempotent.
+_mirror_pools = [
+    MirrorPool(
+        'crispor',
+        CRISPOR_MIRRORS,
+        affinity=None if MIRRORS_SHARED else r'batchId=(\w+)',
+        hedge=r'[?&]pamId=',
+        store=_cache.store),
+    MirrorPool(
+        'crispresso',
+        CRISPRESSO_MIRRORS,
+        affinity=None if MIRRORS_SHARED else r'(?:check_progress|status|view_report)/(\w+)|CRISPRessoRun(\w+)',
+        hedge=r'/reports_data/',
+        health_path='/',
+        store=_cache.store),
+]
+for _pool in _mirror_pools:
+    _cached_session.mount(_pool.base_url, MirrorAdapter(_pool, pool_maxsize=IO_WORKERS))
+    _session.mount(_pool.base_url, MirrorAdapter(_pool, pool_maxsize=IO_WORKERS))
+
+
+# Seconds before retrying a request that got an error page
+ERROR_RETRY_DELAY = 5
+
+# Celery workers per Crispresso mirror, which run one report each. See README.
+CRISPRESSO_WORKERS = 3
+# Seconds to wait for a report of one sample. Was 20 polls of 30s.
+CRISPRESSO_TIMEOUT = 600
+
+# Files in the report of each sample. See CrispressoRequest.report_files.
+REPORT_FILES = (
+    'CRISPResso_RUNNING_LOG.txt',
+    # TODO (gdingle): read pickle file and avoid "invalid start byte" error
+    'CRISPResso2_info.pickle',  # contains figure captions
+    'Alleles_frequency_table.txt',
+    'CRISPResso_mapping_statistics.txt',
+    'CRISPResso_quantification_of_editing_frequency.txt',
+    'Mapping_statistics.txt',
+    'Quantification_of_editing_frequency.txt',
+    '1a.Read_Barplot.pdf',
+    '1a.Read_Barplot.png',
+    '1b.Alignment_Pie_Chart.pdf',
+    '1b.Alignment_Pie_Chart.png',
+    '1c.Alignment_Barplot.pdf',
+    '1c.Alignment_Barplot.png',
+)
+# Files of each amplicon, such as Reference and HDR, some for the guide
+AMPLICON_REPORT_FILES = (
+    '{amplicon}.Alleles_frequency_table_around_cut_site_for_{guide}.txt',
+    '{amplicon}.deletion_histogram.txt',
+    '{amplicon}.effect_vector_combined.txt',
+    '{amplicon}.effect_vector_deletion.txt',
+    '{amplicon}.effect_vector_insertion.txt',
+    '{amplicon}.effect_vector_substitution.txt',
+    '{amplicon}.indel_histogram.txt',
+    '{amplicon}.insertion_histogram.txt',
+    '{amplicon}.modification_count_vectors.txt',
+    '{amplicon}.nucleotide_frequency_table.txt',
+    '{amplicon}.nucleotide_percentage_table.txt',
+    '{amplicon}.quantification_window_modification_count_vectors.txt',
+    '{amplicon}.quantification_window_nucleotide_frequency_table.txt',
+    '{amplicon}.quantification_window_nucleotide_percentage_table.txt',
+    '{amplicon}.quantification_window_substitution_frequency_table.txt',
+    '{amplicon}.substitution_frequency_table.txt',
+    '{amplicon}.substitution_histogram.txt',
+    '2a.{amplicon}.Nucleotide_Percentage_Quilt.pdf',
+    '2a.{amplicon}.Nucleotide_Percentage_Quilt.png',
+    '2b.{amplicon}.Nucleotide_Percentage_Quilt_For_{guide}.pdf',
+    '2b.{amplicon}.Nucleotide_Percentage_Quilt_For_{guide}.png',
+    '3a.{amplicon}.Indel_Size_Distribution.pdf',
+    '3a.{amplicon}.Indel_Size_Distribution.png',
+    '3b.{amplicon}.Insertion_Deletion_Substitutions_Size_Hist.pdf',
+    '3b.{amplicon}.Insertion_Deletion_Substitutions_Size_Hist.png',
+    '4a.{amplicon}.Combined_Insertion_Deletion_Substitution_Locations.pdf',
+    '4a.{amplicon}.Combined_Insertion_Deletion_Substitution_Locations.png',
+    '4b.{amplicon}.Insertion_Deletion_Substitution_Locations.pdf',
+    '4b.{amplicon}.Insertion_Deletion_Substitution_Locations.png',
+    '4c.{amplicon}.Quantification_Window_Insertion_Deletion_Substitution_Locations.pdf',
+    '4c.{amplicon}.Quantification_Window_Insertion_Deletion_Substitution_Locations.png',
+    '4d.{amplicon}.Position_Dependent_Average_Indel_Size.pdf',
+    '4d.{amplicon}.Position_Dependent_Average_Indel_Size.png',
+    '9.{amplicon}.Alleles_Frequency_Table_Around_Cut_Site_For_{guide}.pdf',
+    '9.{amplicon}.Alleles_Frequency_Table_Around_Cut_Site_For_{guide}.png',
+)
+
+# Part of the kind of parsed results in the cache. Bump it when extraction
+# changes, so that old results are not used. See _send_parsed.
+PARSED_VERSION = 1
+
+_flights = SingleFlight()
+
+
+def file_digest(path: str) -> str:
+    """
+    Streamed sha256 of a file, memoised by path, mtime and size.
+
+    >>> file_digest(__file__) == file_digest(__file__)
+    True
+    """
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=4096)
+def _file_digest(path: str, mtime_ns: int, size: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RetryLater(Exception):
+    """
+    Raised instead of sleeping when a request should be retried after delay
+    seconds, so that the caller can give up its lane slot meanwhile. Await
+    resume() to retry. See AbstractScrapeRequest.defer_retries.
+
+    >>> e = RetryLater('Stuck in job queue', 30, None, 2)
+    >>> sorted(e.status)
+    ['retries', 'retry_at', 'retry_reason']
+    >>> e.status['retries'], e.status['retry_reason']
+    (2, 'Stuck in job queue')
+    """
+
+    def __init__(self, reason: str, delay: float, resume: Callable[[], Awaitable], retries: int) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.delay = delay
+        self.resume = resume
+        self.retries = retries
+        self.retry_at = time.time() + delay
+
+    @property
+    def status(self) -> Dict[str, Any]:
+        """For the result of the request while it waits. See BatchStatus."""
+        return {
+            'retries': self.retries,
+            'retry_at': int(self.retry_at),
+            'retry_reason': self.reason,
+        }
+
 
 class AbstractScrapeRequest:
 
+    # Whether to raise RetryLater instead of sleeping before a retry. Set by
+    # callers that schedule retries themselves, see BaseBatchWebRequest.
+    defer_retries = False
+    # Owner of the request, for fair sharing of lanes by the requests it makes
+    # itself. Set by callers, like defer_retries. See scheduler.
+    user = None  # type: Hashable
+    # Number of retries so far
+    num_retries = 0
+
     def __repr__(self):
         return '{}({}, {})'.format(
             self.__class__, self.endpoint, self.__dict__.get('data'))
@@ -68,10 +278,87 @@ class AbstractScrapeRequest:
     def cache_key(self):
         return _cache.create_key(self.request)
 
+    @property
+    def parsed_kind(self) -> str:
+        """What extracted a parsed result in the cache. See _send_parsed."""
+        return '{}:{}'.format(self.__class__.__name__, PARSED_VERSION)
+
     @abstractmethod
     def run(self) -> Dict[str, Any]:
         """Requests self.endpoint and extracts relevant data from the HTML response"""
 
+    async def arun(self) -> Dict[str, Any]:
+        """
+        Coroutine version of run, for the engine loop. Clients that wait on slow
+        services override it, and their run blocks on it. See engine.
+        """
+        return await shared_engine.call(self.run)
+
+    def run_coalesced(self) -> Dict[str, Any]:
+        """
+        Like run, but identical requests in flight, by cache_key, share one run.
+        Each caller gets its own shallow copy of the result.
+        """
+        return dict(_flights.do(self.cache_key, self.run))
+
+    async def arun_coalesced(self, *args: Any) -> Dict[str, Any]:
+        """Coroutine version of run_coalesced. args are passed to arun."""
+        return dict(await _flights.do_async(self.cache_key, self.arun, *args))
+
+    async def _retry(self, reason: str, delay: float, *args: Any) -> Dict[str, Any]:
+        """
+        Runs arun again with args after delay seconds, or raises RetryLater
+        for the caller to do so.
+        """
+        self.num_retries += 1
+        if self.defer_retries:
+            # Coalesced, because followers of a coalesced run get the same
+            # RetryLater. The run is no longer in flight once this is raised.
+            resume = functools.partial(self.arun_coalesced, *args)
+            raise RetryLater(reason, delay, resume, self.num_retries)
+        await asyncio.sleep(delay)
+        return await self.arun(*args)
+
+    @classmethod
+    def is_async(cls) -> bool:
+        return cls.arun is not AbstractScrapeRequest.arun
+
+
+def _get_report_state(report_id: str) -> Tuple[str, str]:
+    status_url = CRISPRESSO_BASE_URL + '/status/' + report_id
+    logger.info('GET request to: {}'.format(status_url))
+    # no cache here
+    response = _session.get(status_url)
+    # So that 5xx are retried by the poller
+    response.raise_for_status()
+    report_status = response.json()
+    return report_status['state'], report_status.get('message', '')
+
+
+def _is_report_cached(report_id: str) -> bool:
+    report_url = CRISPRESSO_BASE_URL + '/view_report/' + report_id
+    request = _cached_session.prepare_request(requests.Request('GET', report_url))
+    # Only 200 is cached, so there is no need to read the cached report
+    return _cache.has_key(_cache.create_key(request))
+
+
+def _is_report_ready(report_id: str) -> bool:
+    # Sometimes pending status is never set to success though the report exists.
+    # The bug was reported to Luca Pinello.
+    # Also it seems that there could be a race condition on SUCCESS
+    # in reading the report so check it here to be safe.
+    if _is_report_cached(report_id):
+        return True
+    report_url = CRISPRESSO_BASE_URL + '/view_report/' + report_id
+    logger.info('GET request to: {}'.format(report_url))
+    response = _cached_session.get(report_url)
+    return response.status_code == 200
+
+
+# All reports in progress are polled together. See statuspoller.
+_status_poller = StatusPoller(
+    _get_report_state, _is_report_ready, slots=CRISPRESSO_WORKERS * len(CRISPRESSO_MIRRORS))
+
 
 class CrispressoRequest(AbstractScrapeRequest):
     """
@@ -146,28 +433,41 @@ class CrispressoRequest(AbstractScrapeRequest):
             'single_sample_1_name': '',
             'single_sample_1_sgRNA': '',
         }
+        # Files are opened only when the request is sent. See cache_key.
         self.files = {
             # TODO (gdingle): use acutal crispresso multi sample batch mode somehow?
-            'paired_sample_1_fastq_r1': open(fastq_r1, 'rb'),
-            'paired_sample_1_fastq_r2': open(fastq_r2, 'rb'),
+            'paired_sample_1_fastq_r1': fastq_r1,
+            'paired_sample_1_fastq_r2': fastq_r2,
         }
 
-        self.request = requests.Request(  # type: ignore
-            'POST',
-            self.endpoint,
-            data=self.data,
-            files=self.files,
-        ).prepare()
+    @property
+    def cache_key(self) -> str:
+        """
+        A digest of the form data and of the content of the files. Unlike the
+        default key, it does not require reading the files into a multipart body.
+        """
+        if '_cache_key' not in self.__dict__:
+            self._cache_key = self._content_digest()
+        return self._cache_key
+
+    def _content_digest(self) -> str:
+        digest = hashlib.sha256(self.endpoint.encode())
+        for name, value in sorted(self.data.items()):
+            digest.update('{}={}\n'.format(name, value).encode())
+        for name, path in sorted(self.files.items()):
+            digest.update('{}={}\n'.format(name, file_digest(path)).encode())
+        return digest.hexdigest()
 
     def run(self) -> Dict[str, Any]:
-        logger.info('POST request to: {}'.format(self.endpoint))
-        response = _cached_session.send(self.request)  # type: ignore
-        response.raise_for_status()
+        return shared_engine.run(self.arun())
+
+    async def arun(self) -> Dict[str, Any]:
+        response = await shared_engine.call(self._submit)
         # for example: http://crispresso.pinellolab.partners.org/check_progress/P2S84K
         report_id = response.url.split('/')[-1]
 
         try:
-            self._wait_for_success(report_id)
+            await self._wait_for_success(report_id)
 
             report_data_url = CRISPRESSO_BASE_URL + \
                 '/reports_data/CRISPRessoRun{}'.format(report_id)
@@ -176,14 +476,22 @@ class CrispressoRequest(AbstractScrapeRequest):
             report_url = CRISPRESSO_BASE_URL + '/view_report/' + report_id
             stats_url = report_files_url + 'CRISPResso_quantification_of_editing_frequency.txt'
 
+            log_params, report_stats, report_artifacts = await asyncio.gather(
+                shared_engine.call(self._get_log_params, report_url),
+                shared_engine.call(self._get_stats, stats_url),
+                artifacts.fetch_report(_session, report_zip, OrderedDict(
+                    ('CRISPResso_on_{}/{}'.format(report_id, file), report_files_url + file)
+                    for file in self.report_files)))
             return {
                 'report_url': report_url,
                 'report_zip': report_zip,
-                'log_params': self._get_log_params(report_url),
+                'log_params': log_params,
                 'report_files': [report_files_url + file for file in self.report_files],
-                'report_stats': self._get_stats(stats_url),
+                'report_stats': report_stats,
+                # Local copies, by name. See artifacts.
+                'artifacts': report_artifacts,
                 'input_data': self.data,
-                'input_files': [f.name for f in self.files.values()],
+                'input_files': list(self.files.values()),
                 # Keep for display of custom analysis
                 'optional_name': self.optional_name,
             }
@@ -192,28 +500,43 @@ class CrispressoRequest(AbstractScrapeRequest):
             _cache.delete(self.cache_key)
             raise
 
-    def _wait_for_success(self, report_id: str, retries: int = 20) -> None:
+    def _submit(self) -> requests.Response:
+        logger.info('POST request to: {}'.format(self.endpoint))
+        # Files are streamed from disk as they are sent, not read into memory
+        body = MultipartBody(self.data, self.files)
+        try:
+            request = requests.Request(  # type: ignore
+                'POST',
+                self.endpoint,
+                data=body,
+                headers={'Content-Type': body.content_type},
+            ).prepare()
+            request.content_key = self.cache_key
+            response = _cached_session.send(request)  # type: ignore
+        finally:
+            body.close()
+        response.raise_for_status()
+        return response
+
+    async def _wait_for_success(self, report_id: str, timeout: float = CRISPRESSO_TIMEOUT, size: int = 1) -> None:
         """
-        Poll for SUCCESS. Typically took 300s secs in testing.
+        Wait for the report on the shared poller. Typically took 300s secs in
+        testing.
 
         As of this writing, Crispresso2 supports running 3 workers in parallel,
         so in the worst case, 96 reports will take approx 3 hours.
         """
-        total = 0
-        while not self._check_report_status(report_id) and retries >= 0:
-            amount = 30
-            time.sleep(amount)
-            retries -= 1
-            total += amount
-
-        if retries < 0:
-            raise TimeoutError('Crispresso on {}: Retries exhausted after {}s.'.format(
-                report_id, total))
+        if await shared_engine.call(_is_report_cached, report_id):
+            return
+        await _status_poller.wait(report_id, timeout, size)
 
     def _get_stats(self, stats_url: str) -> dict:
         logger.info('GET request to: {}'.format(stats_url))
-        stats_response = _cached_session.get(stats_url)
-        return self._parse_tsv(stats_response.text)
+        return _send_parsed(
+            _cached_session.prepare_request(requests.Request('GET', stats_url)),
+            'CrispressoStats:{}'.format(PARSED_VERSION),
+            lambda response: self._parse_tsv(response.text),
+            droppable=True)
 
     @staticmethod
     def _parse_tsv(tsv: str) -> dict:
@@ -236,90 +559,174 @@ class CrispressoRequest(AbstractScrapeRequest):
 
     def _get_log_params(self, report_url: str) -> str:
         logger.info('GET request to: {}'.format(report_url))
-        report_response = _cached_session.get(report_url)
-        soup = BeautifulSoup(report_response.text, 'html.parser')
-        log_params = soup.find(id='log_params')
-        if not log_params:
-            raise ValueError('Bad Crispresso report: {}. Is the input valid?'.format(
-                report_url))
-        return log_params.get_text()
-
-    def _check_report_status(self, report_id: str) -> bool:
-        status_endpoint = CRISPRESSO_BASE_URL + '/status/'
-        status_url = status_endpoint + report_id
-        logger.info('GET request to: {}'.format(status_url))
-        # no cache here
-        report_status = requests.get(status_url).json()
-        if report_status['state'] == 'FAILURE':
-            raise RuntimeError('Crispresso on {}: {}'.format(report_id, report_status['message']))
-        elif report_status['state'] in ('SUCCESS', 'PENDING'):
-            # Sometimes pending status is never set to success though the report exists.
-            # The bug was reported to Luca Pinello.
-            # Also it seems that there could be a race condition on SUCCESS
-            # in reading the report so check it here to be safe.
-            report_url = CRISPRESSO_BASE_URL + '/view_report/' + report_id
-            response = _cached_session.get(report_url)
-            if response.status_code == 200:
-                return True
-            else:
-                return False
-        else:
-            return False
+
+        def parse(report_response: requests.Response) -> str:
+            soup = BeautifulSoup(report_response.text, 'html.parser')
+            log_params = soup.find(id='log_params')
+            if not log_params:
+                raise ValueError('Bad Crispresso report: {}. Is the input valid?'.format(
+                    report_url))
+            return log_params.get_text()
+
+        return _send_parsed(
+            _cached_session.prepare_request(requests.Request('GET', report_url)),
+            'CrispressoLogParams:{}'.format(PARSED_VERSION),
+            parse,
+            droppable=True)
 
     @property
-    def report_files(self):
-        return (
-            'CRISPResso_RUNNING_LOG.txt',
-            # TODO (gdingle): read pickle file and avoid "invalid start byte" error
-            'CRISPResso2_info.pickle',  # contains figure captions
-            'Alleles_frequency_table.txt',
-            'CRISPResso_mapping_statistics.txt',
-            'CRISPResso_quantification_of_editing_frequency.txt',
-            'Mapping_statistics.txt',
-            'Quantification_of_editing_frequency.txt',
-            'Reference.Alleles_frequency_table_around_cut_site_for_AATCGGTACAAGATGGCGGA.txt',
-            'Reference.deletion_histogram.txt',
-            'Reference.effect_vector_combined.txt',
-            'Reference.effect_vector_deletion.txt',
-            'Reference.effect_vector_insertion.txt',
-            'Reference.effect_vector_substitution.txt',
-            'Reference.indel_histogram.txt',
-            'Reference.insertion_histogram.txt',
-            'Reference.modification_count_vectors.txt',
-            'Reference.nucleotide_frequency_table.txt',
-            'Reference.nucleotide_percentage_table.txt',
-            'Reference.quantification_window_modification_count_vectors.txt',
-            'Reference.quantification_window_nucleotide_frequency_table.txt',
-            'Reference.quantification_window_nucleotide_percentage_table.txt',
-            'Reference.quantification_window_substitution_frequency_table.txt',
-            'Reference.substitution_frequency_table.txt',
-            'Reference.substitution_histogram.txt',
-
-            '1a.Read_Barplot.pdf',
-            '1a.Read_Barplot.png',
-            '1b.Alignment_Pie_Chart.pdf',
-            '1b.Alignment_Pie_Chart.png',
-            '1c.Alignment_Barplot.pdf',
-            '1c.Alignment_Barplot.png',
-            '2a.Reference.Nucleotide_Percentage_Quilt.pdf',
-            '2a.Reference.Nucleotide_Percentage_Quilt.png',
-            '2b.Reference.Nucleotide_Percentage_Quilt_For_AATCGGTACAAGATGGCGGA.pdf',
-            '2b.Reference.Nucleotide_Percentage_Quilt_For_AATCGGTACAAGATGGCGGA.png',
-            '3a.Reference.Indel_Size_Distribution.pdf',
-            '3a.Reference.Indel_Size_Distribution.png',
-            '3b.Reference.Insertion_Deletion_Substitutions_Size_Hist.pdf',
-            '3b.Reference.Insertion_Deletion_Substitutions_Size_Hist.png',
-            '4a.Reference.Combined_Insertion_Deletion_Substitution_Locations.pdf',
-            '4a.Reference.Combined_Insertion_Deletion_Substitution_Locations.png',
-            '4b.Reference.Insertion_Deletion_Substitution_Locations.pdf',
-            '4b.Reference.Insertion_Deletion_Substitution_Locations.png',
-            '4c.Reference.Quantification_Window_Insertion_Deletion_Substitution_Locations.pdf',
-            '4c.Reference.Quantification_Window_Insertion_Deletion_Substitution_Locations.png',
-            '4d.Reference.Position_Dependent_Average_Indel_Size.pdf',
-            '4d.Reference.Position_Dependent_Average_Indel_Size.png',
-            '9.Reference.Alleles_Frequency_Table_Around_Cut_Site_For_AATCGGTACAAGATGGCGGA.pdf',
-            '9.Reference.Alleles_Frequency_Table_Around_Cut_Site_For_AATCGGTACAAGATGGCGGA.png',
-        )
+    def report_files(self) -> List[str]:
+        """
+        Files in the report of the sample, of each amplicon, and for its guide.
+
+        >>> req = CrispressoRequest('ACGT', 'acgt', '', '', 'TruSeq3-PE.fa', 'ACGG')
+        >>> files = [f for f in req.report_files if f.startswith('9.')]
+        >>> len(files), files[-1]
+        (4, '9.HDR.Alleles_Frequency_Table_Around_Cut_Site_For_ACGT.png')
+        """
+        amplicons = ['Reference', 'HDR'] if self.data['hdr_seq'] else ['Reference']
+        guide = self.data['paired_sample_1_sgRNA'].upper()
+        return list(REPORT_FILES) + [
+            file.format(amplicon=amplicon, guide=guide)
+            for amplicon in amplicons
+            for file in AMPLICON_REPORT_FILES
+        ]
+
+
+class CrispressoBatchRequest(CrispressoRequest):
+    """
+    Requests one Crispresso2 analysis of many samples, in the batch mode of
+    Crispresso, so that an upload, a job and a report are shared by the
+    samples instead of paid by each.
+
+    Samples are given as CrispressoRequests, each with its own amplicon, guide
+    and HDR sequence. Options such as trim must be the same for all. Samples
+    are numbered in the form like the first sample of a single request, see
+    paired_sample_1_amplicon, and are named by their number.
+
+    Results are one per sample, in order, each like the result of its own
+    CrispressoRequest, but with the report and zip of the batch. A result is
+    an exception if the stats of its sample failed.
+
+    >>> samples = [CrispressoRequest('ACGT' * 10, 'ACGTACGTACGTACGTACGT', __file__, __file__, 'TruSeq3-PE.fa', hdr)
+    ...            for hdr in ('', 'ACGTTT' * 5)]
+    >>> batch = CrispressoBatchRequest(samples)
+    >>> batch.data['active_paired_samples'], batch.data['paired_sample_2_hdr_seq'][:6]
+    ('1,2', 'ACGTTT')
+    >>> sorted(batch.files)[:2]
+    ['paired_sample_1_fastq_r1', 'paired_sample_1_fastq_r2']
+    >>> batch.sample_files_url('http://x/reports_data/CRISPRessoRunABC', 'ABC', 2)
+    'http://x/reports_data/CRISPRessoRunABC/CRISPRessoBatch_on_ABC/CRISPResso_on_Sample_2/'
+    """
+
+    # Per sample fields of the form, after the prefix "paired_sample_{n}_"
+    SAMPLE_FIELDS = ('amplicon', 'sgRNA', 'hdr_seq', 'name')
+    # Seconds to wait for the report, per sample. See _wait_for_success.
+    TIMEOUT_PER_SAMPLE = 300
+
+    def __init__(self, samples: List[CrispressoRequest]) -> None:
+        assert len(set(s.data['optradio_trim'] for s in samples)) == 1, 'Must have one trim'
+        self.samples = samples
+        self.endpoint = samples[0].endpoint
+        self.optional_name = ''
+
+        self.data = dict(samples[0].data)
+        for field in self.SAMPLE_FIELDS:
+            self.data.pop('paired_sample_1_' + field, None)
+        # Given per sample instead
+        self.data.update(sgRNA='', hdr_seq='', optional_name='')
+        self.files = {}  # type: Dict[str, str]
+        for n, sample in enumerate(samples, 1):
+            prefix = 'paired_sample_{}_'.format(n)
+            self.data.update({
+                prefix + 'amplicon': sample.data['paired_sample_1_amplicon'],
+                prefix + 'sgRNA': sample.data['paired_sample_1_sgRNA'],
+                prefix + 'hdr_seq': sample.data['hdr_seq'],
+                prefix + 'name': self.sample_name(n),
+            })
+            for name, path in sample.files.items():
+                self.files[name.replace('paired_sample_1_', prefix)] = path
+        self.data['active_paired_samples'] = ','.join(str(n) for n in range(1, len(samples) + 1))
+
+    def __repr__(self):
+        return 'CrispressoBatchRequest({} samples)'.format(len(self.samples))
+
+    @staticmethod
+    def sample_name(n: int) -> str:
+        return 'Sample_{}'.format(n)
+
+    @classmethod
+    def sample_files_url(cls, report_data_url: str, report_id: str, n: int) -> str:
+        return '{}/CRISPRessoBatch_on_{}/CRISPResso_on_{}/'.format(
+            report_data_url, report_id, cls.sample_name(n))
+
+    @classmethod
+    def sample_artifacts(cls, manifest: Dict[str, str], n: int) -> Dict[str, str]:
+        """
+        Artifacts of the batch that are of sample n, or of no sample, so that
+        results do not each repeat the manifest of the batch.
+
+        >>> manifest = {'CRISPResso_Report_ABC.zip': 'z', 'CRISPRessoBatch_on_ABC/CRISPResso_on_Sample_1/a.txt': '1',
+        ...             'CRISPRessoBatch_on_ABC/CRISPResso_on_Sample_2/a.txt': '2'}
+        >>> sorted(CrispressoBatchRequest.sample_artifacts(manifest, 2).values())
+        ['2', 'z']
+        """
+        sample_dir = 'CRISPResso_on_{}/'.format(cls.sample_name(n))
+        return dict((name, digest) for name, digest in manifest.items()
+                    if sample_dir in name or 'CRISPResso_on_' not in name)
+
+    def run(self) -> list:  # type: ignore
+        return shared_engine.run(self.arun())
+
+    async def arun(self) -> list:  # type: ignore
+        response = await shared_engine.call(self._submit)
+        report_id = response.url.split('/')[-1]
+
+        try:
+            await self._wait_for_success(
+                report_id, self.TIMEOUT_PER_SAMPLE * len(self.samples), len(self.samples))
+
+            report_data_url = CRISPRESSO_BASE_URL + \
+                '/reports_data/CRISPRessoRun{}'.format(report_id)
+            report_zip = '{}/CRISPResso_Report_{}.zip'.format(report_data_url, report_id)
+            report_url = CRISPRESSO_BASE_URL + '/view_report/' + report_id
+            files_urls = [self.sample_files_url(report_data_url, report_id, n)
+                          for n in range(1, len(self.samples) + 1)]
+
+            log_params, report_artifacts, *report_stats = await asyncio.gather(
+                shared_engine.call(self._get_log_params, report_url),
+                artifacts.fetch_report(_session, report_zip, OrderedDict(
+                    (files_url[len(report_data_url) + 1:] + file, files_url + file)
+                    for sample, files_url in zip(self.samples, files_urls)
+                    for file in sample.report_files)),
+                *[shared_engine.call(
+                    self._get_stats,
+                    files_url + 'CRISPResso_quantification_of_editing_frequency.txt')
+                  for files_url in files_urls],
+                return_exceptions=True)
+            if isinstance(log_params, Exception):
+                raise log_params
+            if isinstance(report_artifacts, Exception):
+                logger.warning('Artifacts of {} failed: {}'.format(report_id, report_artifacts))
+                report_artifacts = {}
+        except Exception:
+            # TODO (gdingle): handle more precisely
+            _cache.delete(self.cache_key)
+            raise
+
+        return [stats if isinstance(stats, Exception) else {
+            'report_url': report_url,
+            'report_zip': report_zip,
+            'log_params': log_params,
+            'report_files': [files_url + file for file in sample.report_files],
+            'report_stats': stats,
+            'artifacts': self.sample_artifacts(report_artifacts, n),
+            'input_data': sample.data,
+            'input_files': list(sample.files.values()),
+            'optional_name': sample.optional_name,
+            'batch_sample': self.sample_name(n),
+        } for n, (sample, files_url, stats) in enumerate(
+            zip(self.samples, files_urls, report_stats), 1)]
 
 
 class CrisporGuideRequest(AbstractScrapeRequest):
@@ -354,7 +761,10 @@ class CrisporGuideRequest(AbstractScrapeRequest):
             org: str = 'hg38',
             pam: str = 'NGG',
             target: str = '',
-            pre_filter: int = 2) -> None:
+            pre_filter: int = 2,
+            guides_per_target: int = 0,
+            ingest: str = CRISPOR_INGEST,
+            offtargets: bool = False) -> None:
 
         self.data = {
             # NOTE: Don't use "name" because it lowers cache hit rate, it actually
@@ -374,19 +784,36 @@ class CrisporGuideRequest(AbstractScrapeRequest):
             'POST', self.endpoint, data=self.data).prepare()
         self.target = target or seq
         self.pre_filter = pre_filter
+        self.guides_per_target = guides_per_target
+        self.pam = pam
+        self.ingest = ingest
+        self.offtargets = offtargets
+        # Off-targets are too big to store
+        self.use_store = not offtargets and guidestore.is_enabled()
+
+    @property
+    def store_key(self) -> tuple:
+        """See guidestore"""
+        return (self.data['seq'], self.data['org'], self.pam, self.ingest)
+
+    def in_cache(self) -> bool:
+        return super().in_cache() or (self.use_store and guidestore.has(*self.store_key))
 
     def run(self, retries: int=6) -> Dict[str, Any]:
         """
         retries 6 should equal ~6min
         """
+        return shared_engine.run(self.arun(retries))
+
+    async def arun(self, retries: int=6) -> Dict[str, Any]:
         # TODO (gdingle): temp for working on crispor
         # _cache.delete(self.cache_key)
         try:
-            logger.info('POST request to: {}'.format(self.endpoint))
-            response = _cached_session.send(self.request)  # type: ignore
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-            return self._extract_data(soup, response.url)
+            data = await self._load_or_request()
+            known = data.pop('has_primers', {})
+            if self.pre_filter and 'primer_urls' in data:
+                data = await self._pre_filter(data, known)
+            return data
         except TimeoutError as e:
             logger.warning(str(e))
             # IMPORTANT: Delete cache of "waiting" page
@@ -394,8 +821,8 @@ class CrisporGuideRequest(AbstractScrapeRequest):
             if retries:
                 self.request = requests.Request(  # type: ignore
                     'GET', e.args[1]).prepare()
-                time.sleep(120 // (retries))  # backoff
-                return self.run(retries - 1)
+                # backoff
+                return await self._retry(str(e), 120 // retries, retries - 1)
             else:
                 raise
         except RuntimeError as e:
@@ -409,122 +836,320 @@ class CrisporGuideRequest(AbstractScrapeRequest):
                 'POST', self.endpoint, data=self.data).prepare()
             if retries:
                 logger.warning('Retrying with different name for Crispor')
-                # retry immediately
-                return self.run(retries - 1)
+                return await self._retry(str(e), ERROR_RETRY_DELAY, retries - 1)
             else:
                 raise
             raise
         raise RuntimeError('unknown error')
 
-    def _extract_data(self, soup: BeautifulSoup, url: str) -> Dict[str, Any]:
+    async def _load_or_request(self) -> Dict[str, Any]:
+        """From the shared store if the target was done before. See guidestore."""
+        if self.use_store:
+            data = await guidestore.call(guidestore.load, *self.store_key)
+            if data is not None:
+                logger.debug('Crispor result of {} from store'.format(self.target))
+                data['target'] = self.target
+                return _with_download_urls(data, self.endpoint)
+        data = await shared_engine.call(self._request_and_extract)
+        if self.use_store and data.get('batch_id'):
+            await guidestore.call(guidestore.save, *self.store_key, data)
+        return data
+
+    @property
+    def parsed_kind(self) -> str:
+        """Extraction depends on ingest, which may request more"""
+        return '{}:{}:{}'.format(super().parsed_kind, self.ingest, self.offtargets)
+
+    def _request_and_extract(self) -> Dict[str, Any]:
+        logger.info('{} request to: {}'.format(self.request.method, self.request.url))
+
+        def extract(response: requests.Response) -> Dict[str, Any]:
+            response.raise_for_status()
+            return self._extract_data(response.text, response.url)
+
+        data = _send_parsed(self.request, self.parsed_kind, extract)
+        # The same sequence may be requested for other targets
+        data['target'] = self.target
+        return data
+
+    def _extract_data(self, html: str, url: str) -> Dict[str, Any]:
+        """
+        Reads the page in one pass. See crisporpage.
+
+        >>> req = CrisporGuideRequest('ACGT', pre_filter=0)
+        >>> data = req._extract_data(GUIDE_PAGE_EXAMPLE, CRISPOR_BASE_URL)
+        >>> data['guide_seqs'], data['scores']
+        (OrderedDict([('s5+', 'GCTAGGACCCGCCGGCCACC')]), OrderedDict([('s5+', ['85', '60', '55'])]))
+        >>> req._extract_data('<p>Found no possible guide sequence</p>', CRISPOR_BASE_URL)['guide_seqs']
+        {'not found': 'not found'}
+        >>> req._extract_data('<p>This page will refresh every 10 seconds</p>', CRISPOR_BASE_URL)  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        TimeoutError: ...
+        """
+        page = read_guide_page(html)
+        if page.has_table:
+            return self._extract_guides(page)
+        text = page.text
+
         # Parse from wacky JS redirect so we can have proper URLs for errors
-        match = re.search(r'batchId=(\w+)', soup.get_text())
+        match = re.search(r'batchId=(\w+)', text)
         if match:
-            url += '?batchId=' + match.group(1) if match else ''
+            url += '?batchId=' + match.group(1)
 
-        title = soup.find(class_='title')
-        if title and 'not present in the selected genome' in title.get_text():
+        if page.title and 'not present in the selected genome' in page.title:
             raise ValueError('Crispor on {}: {}'.format(
-                self.target, title.get_text()))
+                self.target, page.title))
 
-        if 'Input sequence range too long' in soup.get_text() or \
-                'cannot handle sequences longer than' in soup.get_text():
+        if 'Input sequence range too long' in text or \
+                'cannot handle sequences longer than' in text:
             raise ValueError('Crispor on {}: Bad sequence size.'.format(
                 self.target))
 
-        if 'This page will refresh every 10 seconds' in soup.get_text():
+        if 'This page will refresh every 10 seconds' in text:
             raise TimeoutError('Crispor on {}: Stuck in job queue. Please retry at {}.'.format(
                 self.target, url), url)
 
-        output_table = soup.find('table', {'id': 'otTable'})
-        if not output_table:
-            if 'Found no possible guide sequence' in soup.get_text():
-                return dict(
-                    target=self.target,
-                    guide_seqs={
-                        NOT_FOUND: NOT_FOUND,
-                    },
-                    url=url,
-                )
-            index = soup.get_text().find('Server error: could not run command')
-            if index != -1:
-                raise RuntimeError(soup.get_text()[index:index + 200])
-            if 'are not valid in the genome' in soup.get_text():
-                return dict(
-                    target=self.target,
-                    guide_seqs={
-                        'invalid chromosome range': 'invalid chromosome range',
-                    },
-                    url=url,
-                )
-            if 'An error occured during processing' in soup.get_text():
-                raise RuntimeError(
-                    'Crispor: An error occured during processing.')
-
-            raise RuntimeError('Crispor on {}: No output rows. "{}"'.format(
-                self.target, soup.find('body')))
-
-        batch_id = soup.find('input', {'name': 'batchId'})['value']
+        if 'Found no possible guide sequence' in text:
+            return dict(
+                target=self.target,
+                guide_seqs={
+                    NOT_FOUND: NOT_FOUND,
+                },
+                url=url,
+            )
+        index = text.find('Server error: could not run command')
+        if index != -1:
+            raise RuntimeError(text[index:index + 200])
+        if 'are not valid in the genome' in text:
+            return dict(
+                target=self.target,
+                guide_seqs={
+                    'invalid chromosome range': 'invalid chromosome range',
+                },
+                url=url,
+            )
+        if 'An error occured during processing' in text:
+            raise RuntimeError(
+                'Crispor: An error occured during processing.')
+
+        raise RuntimeError('Crispor on {}: No output rows. "{}"'.format(
+            self.target, ' '.join(text.split())[:1000]))
+
+    def _extract_guides(self, page: GuidePage) -> Dict[str, Any]:
+        batch_id = page.batch_id
         url = self.endpoint + '?batchId=' + batch_id
-        primers_url = self.endpoint.split('?')[0] + '?batchId={}&pamId={}&pam=NGG'
-
-        rows = [
-            [t['id']] +
-            [cell for cell in t.find_all('td')[1:8]] +
-            [primers_url.format(batch_id, urllib.parse.quote(t['id']))]
-            for t in output_table.find_all(class_='guideRow')]
-
-        # Filter for rows that have possible primers and better than low specificity
-        # See http://crispor.tefor.net/manual/
-        rows = [r for r in rows
-                if 'primers' in r[1].get_text() and
-                r[2].get_text().strip().isdigit() and
-                int(r[2].get_text().strip()) > 20]
-
-        # Filter for rows that have actual primers (by http request),
-        # but only first `pre_filter` to save time.
-        # TODO (gdingle): pool.map parallelize? Or are we already parallel enough at this point?
-        # TODO (gdingle): flag as "no primer" for later filtering in _get_top_guides
-        if self.pre_filter:
-            rows = [r for i, r in enumerate(rows)
-                    if i > self.pre_filter or
-                    'Warning: No primers were found'
-                    not in _cached_session.get(r[-1]).text]
-            if not rows:
-                return dict(
-                    target=self.target,
-                    guide_seqs={NOT_FOUND: NOT_FOUND},
-                    url=url,
-                )
+        base_url = self.endpoint.split('?')[0]
+        primers_url = base_url + '?batchId={}&pamId={}&pam=NGG'
+
+        # Scores are specificity, efficiency and out-of-frame
+        columns = None
+        if self.ingest == 'tsv':
+            columns = self._get_tsv(
+                base_url + '?batchId={}&download=guides&format=tsv'.format(batch_id))
+            rows = self._rows_from_columns(columns)
+        else:
+            rows = []
+            for guide_id, cells, tts in page.rows:
+                scores = [cell.strip() for cell in cells[2:5]]
+                # Filter for rows that have possible primers and better than low specificity
+                # See http://crispor.tefor.net/manual/
+                if 'primers' in cells[1] and \
+                        scores[0].isdigit() and int(scores[0]) > 20:
+                    rows.append((guide_id, tts[1] or '', scores))
+        rows = [r + (primers_url.format(batch_id, urllib.parse.quote(r[0])),)
+                for r in rows]
 
         # TODO (gdingle): refactor to simple lists... see GuideDesign.to_df
-        scores = OrderedDict((t[0],
-                              [c.get_text().strip() for c in t[2:5]])
-                             for t in rows)
-        scores = OrderedDict((t[0],
-                              [c.get_text().strip() for c in t[2:5]])
-                             for t in rows)
-        guide_seqs = OrderedDict((t[0], t[1].find_next('tt').get_text())
-                                 for t in rows)
-        primer_urls = OrderedDict((t[0],
-                                   primers_url.format(batch_id, urllib.parse.quote(t[0])))
-                                  for t in rows)
-
-        return dict(
+        data = _with_download_urls(dict(
             target=self.target,
             url=url,
             batch_id=batch_id,
-            guide_seqs=guide_seqs,
-            scores=scores,
-            primer_urls=primer_urls,
-            # TODO (gdingle): are these links ever needed?
-            # TODO (gdingle): add link to batch primer download
-            fasta_url=self.endpoint + '?batchId={}&download=fasta'.format(batch_id),
-            benchling_url=self.endpoint + '?batchId={}&download=benchling'.format(batch_id),
-            guides_url=self.endpoint + '?batchId={}&download=guides&format=tsv'.format(batch_id),
-            offtargets_url=self.endpoint + \
-            '?batchId={}&download=offtargets&format=tsv'.format(batch_id),
-        )
+            guide_seqs=OrderedDict((r[0], r[1]) for r in rows),
+            scores=OrderedDict((r[0], r[2]) for r in rows),
+            primer_urls=OrderedDict((r[0], r[3]) for r in rows),
+        ), self.endpoint)
+        guide_ids = [r[0] for r in rows]
+        if columns is not None:
+            # All score columns of Crispor, in the order of guide_seqs
+            data['score_columns'] = _select_rows(columns, guide_ids)
+        if self.offtargets:
+            data['offtargets'] = _select_rows(self._get_tsv(
+                base_url + '?batchId={}&download=offtargets&format=tsv'.format(batch_id)),
+                guide_ids)
+        return data
+
+    async def _pre_filter(self, data: Dict[str, Any], known: Dict[str, bool] = {}) -> Dict[str, Any]:
+        """
+        Filter for guides that have actual primers, by request of their primer
+        pages, but only the first `pre_filter` to save time. Requests run
+        concurrently on the crispor_primers lane, and stop as soon as the first
+        `guides_per_target` guides with primers are found. Guides that are not
+        checked are kept.
+
+        Guides in known were checked before, see guidestore, and are not
+        requested again. New checks are stored.
+        """
+        # TODO (gdingle): flag as "no primer" for later filtering in _get_top_guides
+        guide_ids = list(data['primer_urls'])
+        candidates = guide_ids[:self.pre_filter + 1]
+        window = UPSTREAM_LIMITS['crispor_primers']
+        futures = []  # type: List[Future]
+        checked = {}  # type: Dict[str, bool]
+        keep = []
+
+        def submit(guide_id: str) -> Future:
+            if guide_id in known:
+                future = Future()  # type: Future
+                future.set_result(known[guide_id])
+                return future
+            return shared_scheduler.submit(
+                'crispor_primers',
+                _has_primers,
+                data['primer_urls'][guide_id],
+                user=self.user,
+                group=('pre_filter', self.target))
+
+        for i, guide_id in enumerate(candidates):
+            # Keep up to a window of requests in flight, in order of rank
+            while len(futures) < min(i + window, len(candidates)):
+                futures.append(submit(candidates[len(futures)]))
+            checked[guide_id] = await asyncio.wrap_future(futures[i])
+            if checked[guide_id]:
+                keep.append(guide_id)
+                if self.guides_per_target and len(keep) >= self.guides_per_target:
+                    logger.debug('Pre-filter of {} done after {} of {} guides'
+                                 .format(self.target, i + 1, len(candidates)))
+                    for future in futures[i + 1:]:
+                        future.cancel()
+                    keep += guide_ids[i + 1:]
+                    break
+        else:
+            keep += guide_ids[len(candidates):]
+
+        new_checks = dict((g, c) for g, c in checked.items() if g not in known)
+        if self.use_store and new_checks:
+            await guidestore.call(guidestore.save_primer_checks, *self.store_key, new_checks)
+        return self._select_guides(data, keep)
+
+    def _select_guides(self, data: Dict[str, Any], guide_ids: list) -> Dict[str, Any]:
+        """
+        >>> req = CrisporGuideRequest('ACGT', pre_filter=0)
+        >>> data = req._extract_data(GUIDE_PAGE_EXAMPLE, CRISPOR_BASE_URL)
+        >>> req._select_guides(dict(data), [])['guide_seqs']
+        {'not found': 'not found'}
+        >>> req._select_guides(dict(data), ['s5+'])['guide_seqs']
+        OrderedDict([('s5+', 'GCTAGGACCCGCCGGCCACC')])
+        """
+        if not guide_ids:
+            return dict(
+                target=self.target,
+                guide_seqs={NOT_FOUND: NOT_FOUND},
+                url=data['url'],
+            )
+        for key in ('guide_seqs', 'scores', 'primer_urls'):
+            data[key] = OrderedDict((g, data[key][g]) for g in guide_ids)
+        for key in ('score_columns', 'offtargets'):
+            if key in data:
+                data[key] = _select_rows(data[key], guide_ids)
+        return data
+
+    def _rows_from_columns(self, columns: Dict[str, list]) -> list:
+        """
+        Same rows as from the results page, but from the columns of the guides
+        TSV. The guide seq is split from the PAM by a space, as on the page.
+
+        >>> req = CrisporGuideRequest('ACGT', pre_filter=0, ingest='tsv')
+        >>> req._rows_from_columns(read_tsv(GUIDES_TSV_EXAMPLE))
+        [('s5+', 'GCTAGGACCCGCCGGCCACC CGG', ['85', '60', '55'])]
+        """
+        pam_length = len(self.pam)
+        rows = []
+        for i, guide_id in enumerate(columns['guideId']):
+            seq = columns['targetSeq'][i]
+            scores = [columns[name][i] if name in columns else ''
+                      for name in ('mitSpecScore', "Doench '16-Score", 'Out-of-Frame-Score')]
+            # Better than low specificity. See http://crispor.tefor.net/manual/
+            if scores[0].isdigit() and int(scores[0]) > 20:
+                rows.append((guide_id, seq[:-pam_length] + ' ' + seq[-pam_length:], scores))
+        return rows
+
+    def _get_tsv(self, url: str) -> Dict[str, list]:
+        request = requests.Request('GET', url).prepare()  # type: ignore
+        logger.info('GET request to: {}'.format(url))
+        response = _cached_session.send(request)
+        response.raise_for_status()
+        try:
+            return read_tsv(response.text)
+        except ValueError as e:
+            # IMPORTANT: Delete cache of unexpected output
+            _cache.delete(_cache.create_key(request))
+            raise RuntimeError('Crispor on {}: {}'.format(self.target, e))
+
+
+def _with_download_urls(data: Dict[str, Any], endpoint: str) -> Dict[str, Any]:
+    """
+    Links to downloads of a Crispor batch.
+
+    >>> _with_download_urls({'batch_id': 'abc'}, CRISPOR_BASE_URL)['guides_url'].split('?')[1]
+    'batchId=abc&download=guides&format=tsv'
+    """
+    batch_id = data['batch_id']
+    # TODO (gdingle): are these links ever needed?
+    # TODO (gdingle): add link to batch primer download
+    data['fasta_url'] = endpoint + '?batchId={}&download=fasta'.format(batch_id)
+    data['benchling_url'] = endpoint + '?batchId={}&download=benchling'.format(batch_id)
+    data['guides_url'] = endpoint + '?batchId={}&download=guides&format=tsv'.format(batch_id)
+    data['offtargets_url'] = endpoint + \
+        '?batchId={}&download=offtargets&format=tsv'.format(batch_id)
+    return data
+
+
+def _has_primers(primers_url: str) -> bool:
+    return _send_parsed(
+        _cached_session.prepare_request(requests.Request('GET', primers_url)),
+        'HasPrimers:{}'.format(PARSED_VERSION),
+        lambda response: 'Warning: No primers were found' not in response.text,
+        droppable=True)
+
+
+def _send_parsed(
+        request: requests.PreparedRequest,
+        kind: str,
+        parse: Callable[[requests.Response], Any],
+        droppable: bool = False) -> Any:
+    """
+    Sends request through the cache and parses the response, unless a result
+    of the same kind of parse is already cached. Results are only cached if
+    the response is. See httpcache.ResponseCache.get_parsed.
+
+    droppable is for GET requests whose response is only ever parsed by this
+    kind, apart from PARSED_VERSION. Then the response may be dropped once
+    parsed. See httpcache.ResponseCache.save_parsed.
+    """
+    assert not droppable or request.method == 'GET', 'Only GETs are safe to send again'
+    key = _cache.create_key(request)
+    parsed = _cache.get_parsed(key, kind)
+    if parsed is not None:
+        return parsed
+    parsed = parse(_cached_session.send(request))  # type: ignore
+    _cache.save_parsed(key, kind, parsed, droppable)
+    return parsed
+
+
+def _select_rows(columns: Dict[str, list], guide_ids: list) -> Dict[str, list]:
+    """
+    Rows of columns with the given guide ids, in order of guide ids.
+
+    >>> _select_rows({'guideId': ['s1+', 's2-', 's1+'], 'x': [1, 2, 3]}, ['s2-', 's1+'])
+    OrderedDict([('guideId', ['s2-', 's1+', 's1+']), ('x', [2, 1, 3])])
+    """
+    indexes = OrderedDict((guide_id, []) for guide_id in guide_ids)  # type: Dict[str, list]
+    for i, guide_id in enumerate(columns['guideId']):
+        if guide_id in indexes:
+            indexes[guide_id].append(i)
+    order = [i for rows in indexes.values() for i in rows]
+    return OrderedDict((name, [values[i] for i in order]) for name, values in columns.items())
 
 
 class CrisporGuideRequestByBatchId(CrisporGuideRequest):
@@ -537,6 +1162,11 @@ class CrisporGuideRequestByBatchId(CrisporGuideRequest):
         self.request = requests.Request('GET', self.endpoint).prepare()  # type: ignore
         self.target = batch_id
         self.pre_filter = pre_filter
+        self.guides_per_target = 0
+        self.pam = 'NGG'
+        self.ingest = CRISPOR_INGEST
+        self.offtargets = False
+        self.use_store = False
 
 
 class CrisporPrimerRequest(AbstractScrapeRequest):
@@ -581,7 +1211,9 @@ class CrisporPrimerRequest(AbstractScrapeRequest):
             target: str='',
             hdr_dist: int = None) -> None:
 
+        self.batch_id = batch_id
         self.pam_id = pam_id
+        self.hdr_dist = hdr_dist
         # percent encode the '+' symbol
         quoted_pam_id = urllib.parse.quote(pam_id)
 
@@ -598,33 +1230,45 @@ class CrisporPrimerRequest(AbstractScrapeRequest):
 
     def run(self,
             retries: int=1) -> dict:
+        return shared_engine.run(self.arun(retries))
+
+    async def arun(self,
+                   retries: int=1) -> dict:
         # TODO (gdingle): temp for working on crispor
         # _cache.delete(self.cache_key)
         try:
-            logger.info('GET request to: {}'.format(self.endpoint))
-            response = _cached_session.send(self.request)  # type: ignore
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-            return self._extract_data(soup)
+            return await shared_engine.call(self._request_and_extract)
         except RuntimeError as e:
             logger.warning(str(e))
             _cache.delete(self.cache_key)
             if retries:
-                return self.run(retries - 1)
+                return await self._retry(str(e), ERROR_RETRY_DELAY, retries - 1)
             else:
                 raise
 
+    def _request_and_extract(self) -> dict:
+        logger.info('GET request to: {}'.format(self.endpoint))
+
+        def extract(response: requests.Response) -> dict:
+            response.raise_for_status()
+            return self._extract_data(BeautifulSoup(response.text, HTML_PARSER))
+
+        data = _send_parsed(self.request, self.parsed_kind, extract, droppable=True)
+        data['target'] = self.target
+        return data
+
     def _extract_data(self, soup: BeautifulSoup) -> dict:
         if soup is None:
             raise RuntimeError('Cannot parse HTML {}'.format(soup))
 
-        if 'exceptions.ValueError' in soup.get_text():
+        text = soup.get_text()
+        if 'exceptions.ValueError' in text:
             raise RuntimeError('Crispor exceptions.ValueError')
 
-        if 'Error:' in soup.get_text():
+        if 'Error:' in text:
             _cache.delete(self.cache_key)
             raise ValueError('Crispor error: {}'.format(
-                soup.get_text().split('Error:')[1].strip().split('\n')[0]))
+                text.split('Error:')[1].strip().split('\n')[0]))
 
         return dict(
             pam_id=self.pam_id,
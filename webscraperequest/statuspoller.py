@@ -0,0 +1,303 @@
+"""
+One poller for the status of all outstanding Crispresso reports.
+
+Instead of each job polling its own report every 30 seconds, jobs wait on the
+poller, which checks all reports from one task on the engine loop, over the
+pooled session of scraperequest. Each report is checked when it is due:
+rarely while it is expected to be queued or running, and often around when it
+is expected to be done. Expectations come from the durations of reports done
+so far, and the position of the report among those outstanding, since
+Crispresso runs a few reports at a time. A job is woken only when its report
+is done, failed or timed out.
+
+A report in PENDING may be done, because Crispresso sometimes never sets its
+state. So it is checked for a report when overdue, and at least every
+ready_interval before that. Errors of requests, such as timeouts and 5xx,
+are retried with backoff, up to MAX_ERRORS in a row.
+
+>>> states = {'A': 'PENDING'}
+>>> poller = StatusPoller(lambda id: (states[id], 'Bad input'), lambda id: True,
+...                       slots=1, expected_run=0.02, min_interval=0.01, max_interval=0.05)
+>>> async def finish(id):
+...     await asyncio.sleep(0.05)
+...     states[id] = 'SUCCESS'
+>>> async def run():
+...     asyncio.ensure_future(finish('A'))
+...     await poller.wait('A', timeout=5)
+>>> shared_engine.run(run())
+>>> stats = poller.stats()
+>>> stats['outstanding'], stats['done'], 1 < stats['polls'] < 10
+(0, 1, True)
+
+Failures are raised in the waiting job.
+
+>>> states['B'] = 'FAILURE'
+>>> shared_engine.run(poller.wait('B', timeout=5))
+Traceback (most recent call last):
+...
+RuntimeError: Crispresso on B: Bad input
+
+Errors of requests are retried.
+
+>>> errors = [requests.ConnectionError('Reset')] * 2
+>>> def get_state(id):
+...     if errors:
+...         raise errors.pop()
+...     return 'SUCCESS', ''
+>>> poller = StatusPoller(get_state, lambda id: True,
+...                       slots=1, expected_run=0.02, min_interval=0.01, max_interval=0.05)
+>>> shared_engine.run(poller.wait('C', timeout=5))
+>>> poller.stats()['errors'], poller.stats()['done']
+(2, 1)
+
+A report stuck in PENDING is found by ready_interval, long before it is due.
+
+>>> poller = StatusPoller(lambda id: ('PENDING', ''), lambda id: True, slots=1,
+...                       expected_run=600, min_interval=0.01, ready_interval=0.05)
+>>> start = time.time()
+>>> shared_engine.run(poller.wait('D', timeout=5))
+>>> time.time() - start < 1
+True
+"""
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import requests
+
+try:
+    from .engine import shared_engine
+except ImportError:
+    # For doctest, which is not run in package context
+    from engine import shared_engine  # type: ignore # noqa
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of one report
+MIN_INTERVAL = 10
+MAX_INTERVAL = 60
+# Seconds that a report of one sample is expected to run, until some are done.
+# Typically took 300s in testing.
+EXPECTED_RUN = 300
+# Weight of the latest duration in the expected duration
+DURATION_WEIGHT = 0.3
+# Max checks in flight
+MAX_CHECKS = 8
+# Seconds between checks of a report in PENDING for its report, before it is
+# overdue. Same as the fixed interval of polling before the poller.
+READY_INTERVAL = 30
+# Errors of requests in a row before a report fails
+MAX_ERRORS = 5
+
+
+class _Report:
+
+    def __init__(self, report_id: str, future: asyncio.Future, deadline: float, size: int) -> None:
+        self.id = report_id
+        self.future = future
+        self.deadline = deadline
+        self.size = size
+        self.registered_at = time.time()
+        # When first seen running, if ever
+        self.started_at = None  # type: Optional[float]
+        self.state = None  # type: Optional[str]
+        self.next_poll = self.registered_at
+        self.ready_checked_at = self.registered_at
+        # Errors of requests in a row
+        self.errors = 0
+        self.waiters = 0
+
+
+class StatusPoller:
+    """
+    get_state returns the Celery state of a report and a message, such as
+    ('FAILURE', 'Bad input'). is_ready returns whether the report can be read,
+    because a state of SUCCESS may come before the report, and the state may
+    stay PENDING forever though the report exists. Both are blocking calls.
+
+    slots is how many reports Crispresso runs at a time.
+
+    Errors of requests in get_state or is_ready are retried, with the wait
+    doubling from min_interval, until MAX_ERRORS in a row or the deadline.
+    Other errors fail the report.
+
+    There are two public methods: wait and stats.
+    """
+
+    def __init__(self,
+                 get_state: Callable[[str], Tuple[str, str]],
+                 is_ready: Callable[[str], bool],
+                 slots: int,
+                 expected_run: float = EXPECTED_RUN,
+                 min_interval: float = MIN_INTERVAL,
+                 max_interval: float = MAX_INTERVAL,
+                 ready_interval: float = READY_INTERVAL) -> None:
+        self.get_state = get_state
+        self.is_ready = is_ready
+        self.slots = slots
+        self.expected_run = expected_run
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.ready_interval = ready_interval
+        # Only touched on the engine loop, so no lock
+        self._reports = OrderedDict()  # type: Dict[str, _Report]
+        self._task = None  # type: Any
+        self._wakeup = None  # type: Any
+        self._stats = dict(polls=0, done=0, failed=0, timed_out=0, errors=0)
+
+    async def wait(self, report_id: str, timeout: float, size: int = 1) -> None:
+        """
+        Until the report is ready. Raises RuntimeError if Crispresso failed, or
+        TimeoutError after timeout seconds. size is the number of samples.
+        """
+        report = self._reports.get(report_id)
+        if report is None:
+            report = _Report(
+                report_id, asyncio.get_event_loop().create_future(), time.time() + timeout, size)
+            self._reports[report_id] = report
+        else:
+            report.deadline = max(report.deadline, time.time() + timeout)
+        self._ensure_running()
+
+        report.waiters += 1
+        try:
+            await asyncio.shield(report.future)
+        finally:
+            report.waiters -= 1
+            if not report.waiters and not report.future.done():
+                # All waiters gave up
+                self._reports.pop(report_id, None)
+                report.future.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats, outstanding=len(self._reports), expected_run=self.expected_run)
+
+    def _ensure_running(self) -> None:
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        else:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        checks = asyncio.Semaphore(MAX_CHECKS)
+        try:
+            while self._reports:
+                now = time.time()
+                due = [r for r in self._reports.values() if r.next_poll <= now]
+                await asyncio.gather(*[self._poll(r, checks) for r in due])
+
+                if not self._reports:
+                    break
+                delay = min(r.next_poll for r in self._reports.values()) - time.time()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(0, delay))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._task = None
+
+    async def _poll(self, report: _Report, checks: asyncio.Semaphore) -> None:
+        async with checks:
+            if report.future.done():
+                return
+            self._stats['polls'] += 1
+            try:
+                state, message = await shared_engine.call(self.get_state, report.id)
+                now = time.time()
+                ready = self._may_be_ready(report, state, now) and \
+                    await shared_engine.call(self.is_ready, report.id)
+            except requests.RequestException as e:
+                self._retry(report, e)
+                return
+            except Exception as e:
+                self._finish(report, exception=e)
+                return
+        report.errors = 0
+
+        # A report that is ready on the first check says nothing about durations
+        first = report.state is None
+        if state != report.state:
+            logger.info('Crispresso on {}: {}'.format(report.id, state))
+            report.state = state
+            if state != 'PENDING' and report.started_at is None:
+                report.started_at = now
+
+        if ready:
+            if not first:
+                run = (now - (report.started_at or report.registered_at)) / report.size
+                self.expected_run += DURATION_WEIGHT * (run - self.expected_run)
+            self._finish(report)
+        elif state == 'FAILURE':
+            self._finish(report, exception=RuntimeError(
+                'Crispresso on {}: {}'.format(report.id, message)))
+        elif now > report.deadline:
+            self._finish(report, exception=TimeoutError(
+                'Crispresso on {}: No report after {:.0f}s.'.format(
+                    report.id, now - report.registered_at)))
+        else:
+            next_poll = now + self._interval(report, now)
+            if state == 'PENDING':
+                next_poll = min(next_poll, report.ready_checked_at + self.ready_interval)
+            report.next_poll = min(report.deadline, next_poll)
+
+    def _may_be_ready(self, report: _Report, state: str, now: float) -> bool:
+        """Whether to check for the report"""
+        if state == 'SUCCESS':
+            return True
+        if state != 'PENDING':
+            return False
+        if now > self._eta(report) or now - report.ready_checked_at >= self.ready_interval:
+            report.ready_checked_at = now
+            return True
+        return False
+
+    def _retry(self, report: _Report, error: Exception) -> None:
+        self._stats['errors'] += 1
+        report.errors += 1
+        now = time.time()
+        if report.errors >= MAX_ERRORS or now > report.deadline:
+            self._finish(report, exception=error)
+            return
+        delay = min(self.max_interval, self.min_interval * 2 ** (report.errors - 1))
+        logger.warning('Crispresso status of {} failed, retry in {:.0f}s: {}'.format(
+            report.id, delay, error))
+        report.next_poll = min(report.deadline, now + delay)
+
+    def _eta(self, report: _Report) -> float:
+        """When the report is expected to be done"""
+        if report.started_at is not None:
+            return report.started_at + report.size * self.expected_run
+        ahead = 0
+        for other in self._reports.values():
+            if other is report:
+                break
+            ahead += other.size
+        return report.registered_at + (ahead / self.slots + report.size) * self.expected_run
+
+    def _interval(self, report: _Report, now: float) -> float:
+        """
+        Half the time left until expected, or a quarter of the time since, so
+        that checks are most frequent around when the report is expected.
+        """
+        eta = self._eta(report)
+        interval = (eta - now) / 2 if eta > now else (now - eta) / 4
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def _finish(self, report: _Report, exception: Exception = None) -> None:
+        self._reports.pop(report.id, None)
+        if exception is None:
+            self._stats['done'] += 1
+            report.future.set_result(None)
+        else:
+            self._stats['timed_out' if isinstance(exception, TimeoutError) else 'failed'] += 1
+            report.future.set_exception(exception)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()